@@ -0,0 +1,154 @@
+"""Admission control for blast sends - concurrency cap, bounded queue and idempotency keys
+
+A blast (manual send to every device) runs its fan-out in a worker thread, so the
+event loop keeps serving heartbeats and WebSockets. At most MAX_CONCURRENT_BLASTS
+run at once and MAX_QUEUED_BLASTS wait; beyond that requests get a 429 with a
+Retry-After estimated from recent blast durations. A request carrying an
+Idempotency-Key that was already seen gets the original result (or waits for the
+in-flight blast) instead of sending again.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+MAX_CONCURRENT_BLASTS = int(os.getenv("MAX_CONCURRENT_BLASTS", "2"))
+MAX_QUEUED_BLASTS = int(os.getenv("MAX_QUEUED_BLASTS", "4"))
+
+# How long a finished blast's result is replayed for a repeated idempotency key
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+MAX_IDEMPOTENCY_KEYS = 1000
+
+# Retry-After used before any blast duration has been measured
+DEFAULT_BLAST_SECONDS = 5.0
+
+# Retry-After for blasts refused while the server drains for a restart
+DRAIN_RETRY_AFTER_SECONDS = 15
+
+
+class BlastAdmission:
+    def __init__(self, max_concurrent=MAX_CONCURRENT_BLASTS, max_queued=MAX_QUEUED_BLASTS):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.running = 0
+        self.waiting = 0
+        self.avg_duration = DEFAULT_BLAST_SECONDS
+        self.counters = {"admitted": 0, "rejected": 0, "replayed": 0, "completed": 0, "failed": 0}
+        # Set on shutdown: new blasts are refused, running ones finish
+        self.draining = False
+        # idempotency key -> (payload hash, future, finished_at)
+        self._keys = OrderedDict()
+        self._semaphore = None
+
+    def _slots(self):
+        # Created lazily so it binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    def retry_after(self):
+        """Seconds until a slot is likely free"""
+        rounds = (self.waiting + 1) / max(1, self.max_concurrent)
+        return max(1, math.ceil(rounds * self.avg_duration))
+
+    def _expire_keys(self, now):
+        """Drop finished keys past their TTL, and the oldest finished ones beyond the cap"""
+        while self._keys:
+            _, _, finished_at = next(iter(self._keys.values()))
+            if finished_at is None:
+                break  # Oldest blast still in flight
+            if now - finished_at <= IDEMPOTENCY_TTL_SECONDS and len(self._keys) <= MAX_IDEMPOTENCY_KEYS:
+                break
+            self._keys.popitem(last=False)
+
+    async def run(self, scope, payload, job, idempotency_key=None):
+        """Run job() (a coroutine factory) under admission control, returns its result"""
+        self._expire_keys(time.time())
+
+        key = None
+        payload_hash = None
+        if idempotency_key:
+            key = f"{scope}:{idempotency_key}"
+            payload_hash = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+            seen = self._keys.get(key)
+            if seen is not None:
+                if seen[0] != payload_hash:
+                    raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different payload")
+                self.counters["replayed"] += 1
+                # Shielded so a disconnecting retry doesn't cancel the original blast
+                return await asyncio.shield(seen[1])
+
+        if self.draining:
+            self.counters["rejected"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Server is restarting",
+                headers={"Retry-After": str(DRAIN_RETRY_AFTER_SECONDS)}
+            )
+
+        if self.running + self.waiting >= self.max_concurrent + self.max_queued:
+            self.counters["rejected"] += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Too many notification blasts in progress",
+                headers={"Retry-After": str(self.retry_after())}
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        if key:
+            self._keys[key] = (payload_hash, future, None)
+        self.counters["admitted"] += 1
+
+        try:
+            result = await self._run_admitted(job)
+        except BaseException as e:
+            self.counters["failed"] += 1
+            # Failed blasts are not replayed: a retry with the same key sends again
+            if key:
+                self._keys.pop(key, None)
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # Mark retrieved when no retry is waiting on it
+            raise
+
+        self.counters["completed"] += 1
+        future.set_result(result)
+        if key and key in self._keys:
+            self._keys[key] = (payload_hash, future, time.time())
+        return result
+
+    async def _run_admitted(self, job):
+        """Wait for a free slot, then run the job"""
+        self.waiting += 1
+        try:
+            await self._slots().acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        started = time.monotonic()
+        try:
+            return await job()
+        finally:
+            self.running -= 1
+            self._slots().release()
+            self.avg_duration = 0.8 * self.avg_duration + 0.2 * (time.monotonic() - started)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queued": self.max_queued,
+            "draining": self.draining,
+            "avg_blast_seconds": round(self.avg_duration, 2),
+            "idempotency_keys": len(self._keys),
+            **self.counters,
+        }
@@ -0,0 +1,81 @@
+"""Collapse keys - newer notifications replace pending ones instead of stacking up
+
+Superseding is per device: a newer blast for the same key only makes an older,
+still running blast skip the devices the newer one also targets. A blast sent
+to a subset of devices doesn't cancel a fleet-wide one for everybody else.
+"""
+import base64
+import hashlib
+import itertools
+import re
+import threading
+from contextlib import contextmanager
+
+# WebPush Topic header: at most 32 characters from the URL-safe base64 alphabet (RFC 8030)
+TOPIC_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+# collapse key -> {generation: [target fingerprints (None = every device), finished]}
+# Finished blasts are kept only while an older one for the same key is still running,
+# the key itself is dropped once none is
+_blasts = {}
+_generations = itertools.count(1)
+_lock = threading.Lock()
+
+
+def topic_for(collapse_key):
+    """Return a valid WebPush Topic header value for a collapse key"""
+    if TOPIC_PATTERN.match(collapse_key):
+        return collapse_key
+    digest = hashlib.sha256(collapse_key.encode("utf-8")).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")[:32]
+
+
+def claim(collapse_key, fingerprints=None):
+    """Start a blast for collapse_key to `fingerprints` (every device when None), returns its generation"""
+    targets = frozenset(fingerprints) if fingerprints is not None else None
+    with _lock:
+        generation = next(_generations)
+        _blasts.setdefault(collapse_key, {})[generation] = [targets, False]
+        return generation
+
+
+def is_superseded(collapse_key, generation, fingerprint):
+    """True if a newer blast for collapse_key also targets this device"""
+    with _lock:
+        for newer, (targets, _) in _blasts.get(collapse_key, {}).items():
+            if newer > generation and (targets is None or fingerprint in targets):
+                return True
+        return False
+
+
+def release(collapse_key, generation):
+    """Mark a blast as finished and forget what no running blast can be superseded by"""
+    with _lock:
+        blasts = _blasts.get(collapse_key)
+        if not blasts or generation not in blasts:
+            return
+        blasts[generation][1] = True
+        running = [number for number, (_, finished) in blasts.items() if not finished]
+        if not running:
+            del _blasts[collapse_key]
+            return
+        # Only newer blasts can supersede a running one
+        for number in [number for number in blasts if number < min(running)]:
+            del blasts[number]
+
+
+@contextmanager
+def blast(collapse_key, fingerprints=None):
+    """Claim collapse_key for the duration of a blast
+
+    Yields is_superseded(fingerprint) for the fan-out loop, or None when the send
+    has no collapse key.
+    """
+    if not collapse_key:
+        yield None
+        return
+    generation = claim(collapse_key, fingerprints)
+    try:
+        yield lambda fingerprint: is_superseded(collapse_key, generation, fingerprint)
+    finally:
+        release(collapse_key, generation)
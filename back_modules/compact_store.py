@@ -0,0 +1,366 @@
+"""Compact in-memory and on-disk representation of subscriptions
+
+Records use __slots__ instead of per-subscription dicts, WebPush endpoints are
+split into an interned origin (shared by every device of the same push
+service) plus a path, and encryption keys are kept as raw bytes instead of
+base64 text. Snapshots use a small binary format with an origin table.
+"""
+import base64
+import binascii
+import struct
+import sys
+from array import array
+from itertools import accumulate
+from urllib.parse import urlsplit
+
+WEBPUSH_MAGIC = b"PWSUB\x02"
+FCM_MAGIC = b"PWFCM\x02"
+# NUL-joined text columns and u16 key lengths (still readable)
+WEBPUSH_MAGIC_V1 = b"PWSUB\x01"
+FCM_MAGIC_V1 = b"PWFCM\x01"
+
+_U32 = struct.Struct("<I")
+# Length marker for a None text value
+_NONE_LENGTH = 0xFFFFFFFF
+
+# Size caps checked when a subscription is accepted (see the handlers' Pydantic models)
+MAX_ENDPOINT_LENGTH = 2048
+MAX_KEY_LENGTH = 256
+MAX_FINGERPRINT_LENGTH = 256
+MAX_TOKEN_LENGTH = 4096
+MAX_TIMEZONE_LENGTH = 64
+NO_NUL_PATTERN = r"^[^\x00]*$"
+
+
+def _b64_to_bytes(value):
+    """Decode an unpadded base64url key; values that don't round-trip are kept as text"""
+    if not isinstance(value, str):
+        return value
+    try:
+        raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+    except (binascii.Error, ValueError):
+        return value
+    return raw if _bytes_to_b64(raw) == value else value
+
+
+def _bytes_to_b64(value):
+    if isinstance(value, bytes):
+        return base64.urlsafe_b64encode(value).decode("ascii").rstrip("=")
+    return value
+
+
+def split_endpoint(endpoint):
+    """Split an endpoint URL into (interned origin, path)"""
+    parts = urlsplit(endpoint)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    return sys.intern(origin), endpoint[len(origin):]
+
+
+class WebPushRecord:
+    """A WebPush subscription (dict-like .get() for the fields the handlers use)"""
+
+    __slots__ = ("device_fingerprint", "origin", "path", "p256dh", "auth", "timezone", "quiet_start", "quiet_end")
+
+    def __init__(self, device_fingerprint, origin, path, p256dh, auth, timezone=None, quiet_start=None, quiet_end=None):
+        self.device_fingerprint = device_fingerprint
+        self.origin = origin
+        self.path = path
+        self.p256dh = p256dh
+        self.auth = auth
+        self.timezone = timezone
+        self.quiet_start = quiet_start
+        self.quiet_end = quiet_end
+
+    @classmethod
+    def from_dict(cls, data):
+        origin, path = split_endpoint(data["endpoint"])
+        keys = data.get("keys") or {}
+        return cls(
+            data.get("device_fingerprint"),
+            origin,
+            path,
+            _b64_to_bytes(keys.get("p256dh")),
+            _b64_to_bytes(keys.get("auth")),
+            data.get("timezone"),
+            data.get("quiet_start"),
+            data.get("quiet_end"),
+        )
+
+    @property
+    def endpoint(self):
+        return self.origin + self.path
+
+    @property
+    def keys(self):
+        return {"p256dh": _bytes_to_b64(self.p256dh), "auth": _bytes_to_b64(self.auth)}
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def subscription_info(self):
+        """Dict in the shape pywebpush expects"""
+        return {"endpoint": self.endpoint, "keys": self.keys}
+
+    def to_dict(self):
+        return {
+            "endpoint": self.endpoint,
+            "keys": self.keys,
+            "device_fingerprint": self.device_fingerprint,
+            "timezone": self.timezone,
+            "quiet_start": self.quiet_start,
+            "quiet_end": self.quiet_end,
+        }
+
+
+class FCMTokenRecord:
+    """An FCM registration token (dict-like .get() for the fields the handlers use)"""
+
+    __slots__ = ("token", "device_fingerprint", "timezone", "quiet_start", "quiet_end")
+
+    def __init__(self, token, device_fingerprint, timezone=None, quiet_start=None, quiet_end=None):
+        self.token = token
+        self.device_fingerprint = device_fingerprint
+        self.timezone = timezone
+        self.quiet_start = quiet_start
+        self.quiet_end = quiet_end
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data.get("token"),
+            data.get("device_fingerprint"),
+            data.get("timezone"),
+            data.get("quiet_start"),
+            data.get("quiet_end"),
+        )
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def to_dict(self):
+        return {
+            "token": self.token,
+            "device_fingerprint": self.device_fingerprint,
+            "timezone": self.timezone,
+            "quiet_start": self.quiet_start,
+            "quiet_end": self.quiet_end,
+        }
+
+
+# ============================================================================
+# BINARY SNAPSHOT FORMAT
+# ============================================================================
+#
+# Columnar: magic followed by sections, each prefixed with its u32 byte length.
+# Text columns are a u32 count, a u32 byte length per value (0xFFFFFFFF = None)
+# and the concatenated UTF-8, so any value (including NUL) round-trips; numeric
+# columns are little-endian arrays decoded with C-level frombytes calls.
+#
+# WebPush: origins, origin index (u32), fingerprints, paths, timezones,
+#          quiet hours (i8 x2, -1 = None), key kinds (u8 x2, 0 raw / 1 text),
+#          key lengths (u32 x2), key bytes
+# FCM:     count, tokens, fingerprints, timezones, quiet hours
+#
+# Version 1 snapshots (NUL-joined text, empty string = None, u16 key lengths)
+# are still decoded and rewritten as version 2 on the next compaction.
+
+
+def _array_bytes(typecode, values):
+    column = array(typecode, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tobytes()
+
+
+def _array_from(typecode, data):
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def _text_column(values):
+    lengths = []
+    blob = []
+    for value in values:
+        if value is None:
+            lengths.append(_NONE_LENGTH)
+        else:
+            raw = value.encode("utf-8")
+            lengths.append(len(raw))
+            blob.append(raw)
+    return _U32.pack(len(lengths)) + _array_bytes("I", lengths) + b"".join(blob)
+
+
+def _read_text(data, count=None):
+    data = bytes(data)
+    if len(data) < 4:
+        raise ValueError("Corrupt subscription snapshot column")
+    size = _U32.unpack_from(data)[0]
+    offset = 4 + 4 * size
+    if (count is not None and size != count) or offset > len(data):
+        raise ValueError("Corrupt subscription snapshot column")
+
+    lengths = _array_from("I", data[4:offset])
+    ends = list(accumulate((0 if length == _NONE_LENGTH else length for length in lengths), initial=0))
+    blob = data[offset:]
+    if ends[-1] != len(blob):
+        raise ValueError("Corrupt subscription snapshot column")
+
+    # ASCII columns (the common case) decode once and are sliced as text
+    text = blob.decode("utf-8")
+    source = text if len(text) == len(blob) else blob
+    values = [source[start:end] for start, end in zip(ends, ends[1:])]
+    if source is blob:
+        values = [value.decode("utf-8") for value in values]
+    if _NONE_LENGTH in lengths:
+        values = [None if length == _NONE_LENGTH else value for length, value in zip(lengths, values)]
+    return values
+
+
+def _split_text_v1(data, count):
+    if count == 0:
+        return []
+    values = bytes(data).decode("utf-8").split("\x00")
+    if len(values) != count:
+        raise ValueError("Corrupt subscription snapshot column")
+    return [value or None for value in values]
+
+
+def _pack_sections(magic, sections):
+    out = [magic]
+    for section in sections:
+        out.append(_U32.pack(len(section)))
+        out.append(section)
+    return b"".join(out)
+
+
+def _unpack_sections(magics, data, count):
+    """Return (magic, sections) for data starting with one of magics"""
+    view = memoryview(data)
+    magic = bytes(view[:len(magics[0])])
+    if magic not in magics:
+        raise ValueError("Unknown subscription snapshot format")
+    offset = len(magic)
+    sections = []
+    for _ in range(count):
+        if offset + 4 > len(view):
+            raise ValueError("Truncated subscription snapshot")
+        size = _U32.unpack_from(view, offset)[0]
+        offset += 4
+        if offset + size > len(view):
+            raise ValueError("Truncated subscription snapshot")
+        sections.append(view[offset:offset + size])
+        offset += size
+    return magic, sections
+
+
+def _quiet_column(records):
+    values = []
+    for record in records:
+        values.append(-1 if record.quiet_start is None else record.quiet_start)
+        values.append(-1 if record.quiet_end is None else record.quiet_end)
+    return _array_bytes("b", values)
+
+
+def _quiet_pairs(data):
+    column = _array_from("b", data)
+    return [
+        (None if start < 0 else start, None if end < 0 else end)
+        for start, end in zip(column[::2], column[1::2])
+    ]
+
+
+def encode_webpush(records):
+    origins = {}
+    for record in records:
+        origins.setdefault(record.origin, len(origins))
+
+    kinds = []
+    lengths = []
+    key_blob = []
+    for record in records:
+        for key in (record.p256dh, record.auth):
+            raw = key if isinstance(key, bytes) else (key or "").encode("utf-8")
+            kinds.append(0 if isinstance(key, bytes) else 1)
+            lengths.append(len(raw))
+            key_blob.append(raw)
+
+    return _pack_sections(WEBPUSH_MAGIC, [
+        _text_column(origins),
+        _array_bytes("I", [origins[record.origin] for record in records]),
+        _text_column(record.device_fingerprint for record in records),
+        _text_column(record.path for record in records),
+        _text_column(record.timezone for record in records),
+        _quiet_column(records),
+        _array_bytes("B", kinds),
+        _array_bytes("I", lengths),
+        b"".join(key_blob),
+    ])
+
+
+def decode_webpush(data):
+    magic, (origins_col, index_col, fingerprint_col, path_col, timezone_col,
+            quiet_col, kind_col, length_col, key_col) = _unpack_sections((WEBPUSH_MAGIC, WEBPUSH_MAGIC_V1), data, 9)
+
+    indexes = _array_from("I", index_col)
+    count = len(indexes)
+    if magic == WEBPUSH_MAGIC_V1:
+        origins = bytes(origins_col).decode("utf-8").split("\x00") if count else []
+        read_text = _split_text_v1
+        lengths = _array_from("H", length_col)
+    else:
+        origins = _read_text(origins_col)
+        read_text = _read_text
+        lengths = _array_from("I", length_col)
+    origins = [sys.intern(origin) for origin in origins]
+    fingerprints = read_text(fingerprint_col, count)
+    paths = read_text(path_col, count)
+    timezones = read_text(timezone_col, count)
+    quiet = _quiet_pairs(quiet_col)
+    kinds = _array_from("B", kind_col)
+
+    keys = []
+    key_bytes = bytes(key_col)
+    offset = 0
+    for kind, length in zip(kinds, lengths):
+        raw = key_bytes[offset:offset + length]
+        keys.append(raw if kind == 0 else raw.decode("utf-8"))
+        offset += length
+
+    return [
+        WebPushRecord(
+            fingerprints[i], origins[indexes[i]], paths[i] or "", keys[2 * i], keys[2 * i + 1],
+            timezones[i], quiet[i][0], quiet[i][1]
+        )
+        for i in range(count)
+    ]
+
+
+def encode_fcm(records):
+    return _pack_sections(FCM_MAGIC, [
+        _U32.pack(len(records)),
+        _text_column(record.token for record in records),
+        _text_column(record.device_fingerprint for record in records),
+        _text_column(record.timezone for record in records),
+        _quiet_column(records),
+    ])
+
+
+def decode_fcm(data):
+    magic, (count_col, token_col, fingerprint_col, timezone_col, quiet_col) = _unpack_sections(
+        (FCM_MAGIC, FCM_MAGIC_V1), data, 5
+    )
+    count = _U32.unpack(count_col)[0]
+    read_text = _split_text_v1 if magic == FCM_MAGIC_V1 else _read_text
+    tokens = read_text(token_col, count)
+    fingerprints = read_text(fingerprint_col, count)
+    timezones = read_text(timezone_col, count)
+    quiet = _quiet_pairs(quiet_col)
+    return [
+        FCMTokenRecord(tokens[i], fingerprints[i], timezones[i], quiet[i][0], quiet[i][1])
+        for i in range(count)
+    ]
@@ -0,0 +1,92 @@
+"""Streaming export - NDJSON / CSV bodies generated row by row, gzipped on the fly"""
+import csv
+import io
+import json
+import zlib
+
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from .assets import accepted_encodings
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+# Rows are encoded into chunks of about this size before being sent / compressed
+CHUNK_BYTES = 64 * 1024
+
+GZIP_LEVEL = 6
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def csv_lines(rows, columns):
+    """CSV header + one line per row; dict / list values are written as JSON"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    yield line(columns)
+    for row in rows:
+        yield line([
+            json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+            for value in (row.get(column) for column in columns)
+        ])
+
+
+def chunked(lines, size=CHUNK_BYTES):
+    """Join text lines into byte chunks of roughly `size`"""
+    parts = []
+    pending = 0
+    for text in lines:
+        data = text.encode("utf-8")
+        parts.append(data)
+        pending += len(data)
+        if pending >= size:
+            yield b"".join(parts)
+            parts = []
+            pending = 0
+    if parts:
+        yield b"".join(parts)
+
+
+def gzip_chunks(chunks, level=GZIP_LEVEL):
+    """Compress a byte stream into a gzip stream incrementally"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_response(request: Request, rows, columns, fmt: str, filename: str):
+    """StreamingResponse for rows in the requested format, gzipped if the client accepts it
+
+    rows is a (sync) generator of dicts; it runs in the threadpool while the body is sent.
+    """
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format '{fmt}' (use {', '.join(FORMATS)})")
+
+    lines = ndjson_lines(rows) if fmt == "ndjson" else csv_lines(rows, columns)
+    body = chunked(lines)
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}.{fmt}"',
+        "Cache-Control": "no-store",
+        "Vary": "Accept-Encoding",
+    }
+    if "gzip" in accepted_encodings(request.headers.get("accept-encoding", "")):
+        body = gzip_chunks(body)
+        headers["Content-Encoding"] = "gzip"
+
+    return StreamingResponse(body, media_type=FORMATS[fmt], headers=headers)
@@ -1,31 +1,51 @@
 """Firebase Cloud Messaging handler"""
 from fastapi import APIRouter
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List, Optional
 from pathlib import Path
-import json
-import firebase_admin
-from firebase_admin import credentials, messaging
+import asyncio
+import threading
+
+from . import collapse, storage, compact_store, receipts, sharding
 
 router = APIRouter()
 
-# Data file
-FCM_TOKENS_FILE = Path("data/subscriptions_fcm.json")
+# Data files (compact binary snapshot; the JSON file is migrated on first load)
+FCM_TOKENS_FILE = Path("data/subscriptions_fcm.bin")
+LEGACY_FCM_TOKENS_FILE = Path("data/subscriptions_fcm.json")
+
+# Collapse key used by the periodic sender
+FCM_PERIODIC_COLLAPSE_KEY = "fcm-periodic"
 
+# firebase_admin (and its google/grpc dependencies) is imported on first use
+_firebase_init_attempted = False
+_firebase_lock = threading.Lock()
 
+
+# Stored fields are size-capped and NUL-free (compact_store snapshot limits)
 class FCMSubscription(BaseModel):
-    token: str
-    device_fingerprint: str
+    token: str = Field(max_length=compact_store.MAX_TOKEN_LENGTH, pattern=compact_store.NO_NUL_PATTERN)
+    device_fingerprint: str = Field(max_length=compact_store.MAX_FINGERPRINT_LENGTH, pattern=compact_store.NO_NUL_PATTERN)
+    # IANA name, e.g. "Europe/Madrid"
+    timezone: Optional[str] = Field(None, max_length=compact_store.MAX_TIMEZONE_LENGTH, pattern=compact_store.NO_NUL_PATTERN)
+    quiet_start: Optional[int] = Field(None, ge=0, le=23)  # Local hour when periodic deliveries pause
+    quiet_end: Optional[int] = Field(None, ge=0, le=23)  # Local hour when periodic deliveries resume
 
 
 class FCMNotificationPayload(BaseModel):
     title: str
     body: str
     icon: str = "/static/icon-192.png"
+    collapse_key: Optional[str] = None
+    # Only these devices (all subscribers when omitted)
+    device_fingerprints: Optional[List[str]] = None
 
 
 def init_firebase():
     """Initialize Firebase Admin SDK"""
     try:
+        import firebase_admin
+        from firebase_admin import credentials
         cred = credentials.Certificate("secrets/barret-firebase-service-account.json")
         firebase_admin.initialize_app(cred)
         print("✅ Firebase Admin SDK initialized")
@@ -35,46 +55,116 @@ def init_firebase():
         return False
 
 
+def get_messaging():
+    """Return firebase_admin.messaging, importing and initializing Firebase on first use"""
+    global _firebase_init_attempted
+    with _firebase_lock:
+        if not _firebase_init_attempted:
+            _firebase_init_attempted = True
+            init_firebase()
+    from firebase_admin import messaging
+    return messaging
+
+
+# Snapshot + journal of FCM token mutations (keyed by device fingerprint)
+fcm_tokens_store = storage.JournaledStore(
+    FCM_TOKENS_FILE,
+    storage.apply_keyed_list_op("device_fingerprint", compact_store.FCMTokenRecord.from_dict),
+    name="FCM tokens",
+    encode=compact_store.encode_fcm,
+    decode=compact_store.decode_fcm
+)
+legacy_fcm_tokens_store = storage.JournaledStore(LEGACY_FCM_TOKENS_FILE, storage.apply_keyed_list_op("device_fingerprint"), name="FCM tokens")
+
+
 def load_fcm_tokens():
-    """Load FCM tokens from JSON file"""
-    if FCM_TOKENS_FILE.exists():
-        try:
-            with open(FCM_TOKENS_FILE, "r") as f:
-                content = f.read().strip()
-                if content:
-                    return json.loads(content)
-        except (json.JSONDecodeError, Exception) as e:
-            print(f"⚠️ Error loading FCM tokens: {e}. Starting with empty list.")
-    return []
+    """Load FCM tokens (FCMTokenRecord list) from snapshot + journal"""
+    storage.migrate_list_store(legacy_fcm_tokens_store, fcm_tokens_store, compact_store.FCMTokenRecord.from_dict)
+    return fcm_tokens_store.load()
 
 
 def save_fcm_tokens(tokens):
-    """Save FCM tokens to JSON file"""
-    FCM_TOKENS_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(FCM_TOKENS_FILE, "w") as f:
-        json.dump(tokens, f, indent=2)
+    """Write a full FCM tokens snapshot (atomic) and reset the journal"""
+    fcm_tokens_store.snapshot(tokens)
+
 
+def prune_fcm_tokens(tokens=(), fingerprints=()):
+    """Remove FCM tokens by token value or device fingerprint in one pass and save once"""
+    global fcm_tokens
+    tokens = set(tokens)
+    fingerprints = set(fingerprints)
+    if not tokens and not fingerprints:
+        return 0
+    
+    if sharding.coordinator:
+        removed = sharding.coordinator.remove("fcm", "token", tokens)
+        removed += sharding.coordinator.remove("fcm", "device_fingerprint", fingerprints)
+        if removed:
+            print(f"🗑️ Pruned {removed} invalid FCM token(s)")
+        return removed
+    
+    with fcm_tokens_lock:
+        remaining = [
+            token for token in fcm_tokens
+            if token.get("token") not in tokens
+            and token.get("device_fingerprint") not in fingerprints
+        ]
+        removed = len(fcm_tokens) - len(remaining)
+        if removed:
+            fcm_tokens = remaining
+            if tokens:
+                fcm_tokens_store.append({"op": "remove", "field": "token", "values": sorted(tokens)}, fcm_tokens)
+            if fingerprints:
+                fcm_tokens_store.append({"op": "remove", "field": "device_fingerprint", "values": sorted(fingerprints)}, fcm_tokens)
+    if removed:
+        print(f"🗑️ Pruned {removed} invalid FCM token(s)")
+    return removed
 
-# Load tokens on module import
-fcm_tokens = load_fcm_tokens()
+
+def init_fcm_tokens():
+    """Load FCM tokens into memory (called at startup)"""
+    global fcm_tokens
+    with fcm_tokens_lock:
+        fcm_tokens = load_fcm_tokens()
+    return fcm_tokens
+
+
+async def fcm_token_total():
+    """Number of FCM tokens (summed over the shard workers when sharded)"""
+    if sharding.coordinator:
+        return await asyncio.to_thread(sharding.coordinator.count, "fcm")
+    return len(fcm_tokens)
+
+
+# In-memory tokens, loaded at startup by init_fcm_tokens (not on import).
+# Copy-on-write like webpush_handler.subscriptions: rebind under fcm_tokens_lock,
+# never mutate in place, so fan-out loops iterate a stable snapshot.
+fcm_tokens = []
+fcm_tokens_lock = threading.RLock()
 
 
 @router.post("/api/fcm/subscribe")
 async def fcm_subscribe(subscription: FCMSubscription, add_history_callback=None, broadcast_callback=None):
     """Store FCM token"""
     global fcm_tokens
+    record = compact_store.FCMTokenRecord.from_dict(subscription.model_dump())
     
-    # Remove old token from same device
-    fcm_tokens = [
-        token for token in fcm_tokens
-        if token.get("device_fingerprint") != subscription.device_fingerprint
-    ]
-    
-    # Add new token
-    fcm_tokens.append(subscription.model_dump())
-    save_fcm_tokens(fcm_tokens)
+    if sharding.coordinator:
+        # Stored (replacing the device's old token) by the shard owning the fingerprint
+        await asyncio.to_thread(sharding.coordinator.put, "fcm", record.to_dict())
+    else:
+        with fcm_tokens_lock:
+            # Replace old token from same device
+            updated = [
+                token for token in fcm_tokens
+                if token.get("device_fingerprint") != subscription.device_fingerprint
+            ]
+            updated.append(record)
+            fcm_tokens = updated
+            fcm_tokens_store.append({"op": "put", "record": record.to_dict()}, fcm_tokens)
+    total = await fcm_token_total()
     print(f"✅ New FCM token from device: {subscription.device_fingerprint[:16]}...")
-    print(f"📊 Total FCM tokens: {len(fcm_tokens)}")
+    print(f"📊 Total FCM tokens: {total}")
     
     # Add to history if callback provided
     if add_history_callback and broadcast_callback:
@@ -83,27 +173,37 @@ async def fcm_subscribe(subscription: FCMSubscription, add_history_callback=None
             message="🔥 Dispositivo suscrito a FCM",
             details={
                 "device": subscription.device_fingerprint[:16],
-                "total": len(fcm_tokens)
+                "total": total
             }
         )
         await broadcast_callback()
     
-    return {"status": "subscribed", "total": len(fcm_tokens)}
+    return {"status": "subscribed", "total": total}
 
 
 @router.post("/api/fcm/unsubscribe")
 async def fcm_unsubscribe(subscription: FCMSubscription, add_history_callback=None, broadcast_callback=None):
     """Remove FCM token"""
     global fcm_tokens
-    initial_count = len(fcm_tokens)
-    fcm_tokens = [
-        token for token in fcm_tokens
-        if token.get("device_fingerprint") != subscription.device_fingerprint
-    ]
-    removed = initial_count - len(fcm_tokens)
-    save_fcm_tokens(fcm_tokens)
+    if sharding.coordinator:
+        removed = await asyncio.to_thread(
+            sharding.coordinator.remove, "fcm", "device_fingerprint", [subscription.device_fingerprint]
+        )
+    else:
+        with fcm_tokens_lock:
+            initial_count = len(fcm_tokens)
+            fcm_tokens = [
+                token for token in fcm_tokens
+                if token.get("device_fingerprint") != subscription.device_fingerprint
+            ]
+            removed = initial_count - len(fcm_tokens)
+            fcm_tokens_store.append(
+                {"op": "remove", "field": "device_fingerprint", "values": [subscription.device_fingerprint]},
+                fcm_tokens
+            )
+    total = await fcm_token_total()
     print(f"🗑️ Removed FCM token from device: {subscription.device_fingerprint[:16]}...")
-    print(f"📊 Total FCM tokens: {len(fcm_tokens)}")
+    print(f"📊 Total FCM tokens: {total}")
     
     # Add to history if callback provided
     if add_history_callback and broadcast_callback:
@@ -112,17 +212,20 @@ async def fcm_unsubscribe(subscription: FCMSubscription, add_history_callback=No
             message="🔥 Dispositivo desuscrito de FCM",
             details={
                 "device": subscription.device_fingerprint[:16],
-                "total": len(fcm_tokens)
+                "total": total
             }
         )
         await broadcast_callback()
     
-    return {"status": "unsubscribed", "removed": removed, "total": len(fcm_tokens)}
+    return {"status": "unsubscribed", "removed": removed, "total": total}
 
 
 @router.get("/api/fcm/check-subscription/{fingerprint}")
 async def fcm_check_subscription(fingerprint: str):
     """Check if a device is subscribed to FCM"""
+    if sharding.coordinator:
+        count = await asyncio.to_thread(sharding.coordinator.count, "fcm", [fingerprint])
+        return {"is_subscribed": count > 0}
     is_subscribed = any(
         token.get("device_fingerprint") == fingerprint 
         for token in fcm_tokens
@@ -134,9 +237,13 @@ async def fcm_check_subscription(fingerprint: str):
 async def fcm_clear_subscriptions(add_history_callback=None, broadcast_callback=None):
     """Clear all FCM subscriptions"""
     global fcm_tokens
-    count = len(fcm_tokens)
-    fcm_tokens.clear()
-    save_fcm_tokens(fcm_tokens)
+    if sharding.coordinator:
+        count = await asyncio.to_thread(sharding.coordinator.clear, "fcm")
+    else:
+        with fcm_tokens_lock:
+            count = len(fcm_tokens)
+            fcm_tokens = []
+            save_fcm_tokens(fcm_tokens)
     print(f"🗑️ Cleared all FCM subscriptions ({count} removed)")
     
     # Add to history if callback provided
@@ -154,42 +261,43 @@ async def fcm_clear_subscriptions(add_history_callback=None, broadcast_callback=
     return {"status": "cleared", "removed": count}
 
 
-@router.post("/api/fcm/send")
-async def fcm_send_notification(payload: FCMNotificationPayload, add_history_callback=None, broadcast_callback=None):
-    """Send FCM notification to all subscribed devices"""
-    print("=" * 50)
-    print("🔥 FCM: Send notification endpoint called")
-    print(f"📊 Total FCM tokens: {len(fcm_tokens)}")
+def deliver_fcm(targets, data, collapse_key=None, is_superseded=None):
+    """Blocking FCM sends to every target, returns (sent, failed, superseded, invalid tokens)
     
-    if not fcm_tokens:
-        print("⚠️ No FCM subscribers found")
-        return {"status": "no_subscribers", "sent": 0}
+    Shared by the blast endpoint and the shard workers (see deliver_webpush).
+    """
+    messaging = get_messaging()
+    
+    # Collapsible sends set FCM collapse_key / WebPush Topic
+    webpush_headers = {"Urgency": "high"}
+    android_config = None
+    if collapse_key:
+        webpush_headers["Topic"] = collapse.topic_for(collapse_key)
+        android_config = messaging.AndroidConfig(collapse_key=collapse_key)
     
     sent_count = 0
     failed_count = 0
+    superseded_count = 0
+    # Invalid tokens are collected and pruned once after the loop
+    invalid_tokens = set()
     
-    for idx, token_data in enumerate(fcm_tokens[:]):
+    for idx, token_data in enumerate(targets):
+        if is_superseded and is_superseded(token_data.get("device_fingerprint")):
+            superseded_count += 1
+            continue
         try:
             token = token_data.get("token")
             if not token:
                 continue
             
-            print(f"📤 Sending FCM to device {idx + 1}/{len(fcm_tokens)}: {token_data.get('device_fingerprint', 'unknown')[:16]}...")
+            print(f"📤 Sending FCM to device {idx + 1}/{len(targets)}: {token_data.get('device_fingerprint', 'unknown')[:16]}...")
             
-            # Send only data payload to trigger onBackgroundMessage in SW
-            # If we use notification field, browser shows it automatically and SW handler doesn't fire
             message = messaging.Message(
-                data={
-                    "title": payload.title,
-                    "body": payload.body,
-                    "icon": payload.icon or "/static/icon-192.png",
-                    "badge": "/static/icon-192.png"
-                },
+                data=data,
                 token=token,
+                android=android_config,
                 webpush=messaging.WebpushConfig(
-                    headers={
-                        "Urgency": "high"
-                    }
+                    headers=webpush_headers
                 )
             )
             
@@ -198,15 +306,76 @@ async def fcm_send_notification(payload: FCMNotificationPayload, add_history_cal
             sent_count += 1
             
         except messaging.UnregisteredError:
-            print(f"❌ Token is invalid or unregistered, removing...")
-            fcm_tokens.remove(token_data)
-            save_fcm_tokens(fcm_tokens)
+            print(f"❌ Token is invalid or unregistered, marking for removal...")
+            invalid_tokens.add(token)
             failed_count += 1
         except Exception as e:
             print(f"❌ Error sending FCM to device {idx + 1}: {e}")
             failed_count += 1
     
-    print(f"📊 FCM Results: Sent={sent_count}, Failed={failed_count}")
+    return sent_count, failed_count, superseded_count, invalid_tokens
+
+
+@router.post("/api/fcm/send")
+async def fcm_send_notification(payload: FCMNotificationPayload, add_history_callback=None, broadcast_callback=None):
+    """Send FCM notification to all subscribed devices"""
+    print("=" * 50)
+    print("🔥 FCM: Send notification endpoint called")
+    if sharding.coordinator:
+        # Tokens live in the shard workers, each one filters its own
+        targets = None
+        target_count = await asyncio.to_thread(sharding.coordinator.count, "fcm", payload.device_fingerprints)
+    else:
+        # Copy-on-write snapshot: concurrent (un)subscribes don't affect this fan-out
+        targets = fcm_tokens
+        if payload.device_fingerprints is not None:
+            wanted = set(payload.device_fingerprints)
+            targets = [token for token in targets if token.device_fingerprint in wanted]
+        target_count = len(targets)
+    print(f"📊 Total FCM tokens: {target_count}")
+    
+    if not target_count:
+        print("⚠️ No FCM subscribers found")
+        return {"status": "no_subscribers", "sent": 0}
+    
+    # Message id lets the service worker report delivery / click receipts
+    message_id = receipts.new_message_id()
+    receipts.register_message(message_id, "fcm", payload.title, target_count)
+    
+    # Send only data payload to trigger onBackgroundMessage in SW
+    # If we use notification field, browser shows it automatically and SW handler doesn't fire
+    data = {
+        "title": payload.title,
+        "body": payload.body,
+        "icon": payload.icon or "/static/icon-192.png",
+        "badge": "/static/icon-192.png",
+        "message_id": message_id
+    }
+    if payload.collapse_key:
+        data["tag"] = payload.collapse_key
+    
+    def fan_out():
+        """Blocking FCM sends to every target (runs in a worker thread)"""
+        if sharding.coordinator:
+            # Each shard worker sends to its own tokens and prunes its invalid ones
+            result = sharding.coordinator.blast(
+                "fcm", {"data": data, "collapse_key": payload.collapse_key}, payload.device_fingerprints
+            )
+            return result["sent"], result["failed"], result["superseded"]
+        
+        # A newer send with the same collapse key reaches the devices it shares with this one instead
+        with collapse.blast(payload.collapse_key, payload.device_fingerprints) as is_superseded:
+            sent_count, failed_count, superseded_count, invalid_tokens = deliver_fcm(
+                targets, data, payload.collapse_key, is_superseded
+            )
+        prune_fcm_tokens(tokens=invalid_tokens)
+        return sent_count, failed_count, superseded_count
+    
+    # Off the event loop, so heartbeats and WebSockets are served during the blast
+    sent_count, failed_count, superseded_count = await asyncio.to_thread(fan_out)
+    receipts.record_send_results(message_id, sent_count, failed_count)
+    
+    print(f"📊 FCM Results: Sent={sent_count}, Failed={failed_count}, Superseded={superseded_count}")
     print("=" * 50)
     
     # Add to history if callback provided
@@ -218,7 +387,9 @@ async def fcm_send_notification(payload: FCMNotificationPayload, add_history_cal
                 "title": payload.title,
                 "body": payload.body,
                 "sent": sent_count,
-                "failed": failed_count
+                "failed": failed_count,
+                "superseded": superseded_count,
+                "message_id": message_id
             }
         )
         await broadcast_callback()
@@ -227,5 +398,7 @@ async def fcm_send_notification(payload: FCMNotificationPayload, add_history_cal
         "status": "sent",
         "sent": sent_count,
         "failed": failed_count,
-        "total_subscribers": len(fcm_tokens)
+        "superseded": superseded_count,
+        "total_subscribers": await fcm_token_total(),
+        "message_id": message_id
     }
@@ -0,0 +1,149 @@
+"""Secondary indexes over the history list - lookups by type, device and time range
+
+Every event gets a sequence number on append, stored in the event as `seq` (so it
+survives restarts and serves as the WebSocket resume cursor); the event with
+sequence `seq` is `history[seq - base]`, where `base` is the sequence of the oldest
+retained event.
+Per-type and per-device indexes are ascending lists of sequence numbers, so a
+filtered query walks only the smallest matching index instead of the whole history.
+Time ranges use binary search over the event timestamps (appends are in time order).
+"""
+from bisect import bisect_left, bisect_right
+
+# Events store the first 16 chars of the device fingerprint in details
+FINGERPRINT_PREFIX_LENGTH = 16
+
+
+def event_fingerprint(event):
+    """Device fingerprint prefix an event refers to, if any"""
+    details = event.get("details") or {}
+    fingerprint = details.get("device") or details.get("fingerprint")
+    if not isinstance(fingerprint, str) or fingerprint == "Unknown":
+        return None
+    return fingerprint[:FINGERPRINT_PREFIX_LENGTH]
+
+
+class HistoryIndex:
+    """Indexes for a capped, append-only history list (caller holds the history lock)"""
+
+    def __init__(self):
+        self.base = 0
+        self.next_seq = 0
+        self.by_type = {}
+        self.by_fingerprint = {}
+        # Evicted entries still at the head of each index list (trimmed lazily)
+        self._stale_types = {}
+        self._stale_fingerprints = {}
+
+    def rebuild(self, events, next_seq=0):
+        """Index a freshly loaded history, continuing the sequence numbers it was saved with
+
+        next_seq: where an empty history continues (the sequence saved when it was cleared)
+        """
+        self.next_seq = events[0].get("seq", next_seq) if events else next_seq
+        self.clear()
+        for event in events:
+            self.add(event)
+
+    def clear(self):
+        self.base = self.next_seq
+        self.by_type = {}
+        self.by_fingerprint = {}
+        self._stale_types = {}
+        self._stale_fingerprints = {}
+
+    def add(self, event):
+        """Index an event just appended to the history (and stamp its sequence number)"""
+        seq = self.next_seq
+        self.next_seq += 1
+        event["seq"] = seq
+        self.by_type.setdefault(event.get("type"), []).append(seq)
+        fingerprint = event_fingerprint(event)
+        if fingerprint:
+            self.by_fingerprint.setdefault(fingerprint, []).append(seq)
+
+    def evict(self, event):
+        """Forget the oldest event, just removed from the head of the history"""
+        self.base += 1
+        _evict_from(self.by_type, self._stale_types, event.get("type"))
+        fingerprint = event_fingerprint(event)
+        if fingerprint:
+            _evict_from(self.by_fingerprint, self._stale_fingerprints, fingerprint)
+
+    def _live(self, seqs):
+        """Index entries still in the history"""
+        return seqs[bisect_left(seqs, self.base):] if seqs and seqs[0] < self.base else seqs
+
+    def seq_window(self, history, since=None, until=None):
+        """Sequence numbers [low, high) of the events within a time range"""
+        low = self.base
+        high = self.next_seq
+        if since is not None:
+            low = self.base + bisect_left(history, since, key=_timestamp)
+        if until is not None:
+            high = self.base + bisect_right(history, until, key=_timestamp)
+        return low, high
+
+    def read(self, history, start_seq, count):
+        """Up to count events from start_seq on, oldest first; returns (events, next_seq)
+
+        Stable across appends and evictions, so long reads can release the lock between chunks.
+        """
+        start_seq = max(start_seq, self.base)
+        events = history[start_seq - self.base:start_seq - self.base + count]
+        return events, start_seq + len(events)
+
+    def query(self, history, types=None, fingerprint=None, since=None, until=None, offset=0, limit=20):
+        """Matching events newest first, paginated; returns (events, total)"""
+        low, high = self.seq_window(history, since, until)
+
+        # Walk the smallest candidate index, check the remaining filters per event
+        candidates = []
+        if types:
+            seqs = []
+            for event_type in types:
+                seqs.extend(self._live(self.by_type.get(event_type, [])))
+            candidates.append(sorted(seqs) if len(types) > 1 else seqs)
+        if fingerprint:
+            candidates.append(self._live(self.by_fingerprint.get(fingerprint[:FINGERPRINT_PREFIX_LENGTH], [])))
+
+        if not candidates:
+            total = max(0, high - low)
+            if offset >= total:
+                return [], total
+            start = max(low, high - offset - limit)
+            page = history[start - self.base:high - offset - self.base]
+            return page[::-1], total
+
+        seqs = min(candidates, key=len)
+        seqs = seqs[bisect_left(seqs, low):bisect_left(seqs, high)]
+        fingerprint = fingerprint[:FINGERPRINT_PREFIX_LENGTH] if fingerprint else None
+        type_set = set(types) if types else None
+
+        matches = []
+        for seq in reversed(seqs):
+            event = history[seq - self.base]
+            if type_set is not None and event.get("type") not in type_set:
+                continue
+            if fingerprint is not None and event_fingerprint(event) != fingerprint:
+                continue
+            matches.append(event)
+        return matches[offset:offset + limit], len(matches)
+
+
+def _evict_from(index, stale_counts, key):
+    """Drop the head entry of index[key]; amortized O(1), the head is trimmed once half is stale"""
+    seqs = index.get(key)
+    if seqs is None:
+        return
+    stale = stale_counts.pop(key, 0) + 1
+    if stale == len(seqs):
+        del index[key]
+    elif stale * 2 >= len(seqs):
+        del seqs[:stale]
+    else:
+        stale_counts[key] = stale
+
+
+def _timestamp(event):
+    return event.get("timestamp", 0)
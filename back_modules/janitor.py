@@ -0,0 +1,63 @@
+"""Subscription janitor - retires subscriptions from devices that stopped heartbeating"""
+import os
+import time
+from datetime import datetime
+
+from . import webpush_handler, fcm_handler, shared_state
+
+# Devices whose last heartbeat is older than this are considered dead
+INACTIVE_DEVICE_HOURS = float(os.getenv("INACTIVE_DEVICE_HOURS", "72"))
+
+# How often the janitor checks the activity log (in minutes)
+JANITOR_INTERVAL_MINUTES = 30
+
+
+def find_stale_fingerprints(activity_log, max_age_seconds, now=None):
+    """Return fingerprints whose last heartbeat is older than max_age_seconds"""
+    now = now or time.time()
+    return {
+        fingerprint for fingerprint, activity in activity_log.items()
+        if now - activity.get("last_activity", now) > max_age_seconds
+    }
+
+
+def prune_inactive_subscriptions(activity_log):
+    """Remove WebPush and FCM subscriptions of stale devices, returns (webpush_removed, fcm_removed)"""
+    # Devices that never sent a heartbeat are kept: not every browser supports
+    # Periodic Background Sync, so missing liveness data is not proof of death
+    stale = find_stale_fingerprints(activity_log, INACTIVE_DEVICE_HOURS * 3600)
+    if not stale:
+        return 0, 0
+
+    webpush_removed = webpush_handler.prune_subscriptions(fingerprints=stale)
+    fcm_removed = fcm_handler.prune_fcm_tokens(fingerprints=stale)
+    return webpush_removed, fcm_removed
+
+
+def run_janitor(load_activity_callback, add_history_callback=None, broadcast_callback=None):
+    """Periodically prune subscriptions of inactive devices - meant to run in a daemon thread"""
+    while True:
+        # Stops when the server starts draining
+        if shared_state.shutdown_event.wait(JANITOR_INTERVAL_MINUTES * 60):
+            return
+
+        try:
+            webpush_removed, fcm_removed = prune_inactive_subscriptions(load_activity_callback())
+
+            if webpush_removed or fcm_removed:
+                current_time = datetime.now().strftime('%H:%M:%S')
+                print(f"🧹 Janitor removed {webpush_removed} WebPush and {fcm_removed} FCM subscription(s) at {current_time}")
+
+                if add_history_callback and broadcast_callback:
+                    add_history_callback(
+                        "subscription",
+                        f"🧹 Suscripciones inactivas eliminadas: {webpush_removed + fcm_removed}",
+                        {
+                            "webpush_removed": webpush_removed,
+                            "fcm_removed": fcm_removed,
+                            "inactive_hours": INACTIVE_DEVICE_HOURS
+                        }
+                    )
+                    shared_state.run_on_main_loop(broadcast_callback())
+        except Exception as e:
+            print(f"❌ Error in janitor thread: {e}")
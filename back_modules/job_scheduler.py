@@ -0,0 +1,357 @@
+"""Scheduled notifications - durable one-shot and recurring jobs fired from a timer heap
+
+Jobs are plain dicts in a journaled JSON store keyed by job id, so every create,
+reschedule and cancel is one appended journal line. Pending fire times live in a
+min-heap of (due, seq, job_id): insert is O(log n), cancel is O(1) by forgetting
+the job (stale heap entries are skipped when they surface and the heap is rebuilt
+once they make up half of it). A single runner thread sleeps until the earliest
+due time and hands due jobs to a small worker pool that sends them.
+"""
+import copy
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from pathlib import Path
+from typing import List, Optional
+
+from fastapi import HTTPException
+from pydantic import BaseModel, Field
+
+from . import shared_state, startup, storage
+
+# Data file
+SCHEDULED_JOBS_FILE = Path("data/scheduled_jobs.json")
+
+# Shortest allowed repeat interval for recurring jobs
+MIN_INTERVAL_SECONDS = 60
+
+# Furthest ahead a job can be scheduled (also the longest repeat interval)
+MAX_SCHEDULE_AHEAD_SECONDS = 366 * 24 * 60 * 60
+
+# Longest single sleep of the runner thread (it re-checks the heap after waking)
+MAX_RUNNER_SLEEP_SECONDS = 60
+
+# Pending jobs accepted before new ones are rejected
+MAX_SCHEDULED_JOBS = int(os.getenv("MAX_SCHEDULED_JOBS", "500000"))
+
+# Due jobs sent at the same time (each one is a blast to its targets)
+MAX_CONCURRENT_JOB_FIRES = 2
+
+CHANNELS = ("webpush", "fcm")
+
+
+class ScheduledNotification(BaseModel):
+    title: str
+    body: str
+    icon: str = "/static/icon-192.png"
+    channels: List[str] = list(CHANNELS)
+    # Only these devices (all subscribers when omitted)
+    device_fingerprints: Optional[List[str]] = None
+    # When to fire: absolute unix time or a delay from now (one of them)
+    run_at: Optional[float] = Field(None, ge=0, allow_inf_nan=False)
+    delay_seconds: Optional[float] = Field(None, ge=0, le=MAX_SCHEDULE_AHEAD_SECONDS, allow_inf_nan=False)
+    # Repeat every N seconds after the first run (one-shot when omitted)
+    interval_seconds: Optional[float] = Field(
+        None, ge=MIN_INTERVAL_SECONDS, le=MAX_SCHEDULE_AHEAD_SECONDS, allow_inf_nan=False
+    )
+    collapse_key: Optional[str] = None
+
+
+class TimerHeap:
+    """Min-heap of due times with lazy cancellation"""
+
+    def __init__(self):
+        self._heap = []
+        # job_id -> (due, seq) of its only valid heap entry
+        self._live = {}
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._live)
+
+    def push(self, job_id, due):
+        """Schedule (or reschedule) job_id - O(log n)"""
+        entry = (due, next(self._seq), job_id)
+        self._live[job_id] = entry[:2]
+        heapq.heappush(self._heap, entry)
+        self._maybe_compact()
+
+    def cancel(self, job_id):
+        """Forget job_id - O(1), its heap entry is dropped when it surfaces"""
+        self._live.pop(job_id, None)
+        self._maybe_compact()
+
+    def _valid(self, entry):
+        return self._live.get(entry[2]) == entry[:2]
+
+    def _maybe_compact(self):
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._live):
+            self._heap = [entry for entry in self._heap if self._valid(entry)]
+            heapq.heapify(self._heap)
+
+    def next_due(self):
+        """Earliest due time, None when empty"""
+        while self._heap and not self._valid(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return the ids of every job due at `now`"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._valid(entry):
+                del self._live[entry[2]]
+                due.append(entry[2])
+        return due
+
+    def upcoming(self, limit):
+        """The `limit` earliest (due, job_id) without popping - O(k log k) heap walk"""
+        result = []
+        frontier = [(self._heap[0], 0)] if self._heap else []
+        while frontier and len(result) < limit:
+            entry, index = heapq.heappop(frontier)
+            if self._valid(entry):
+                result.append((entry[0], entry[2]))
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(self._heap):
+                    heapq.heappush(frontier, (self._heap[child], child))
+        return result
+
+
+class JobScheduler:
+    """Scheduled notification jobs: durable store + timer heap + runner thread"""
+
+    def __init__(self, path=SCHEDULED_JOBS_FILE):
+        self.store = storage.JournaledStore(
+            path, storage.apply_dict_op, empty=dict, name="scheduled jobs", compact_every=5000,
+            encode=lambda state: json.dumps(state, separators=(",", ":")).encode("utf-8")
+        )
+        self.jobs = {}
+        self.timers = TimerHeap()
+        self.changed = threading.Condition()
+        self.executor = ThreadPoolExecutor(MAX_CONCURRENT_JOB_FIRES, thread_name_prefix="scheduled-job")
+        self.stopping = False
+        # Submitted fires -> the job as it was before _advance (restored if never started)
+        self.inflight = {}
+        # Ids cancelled while a fire was in flight: never restored
+        self.cancelled = set()
+
+    def load(self):
+        with self.changed:
+            self.jobs = self.store.load()
+            # Jobs stored before run_at was bounded could never fire (and broke the listings)
+            latest = time.time() + MAX_SCHEDULE_AHEAD_SECONDS
+            unreachable = [job_id for job_id, job in self.jobs.items() if not job["next_run_at"] <= latest]
+            if unreachable:
+                for job_id in unreachable:
+                    del self.jobs[job_id]
+                self.store.append({"op": "delete", "keys": unreachable}, self.jobs)
+                print(f"⚠️ Dropped {len(unreachable)} scheduled job(s) due more than a year ahead")
+            self.timers = TimerHeap()
+            for job in self.jobs.values():
+                self.timers.push(job["id"], job["next_run_at"])
+        return len(self.jobs)
+
+    def snapshot(self):
+        with self.changed:
+            self.store.snapshot(self.jobs)
+
+    def add(self, request: ScheduledNotification):
+        """Validate and store a new job, returns it"""
+        if (request.run_at is None) == (request.delay_seconds is None):
+            raise HTTPException(status_code=400, detail="Give exactly one of run_at or delay_seconds")
+        unknown = set(request.channels) - set(CHANNELS)
+        if unknown or not request.channels:
+            raise HTTPException(status_code=400, detail=f"channels must be a subset of {list(CHANNELS)}")
+
+        now = time.time()
+        if request.run_at is not None and request.run_at > now + MAX_SCHEDULE_AHEAD_SECONDS:
+            raise HTTPException(status_code=400, detail="run_at can be at most a year ahead")
+        job = {
+            "id": uuid.uuid4().hex[:16],
+            "title": request.title,
+            "body": request.body,
+            "icon": request.icon,
+            "channels": sorted(set(request.channels)),
+            "device_fingerprints": request.device_fingerprints,
+            "collapse_key": request.collapse_key,
+            "interval_seconds": request.interval_seconds,
+            "next_run_at": request.run_at if request.run_at is not None else now + request.delay_seconds,
+            "created_at": now,
+            "runs": 0,
+            "last_run_at": None,
+        }
+        with self.changed:
+            if len(self.jobs) >= MAX_SCHEDULED_JOBS:
+                raise HTTPException(status_code=503, detail="Too many scheduled jobs")
+            self.jobs[job["id"]] = job
+            self.store.append({"op": "set", "key": job["id"], "value": job}, self.jobs)
+            self.timers.push(job["id"], job["next_run_at"])
+            self.changed.notify()
+        return job
+
+    def cancel(self, job_id):
+        """Cancel a job, including a fire of it that is queued or running (True if it existed)"""
+        with self.changed:
+            fires = [future for future, job in self.inflight.items() if job["id"] == job_id]
+            if self.jobs.pop(job_id, None) is not None:
+                self.store.append({"op": "delete", "keys": [job_id]}, self.jobs)
+                self.timers.cancel(job_id)
+                self.changed.notify()
+            elif not fires:
+                return False
+            # A queued fire is dropped; a running one may still send but is not restored
+            if fires:
+                self.cancelled.add(job_id)
+            for future in fires:
+                future.cancel()
+        return True
+
+    def get(self, job_id):
+        with self.changed:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def upcoming(self, limit=10):
+        with self.changed:
+            return [dict(self.jobs[job_id]) for _, job_id in self.timers.upcoming(limit)]
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def run(self, add_history_callback=None, broadcast_callback=None, admission=None):
+        """Fire due jobs until stop() - meant to run in a daemon thread
+
+        With admission (a BlastAdmission) fires share the manual blasts' concurrency cap and queue.
+        """
+        while True:
+            with self.changed:
+                if self.stopping:
+                    return
+                next_due = self.timers.next_due()
+                wait = MAX_RUNNER_SLEEP_SECONDS if next_due is None else next_due - time.time()
+                if wait > 0:
+                    # Woken early when a job is added or cancelled
+                    self.changed.wait(timeout=min(wait, MAX_RUNNER_SLEEP_SECONDS))
+                    continue
+                due = [self.jobs[job_id] for job_id in self.timers.pop_due(time.time())]
+                fires = []
+                for job in due:
+                    before = copy.deepcopy(job)
+                    self._advance(job)
+                    fires.append((before, dict(job)))
+
+                for before, job in fires:
+                    future = self.executor.submit(
+                        self._fire, job, before, add_history_callback, broadcast_callback, admission
+                    )
+                    self.inflight[future] = before
+                    future.add_done_callback(self._fire_done)
+
+    def _fire_done(self, future):
+        with self.changed:
+            job = self.inflight.pop(future, None)
+            if job and all(other["id"] != job["id"] for other in self.inflight.values()):
+                self.cancelled.discard(job["id"])
+
+    def stop(self, timeout):
+        """Stop firing; fires not started yet are restored to the store, running ones get `timeout` seconds"""
+        with self.changed:
+            self.stopping = True
+            self.changed.notify_all()
+            restored = 0
+            for future, job in list(self.inflight.items()):
+                if future.cancel() and self._restore(job):
+                    restored += 1
+            running = [future for future in self.inflight if not future.cancelled()]
+        if restored:
+            print(f"⏸️ {restored} scheduled job(s) not started, kept for the next start")
+        wait_futures(running, timeout=timeout)
+        self.executor.shutdown(wait=False)
+
+    def _restore(self, job):
+        """Put back a job as it was before a fire that never sent, unless it was cancelled meanwhile
+
+        Returns True if restored (caller holds the lock).
+        """
+        if job["id"] in self.cancelled:
+            return False
+        self.jobs[job["id"]] = job
+        self.store.append({"op": "set", "key": job["id"], "value": job}, self.jobs)
+        self.timers.push(job["id"], job["next_run_at"])
+        return True
+
+    def _advance(self, job):
+        """Reschedule a recurring job after a run, or remove a one-shot job (caller holds the lock)"""
+        now = time.time()
+        job["runs"] += 1
+        job["last_run_at"] = now
+        if job["interval_seconds"]:
+            # Runs missed while the server was down are skipped, not replayed
+            next_run = job["next_run_at"] + job["interval_seconds"]
+            if next_run <= now:
+                missed = (now - next_run) // job["interval_seconds"] + 1
+                next_run += missed * job["interval_seconds"]
+            job["next_run_at"] = next_run
+            self.store.append({"op": "set", "key": job["id"], "value": job}, self.jobs)
+            self.timers.push(job["id"], next_run)
+        else:
+            del self.jobs[job["id"]]
+            self.store.append({"op": "delete", "keys": [job["id"]]}, self.jobs)
+
+    def _fire(self, job, before, add_history_callback, broadcast_callback, admission=None):
+        """Send one job on each of its enabled channels"""
+        from . import webpush_handler, fcm_handler
+
+        print(f"⏰ Firing scheduled job {job['id']}: {job['title']}")
+        sent_any = False
+        for channel in job["channels"]:
+            if not startup.channel_enabled(channel):
+                continue
+            fields = {key: job[key] for key in ("title", "body", "icon", "collapse_key", "device_fingerprints")}
+            if channel == "webpush":
+                payload = webpush_handler.NotificationPayload(**fields)
+                send = lambda: webpush_handler.send_notification(payload, add_history_callback, broadcast_callback)
+            else:
+                payload = fcm_handler.FCMNotificationPayload(**fields)
+                send = lambda: fcm_handler.fcm_send_notification(payload, add_history_callback, broadcast_callback)
+            try:
+                if admission is None:
+                    # The send handlers broadcast on the server loop; the fan-out itself runs in a thread
+                    shared_state.run_on_main_loop(send(), timeout=None)
+                else:
+                    # The key (job id + run) dedupes a fire that is retried after a 429
+                    self._send_admitted(admission, f"scheduled-{channel}", fields, send, f"{job['id']}:{job['runs']}")
+                sent_any = True
+            except HTTPException as e:
+                if e.status_code == 503 and not sent_any:
+                    # Refused because the server is draining: fire again after the restart
+                    with self.changed:
+                        restored = self._restore(before)
+                    if restored:
+                        print(f"⏸️ Scheduled job {job['id']} not sent (server restarting), kept for the next start")
+                    return
+                print(f"❌ Scheduled job {job['id']} ({channel}): {e.detail}")
+            except Exception as e:
+                print(f"❌ Error firing scheduled job {job['id']} ({channel}): {e}")
+
+    @staticmethod
+    def _send_admitted(admission, scope, payload, send, idempotency_key):
+        """Run send() through blast admission, waiting out 429s (Retry-After) until shutdown"""
+        while True:
+            try:
+                return shared_state.run_on_main_loop(
+                    admission.run(scope, payload, send, idempotency_key), timeout=None
+                )
+            except HTTPException as e:
+                if e.status_code != 429:
+                    raise
+                retry_after = int((e.headers or {}).get("Retry-After", 1))
+                if shared_state.shutdown_event.wait(retry_after):
+                    raise HTTPException(status_code=503, detail="Server is restarting")
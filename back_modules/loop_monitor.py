@@ -0,0 +1,173 @@
+"""Event-loop diagnostics - lag monitor, slow-callback stack samples and a sampling profiler
+
+Opt-in with DIAGNOSTICS_MODE=1. A tick task on the event loop records how late
+each wake-up is (loop lag). A watchdog thread notices when the loop hasn't ticked
+for SLOW_CALLBACK_MS and captures the loop thread's stack while it is still
+blocked, so the log shows the call responsible. `profile(seconds)` samples every
+thread's stack and returns collapsed stacks ("frame;frame;frame count" lines),
+the input format of flamegraph.pl / speedscope.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from pathlib import Path
+
+DIAGNOSTICS_MODE = os.getenv("DIAGNOSTICS_MODE", "0") == "1"
+
+# A loop stall longer than this is reported with the blocking stack
+SLOW_CALLBACK_SECONDS = float(os.getenv("SLOW_CALLBACK_MS", "100")) / 1000
+
+# How often the tick task wakes up
+TICK_INTERVAL_SECONDS = 0.05
+
+# Lag samples kept (one per tick; ~1 minute at the default interval)
+MAX_LAG_SAMPLES = 1200
+
+# Slow-call reports kept for /api/health
+MAX_SLOW_CALLS = 20
+
+# Profile limits
+PROFILE_MAX_SECONDS = 60
+PROFILE_INTERVAL_SECONDS = 0.005
+
+_PROJECT_ROOT = str(Path(__file__).resolve().parent.parent)
+
+
+class LoopMonitor:
+    def __init__(self, threshold=SLOW_CALLBACK_SECONDS, interval=TICK_INTERVAL_SECONDS):
+        self.threshold = threshold
+        self.interval = interval
+        self.running = False
+        self.loop_thread_id = None
+        self.last_tick = None
+        self.lag_samples = deque(maxlen=MAX_LAG_SAMPLES)
+        self.max_lag = 0.0
+        self.slow_calls = deque(maxlen=MAX_SLOW_CALLS)
+        self.slow_call_count = 0
+        self._stall = None  # report of the stall in progress (watchdog thread only)
+
+    def start(self):
+        """Start the tick task and watchdog thread (call from the event loop)"""
+        if self.running:
+            return
+        self.running = True
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        asyncio.get_running_loop().create_task(self._tick())
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+        print(f"🩺 Event-loop monitor on (slow call threshold {self.threshold * 1000:.0f} ms)")
+
+    def stop(self):
+        self.running = False
+
+    async def _tick(self):
+        while self.running:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.last_tick = now
+            self.lag_samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def _watchdog(self):
+        while self.running:
+            time.sleep(min(self.interval, self.threshold / 2))
+            blocked_for = time.monotonic() - self.last_tick
+            if blocked_for >= self.threshold:
+                if self._stall is None:
+                    self._stall = self._capture_stall(blocked_for)
+                else:
+                    self._stall["blocked_ms"] = round(blocked_for * 1000)
+            elif self._stall is not None:
+                print(f"🐢 Event loop was blocked {self._stall['blocked_ms']} ms in {self._stall['where']}")
+                self._stall = None
+
+    def _capture_stall(self, blocked_for):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = traceback.format_stack(frame) if frame else []
+        report = {
+            "at": time.time(),
+            "blocked_ms": round(blocked_for * 1000),
+            "where": _innermost_project_frame(frame),
+            "stack": "".join(stack[-15:]),
+        }
+        self.slow_calls.append(report)
+        self.slow_call_count += 1
+        print(f"🐢 Event loop blocked > {self.threshold * 1000:.0f} ms, stack:\n{report['stack']}")
+        return report
+
+    def stats(self):
+        samples = sorted(self.lag_samples)
+        return {
+            "enabled": self.running,
+            "threshold_ms": round(self.threshold * 1000),
+            "lag_ms": {
+                "current": round(self.lag_samples[-1] * 1000, 1) if samples else None,
+                "p50": _percentile_ms(samples, 0.5),
+                "p99": _percentile_ms(samples, 0.99),
+                "max": round(self.max_lag * 1000, 1),
+            },
+            "slow_calls": self.slow_call_count,
+            "recent_slow_calls": [
+                {key: call[key] for key in ("at", "blocked_ms", "where")}
+                for call in list(self.slow_calls)[-5:]
+            ],
+        }
+
+
+def _percentile_ms(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return round(sorted_values[index] * 1000, 1)
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    filename = code.co_filename
+    if filename.startswith(_PROJECT_ROOT):
+        filename = filename[len(_PROJECT_ROOT) + 1:]
+    else:
+        filename = os.path.basename(filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+def _innermost_project_frame(frame):
+    """Label of the deepest frame from this repo (what our code was calling)"""
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(_PROJECT_ROOT) and "site-packages" not in frame.f_code.co_filename:
+            return f"{_frame_label(frame)} line {frame.f_lineno}"
+        frame = frame.f_back
+    return "unknown"
+
+
+def _collapsed_stack(frame, thread_name):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ";".join(reversed(labels))
+
+
+def profile(seconds, interval=PROFILE_INTERVAL_SECONDS):
+    """Sample all thread stacks for `seconds`, return collapsed-stack text (blocking)"""
+    seconds = max(0.1, min(float(seconds), PROFILE_MAX_SECONDS))
+    own_id = threading.get_ident()
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_id:
+                counts[_collapsed_stack(frame, names.get(thread_id, str(thread_id)).replace(";", ":"))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+monitor = LoopMonitor()
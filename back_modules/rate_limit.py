@@ -0,0 +1,274 @@
+"""Rate limiting for unauthenticated endpoints - per-IP and per-fingerprint token buckets
+
+Implemented as plain ASGI middleware: only the limited routes are inspected, and
+their (small) JSON bodies are buffered once to read the device fingerprint and then
+replayed to the app. Buckets live in an LRU-ordered dict of small tuples; a bucket idle long enough to be full again is identical to a new one, so
+idle buckets are dropped instead of being kept forever.
+Live buckets are never pushed out to make room: fingerprint buckets are keyed
+under the client IP and capped per IP, and when the table is full new keys are
+refused until buckets expire. Rotating fingerprints (or forwarded addresses)
+therefore can't reset other clients' limits.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") != "0"
+
+# Buckets tracked at once (new keys are refused beyond this until buckets expire)
+MAX_TRACKED_BUCKETS = 100_000
+
+# Live fingerprint buckets per client IP and route group (devices behind one NAT share it)
+MAX_FINGERPRINTS_PER_IP = int(os.getenv("RATE_LIMIT_MAX_FINGERPRINTS_PER_IP", "64"))
+
+# A full table is swept for expired buckets at most this often
+FULL_SWEEP_INTERVAL_SECONDS = 1.0
+
+# Bodies larger than this are not parsed for a fingerprint (IP limit still applies)
+MAX_INSPECTED_BODY = 16 * 1024
+
+# route group -> ((per-fingerprint rate/s, burst), (per-IP rate/s, burst))
+# Per-IP limits are looser: many devices can share one NAT address
+RATE_LIMIT_RULES = {
+    "heartbeat": ((0.2, 5), (5.0, 60)),
+    "test": ((1.0, 5), (2.0, 20)),
+    "subscribe": ((0.1, 5), (1.0, 20)),
+    "receipts": ((1.0, 20), (10.0, 200)),
+}
+
+RATE_LIMITED_ROUTES = {
+    "/api/heartbeat": "heartbeat",
+    "/api/test": "test",
+    "/api/subscribe": "subscribe",
+    "/api/unsubscribe": "subscribe",
+    "/api/fcm/subscribe": "subscribe",
+    "/api/fcm/unsubscribe": "subscribe",
+    "/api/receipts": "receipts",
+}
+
+# Peers allowed to report the client address in X-Forwarded-For (e.g. a local ngrok agent)
+TRUSTED_PROXIES = {"127.0.0.1", "::1"}
+
+
+class ExpiringBuckets:
+    """Token buckets keyed by string, dropped once idle long enough to be full again
+
+    A bucket may belong to an owner (the client IP of fingerprint buckets); an owner
+    holds at most max_per_owner live buckets.
+    """
+
+    def __init__(self, max_buckets=MAX_TRACKED_BUCKETS, max_per_owner=MAX_FINGERPRINTS_PER_IP):
+        self.max_buckets = max_buckets
+        self.max_per_owner = max_per_owner
+        # key -> (tokens, updated_at, expires_at, owner)
+        self._buckets = OrderedDict()
+        # owner -> live buckets
+        self._owned = {}
+        self._last_sweep = None
+        self.refused = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, rate, burst, now=None, owner=None):
+        """Take one token from key's bucket, returns seconds to wait (0 means allowed)
+
+        A new key is refused (and waits as long as a bucket takes to refill) when the
+        table or its owner's share of it is full.
+        """
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+
+        entry = self._buckets.pop(key, None)
+        if entry is None:
+            if not self._has_room(owner, now):
+                self.refused += 1
+                return burst / rate
+            tokens = burst
+            if owner is not None:
+                self._owned[owner] = self._owned.get(owner, 0) + 1
+        else:
+            tokens = min(burst, entry[0] + (now - entry[1]) * rate)
+            owner = entry[3]
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        # Re-inserted at the end: the dict stays ordered by last use
+        self._buckets[key] = (tokens, now, now + (burst - tokens) / rate, owner)
+        return wait
+
+    def _has_room(self, owner, now):
+        if owner is not None and self._owned.get(owner, 0) >= self.max_per_owner:
+            return False
+        if len(self._buckets) < self.max_buckets:
+            return True
+        # Expired buckets can sit behind a live one in LRU order: sweep them all (rate limited)
+        if self._last_sweep is None or now - self._last_sweep >= FULL_SWEEP_INTERVAL_SECONDS:
+            self._last_sweep = now
+            for key in [key for key, entry in self._buckets.items() if entry[2] <= now]:
+                self._drop(key)
+        return len(self._buckets) < self.max_buckets
+
+    def _expire(self, now):
+        # Least recently used first; stops at the first bucket still refilling
+        while self._buckets:
+            key, entry = next(iter(self._buckets.items()))
+            if entry[2] > now:
+                break
+            self._drop(key)
+
+    def _drop(self, key):
+        owner = self._buckets.pop(key)[3]
+        if owner is not None:
+            remaining = self._owned[owner] - 1
+            if remaining:
+                self._owned[owner] = remaining
+            else:
+                del self._owned[owner]
+
+
+def client_ip(scope, headers):
+    """Client address, taken from X-Forwarded-For only when the peer is a trusted local proxy"""
+    peer = scope.get("client")[0] if scope.get("client") else "unknown"
+    forwarded = headers.get(b"x-forwarded-for")
+    if forwarded and peer in TRUSTED_PROXIES:
+        # The proxy appends the address it saw; earlier entries are client-controlled
+        return forwarded.decode("latin-1").split(",")[-1].strip() or peer
+    return peer
+
+
+def body_fingerprint(body):
+    """Device fingerprint sent in a JSON body (`fingerprint` or `device_fingerprint`)"""
+    if not body or len(body) > MAX_INSPECTED_BODY:
+        return None
+    try:
+        data = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    fingerprint = data.get("device_fingerprint") or data.get("fingerprint")
+    return fingerprint if isinstance(fingerprint, str) and fingerprint else None
+
+
+class RateLimiter:
+    """Limit rules, buckets and counters (shared by the middleware and the stats endpoint)"""
+
+    def __init__(self, rules=None, routes=None, enabled=RATE_LIMIT_ENABLED):
+        self.rules = rules or RATE_LIMIT_RULES
+        self.routes = routes or RATE_LIMITED_ROUTES
+        self.enabled = enabled
+        self.buckets = ExpiringBuckets()
+        self.counters = {"allowed": 0, "limited_ip": 0, "limited_fingerprint": 0}
+        self.limited_by_route = {}
+
+    def group_for(self, scope):
+        """Rule group for a request, None when it isn't limited"""
+        if not self.enabled or scope["type"] != "http" or scope.get("method") != "POST":
+            return None
+        return self.routes.get(scope.get("path"))
+
+    def check_ip(self, group, ip):
+        return self.buckets.take(f"ip:{group}:{ip}", *self.rules[group][1])
+
+    def check_fingerprint(self, group, fingerprint, ip):
+        # Keyed under the client IP, which caps the distinct fingerprints one address can use
+        return self.buckets.take(f"fp:{group}:{ip}:{fingerprint}", *self.rules[group][0], owner=f"{group}:{ip}")
+
+    def record(self, path, counter):
+        self.counters[counter] += 1
+        if counter != "allowed":
+            self.limited_by_route[path] = self.limited_by_route.get(path, 0) + 1
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            **self.counters,
+            "limited_by_route": dict(self.limited_by_route),
+            "tracked_buckets": len(self.buckets),
+            "refused_new_buckets": self.buckets.refused,
+        }
+
+
+class RateLimitMiddleware:
+    """ASGI middleware answering 429 + Retry-After when a client exceeds its bucket"""
+
+    def __init__(self, app, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        group = self.limiter.group_for(scope)
+        if group is None:
+            await self.app(scope, receive, send)
+            return
+
+        # Per-IP first: it doesn't need the body
+        ip = client_ip(scope, dict(scope.get("headers") or []))
+        wait = self.limiter.check_ip(group, ip)
+        if wait:
+            await self._reject(scope, send, group, "limited_ip", wait)
+            return
+
+        body, more_body = await _read_body(receive)
+        if body is None:
+            return  # Client went away before sending the body
+        fingerprint = body_fingerprint(body)
+        if fingerprint:
+            wait = self.limiter.check_fingerprint(group, fingerprint, ip)
+            if wait:
+                await self._reject(scope, send, group, "limited_fingerprint", wait)
+                return
+
+        self.limiter.record(scope["path"], "allowed")
+        await self.app(scope, _replay(body, more_body, receive), send)
+
+    async def _reject(self, scope, send, group, counter, wait):
+        self.limiter.record(scope["path"], counter)
+        body = json.dumps({"detail": f"Too many requests ({group})"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"retry-after", str(max(1, int(wait + 0.999))).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive):
+    """Buffer the request body up to MAX_INSPECTED_BODY; returns (body, more_body)
+
+    body is None when the client disconnected first.
+    """
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            return None, False
+        chunk = message.get("body", b"")
+        chunks.append(chunk)
+        size += len(chunk)
+        more_body = message.get("more_body", False)
+        if not more_body or size > MAX_INSPECTED_BODY:
+            return b"".join(chunks), more_body
+
+
+def _replay(body, more_body, receive):
+    """receive() that first returns the buffered body, then defers to the real channel"""
+    replayed = False
+
+    async def replay_receive():
+        nonlocal replayed
+        if not replayed:
+            replayed = True
+            return {"type": "http.request", "body": body, "more_body": more_body}
+        return await receive()
+
+    return replay_receive
@@ -0,0 +1,237 @@
+"""Delivery receipts - per-message delivery and engagement tracking
+
+Every blast gets a message_id that travels in the push payload. The service
+worker reports `received` (push event) and `clicked` (notificationclick)
+receipts in batches to /api/receipts. Ingestion only appends to an in-memory
+buffer; a flusher thread aggregates the buffer into per-message stats and
+writes one atomic snapshot, so no request ever touches the disk.
+
+The per-device sets that dedupe repeated receipts are kept in memory only (they
+would dwarf the stats); after a restart a device's retried receipt for a message
+sent before the restart can be counted again.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+from . import storage
+
+# Data file (aggregated stats of the most recent messages)
+RECEIPTS_FILE = Path("data/receipts.json")
+
+# Messages kept in memory / on disk (oldest are dropped)
+MAX_TRACKED_MESSAGES = 200
+
+# Latency samples kept per message and event (reservoir sampling)
+MAX_LATENCY_SAMPLES = 500
+
+# How often buffered receipts are aggregated and the snapshot written (seconds)
+FLUSH_INTERVAL_SECONDS = 5
+
+# Receipt batches buffered between flushes before new ones are dropped
+MAX_PENDING_BATCHES = 100_000
+
+# Receipts accepted in one POST (the service worker sends smaller batches)
+MAX_RECEIPTS_PER_BATCH = 100
+
+RECEIPT_EVENTS = ("received", "clicked")
+
+_pending = []
+_pending_lock = threading.Lock()
+_messages = OrderedDict()
+_messages_lock = threading.RLock()
+_dirty = False
+
+
+def new_message_id():
+    return uuid.uuid4().hex[:16]
+
+
+def _new_stats(message_id):
+    return {
+        "message_id": message_id,
+        "channel": None,
+        "title": None,
+        "sent_at": None,
+        "targeted": 0,
+        "sent": 0,
+        "failed": 0,
+        "received": 0,
+        "clicked": 0,
+        "latency_samples": {event: [] for event in RECEIPT_EVENTS},
+        "latency_seen": {event: 0 for event in RECEIPT_EVENTS},
+        # Device sets dedupe repeated receipts; not persisted
+        "devices": {event: set() for event in RECEIPT_EVENTS},
+    }
+
+
+def _get_stats(message_id):
+    """Stats entry for message_id, creating it if needed (caller holds _messages_lock)"""
+    stats = _messages.get(message_id)
+    if stats is None:
+        stats = _new_stats(message_id)
+        _messages[message_id] = stats
+        while len(_messages) > MAX_TRACKED_MESSAGES:
+            _messages.popitem(last=False)
+    return stats
+
+
+def register_message(message_id, channel, title, targeted):
+    """Start tracking a blast before it is sent"""
+    global _dirty
+    with _messages_lock:
+        stats = _get_stats(message_id)
+        stats.update({"channel": channel, "title": title, "sent_at": time.time(), "targeted": targeted})
+        _dirty = True
+
+
+def record_send_results(message_id, sent, failed):
+    """Store the push-service results of a finished blast"""
+    global _dirty
+    with _messages_lock:
+        stats = _get_stats(message_id)
+        stats["sent"] += sent
+        stats["failed"] += failed
+        _dirty = True
+
+
+def ingest(receipts):
+    """Buffer receipts (list of dicts with message_id, event, fingerprint, at) - O(1) per batch"""
+    received_at = time.time()
+    with _pending_lock:
+        if len(_pending) >= MAX_PENDING_BATCHES:
+            return False
+        _pending.append((received_at, receipts))
+    return True
+
+
+def aggregate_pending():
+    """Fold buffered receipts into per-message stats, returns how many were applied"""
+    global _pending, _dirty
+    with _pending_lock:
+        batches, _pending = _pending, []
+    if not batches:
+        return 0
+
+    applied = 0
+    with _messages_lock:
+        for received_at, receipts in batches:
+            for receipt in receipts:
+                event = receipt.get("event")
+                message_id = receipt.get("message_id")
+                if event not in RECEIPT_EVENTS or not message_id:
+                    continue
+                # Unknown ids (untracked or evicted messages) are ignored
+                stats = _messages.get(message_id)
+                if stats is None:
+                    continue
+
+                # Anonymous receipts can't be deduped, so they aren't counted
+                fingerprint = receipt.get("fingerprint")
+                devices = stats["devices"][event]
+                if not fingerprint or fingerprint in devices:
+                    continue
+                devices.add(fingerprint)
+                stats[event] += 1
+                applied += 1
+
+                # Latency from the send time, using the client clock when provided
+                if stats["sent_at"]:
+                    at = receipt.get("at")
+                    event_time = at / 1000 if isinstance(at, (int, float)) and at > 0 else received_at
+                    _add_sample(stats, event, max(0.0, event_time - stats["sent_at"]))
+        _dirty = True
+    return applied
+
+
+def _add_sample(stats, event, latency):
+    samples = stats["latency_samples"][event]
+    stats["latency_seen"][event] += 1
+    if len(samples) < MAX_LATENCY_SAMPLES:
+        samples.append(latency)
+    else:
+        slot = random.randrange(stats["latency_seen"][event])
+        if slot < MAX_LATENCY_SAMPLES:
+            samples[slot] = latency
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return round(sorted_values[index], 3)
+
+
+def _public_stats(stats):
+    result = {key: stats[key] for key in ("message_id", "channel", "title", "sent_at", "targeted", "sent", "failed", "received", "clicked")}
+    result["delivery_rate"] = round(stats["received"] / stats["sent"], 3) if stats["sent"] else None
+    result["click_rate"] = round(stats["clicked"] / stats["received"], 3) if stats["received"] else None
+    result["latency_seconds"] = {}
+    for event in RECEIPT_EVENTS:
+        samples = sorted(stats["latency_samples"][event])
+        result["latency_seconds"][event] = {
+            "p50": _percentile(samples, 0.5),
+            "p95": _percentile(samples, 0.95),
+            "max": round(samples[-1], 3) if samples else None,
+        }
+    return result
+
+
+def get_message_stats(message_id):
+    aggregate_pending()
+    with _messages_lock:
+        stats = _messages.get(message_id)
+        return _public_stats(stats) if stats else None
+
+
+def list_message_stats(limit=20):
+    """Most recent messages first"""
+    aggregate_pending()
+    with _messages_lock:
+        recent = list(_messages.values())[-limit:]
+        return [_public_stats(stats) for stats in reversed(recent)]
+
+
+def load_receipts():
+    """Load aggregated stats saved by a previous run"""
+    if not RECEIPTS_FILE.exists():
+        return
+    try:
+        saved = json.loads(RECEIPTS_FILE.read_text(encoding="utf-8") or "[]")
+    except (json.JSONDecodeError, Exception) as e:
+        print(f"⚠️ Error loading receipts: {e}. Starting empty.")
+        return
+    with _messages_lock:
+        for item in saved:
+            stats = _new_stats(item["message_id"])
+            stats.update({key: value for key, value in item.items() if key in stats and key != "devices"})
+            _messages[stats["message_id"]] = stats
+
+
+def flush():
+    """Aggregate buffered receipts and write the stats snapshot if anything changed"""
+    global _dirty
+    aggregate_pending()
+    with _messages_lock:
+        if not _dirty:
+            return
+        saved = [
+            {key: value for key, value in stats.items() if key != "devices"}
+            for stats in _messages.values()
+        ]
+        _dirty = False
+    storage.atomic_write_text(RECEIPTS_FILE, json.dumps(saved))
+
+
+def run_flusher():
+    """Flush receipts every FLUSH_INTERVAL_SECONDS - meant to run in a daemon thread"""
+    while True:
+        time.sleep(FLUSH_INTERVAL_SECONDS)
+        try:
+            flush()
+        except Exception as e:
+            print(f"❌ Error flushing receipts: {e}")
@@ -0,0 +1,84 @@
+"""Delivery scheduling helpers - per-device jitter, quiet hours and outbound rate cap"""
+import hashlib
+import threading
+import time
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursts up to `capacity` (rate <= 0: unlimited)"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1, now=None):
+        """Take tokens if available, returns seconds to wait otherwise (0 means acquired)"""
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            self._refill(time.monotonic() if now is None else now)
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available"""
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+def jitter_offset(fingerprint, window_seconds):
+    """Deterministic delivery offset within the window for a device fingerprint"""
+    if window_seconds <= 0:
+        return 0.0
+    digest = hashlib.sha256((fingerprint or "").encode("utf-8")).digest()
+    fraction = int.from_bytes(digest[:8], "big") / 2 ** 64
+    return fraction * window_seconds
+
+
+def device_local_time(record, now=None):
+    """Current time in the device timezone (UTC when unknown or invalid)"""
+    now = now or time.time()
+    tz = timezone.utc
+    if record.get("timezone"):
+        try:
+            tz = ZoneInfo(record["timezone"])
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    return datetime.fromtimestamp(now, tz)
+
+
+def in_quiet_hours(record, now=None):
+    """True if the device is inside its quiet_start..quiet_end window (local hours, may wrap midnight)"""
+    start = record.get("quiet_start")
+    end = record.get("quiet_end")
+    if start is None or end is None or start == end:
+        return False
+
+    hour = device_local_time(record, now).hour
+    if start < end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def build_delivery_plan(records, cycle_start, window_seconds):
+    """Return [(due_time, channel, record)] sorted by due time for (channel, record) pairs"""
+    plan = [
+        (cycle_start + jitter_offset(record.get("device_fingerprint"), window_seconds), channel, record)
+        for channel, record in records
+    ]
+    plan.sort(key=lambda item: item[0])
+    return plan
@@ -0,0 +1,586 @@
+"""Sharded subscription storage - consistent-hash ring, shard worker processes and a coordinator
+
+Opt-in: SHARD_WORKERS="shard-1=host:port,shard-2=host:port" points the server at
+running shard workers, SHARD_LOCAL_WORKERS=N starts N worker processes on this
+machine. Each worker owns the WebPush subscriptions and FCM tokens whose device
+fingerprint falls on its arcs of the hash ring, keeps them in its own journaled
+stores (data/shards/<name>/) and sends its part of every blast, so fan-out
+capacity and audience size grow with the number of workers. The coordinator (the
+web server) routes each (un)subscribe to the owning shard, splits blasts across
+the shards in parallel and merges their counts.
+
+RPC is multiprocessing.connection: one pickled dict per request / response over
+TCP, authenticated with SHARD_AUTHKEY. Unpickling runs code, so anyone holding the
+key can take over a worker: there is no default key, workers refuse to start
+without one, and local workers get a random key per start. A worker on another
+node is started with
+`SHARD_AUTHKEY=<secret> python -m back_modules.sharding --name shard-3 --host 0.0.0.0 --port 9103`.
+
+Each worker also applies collapse-key superseding (back_modules/collapse.py) to
+its part of a blast: every blast to a device goes through the shard owning it.
+"""
+import argparse
+import bisect
+import hashlib
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+from fastapi import HTTPException
+
+from . import collapse, compact_store, scheduler, storage
+
+# "name=host:port" (or just "host:port") per running worker
+SHARD_WORKERS = [address.strip() for address in os.getenv("SHARD_WORKERS", "").split(",") if address.strip()]
+SHARD_LOCAL_WORKERS = int(os.getenv("SHARD_LOCAL_WORKERS", "0"))
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "9101"))
+
+# Shared secret of the worker RPC (required by SHARD_WORKERS; random per start for local workers)
+SHARD_AUTHKEY = os.getenv("SHARD_AUTHKEY", "").encode("utf-8")
+
+# Ring points per shard: more points spread fingerprints more evenly
+SHARD_VNODES = 128
+
+SHARDS_DIR = Path("data/shards")
+
+# Seconds to wait for a worker's response before giving up on it (a blast sends to the
+# whole shard, so it gets longer)
+SHARD_RPC_TIMEOUT = float(os.getenv("SHARD_RPC_TIMEOUT", "30"))
+SHARD_SEND_TIMEOUT = float(os.getenv("SHARD_SEND_TIMEOUT", "900"))
+
+# Seconds a local worker process gets to start accepting connections
+WORKER_START_TIMEOUT = 15
+
+# channel -> (shard file, record type, snapshot codec)
+CHANNEL_STORES = {
+    "webpush": ("subscriptions.bin", compact_store.WebPushRecord, compact_store.encode_webpush, compact_store.decode_webpush),
+    "fcm": ("subscriptions_fcm.bin", compact_store.FCMTokenRecord, compact_store.encode_fcm, compact_store.decode_fcm),
+}
+
+# Coordinator used by the handlers (None: subscriptions live in this process)
+coordinator = None
+
+
+class ShardError(Exception):
+    """A shard worker could not be reached or failed a request"""
+
+
+def ring_hash(value):
+    """Stable 64-bit hash (Python's hash() is salted per process)"""
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring: a key belongs to the shard owning the first point at or after its hash
+
+    Adding or removing a shard only moves the keys on the arcs its points cover
+    (about 1/N of them); every other key keeps its owner.
+    """
+
+    def __init__(self, nodes=(), vnodes=SHARD_VNODES):
+        self.vnodes = vnodes
+        self.nodes = []
+        self._hashes = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node not in self.nodes:
+            self.nodes.append(node)
+            self._rebuild()
+
+    def remove(self, node):
+        self.nodes.remove(node)
+        self._rebuild()
+
+    def _rebuild(self):
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(self.vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        if not self._hashes:
+            raise ValueError("Hash ring has no nodes")
+        index = bisect.bisect_left(self._hashes, ring_hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+# ============================================================================
+# WORKER (one per shard, in its own process)
+# ============================================================================
+
+class ShardWorker:
+    """One shard's subscriptions and tokens - copy-on-write lists like the handlers keep"""
+
+    # Methods callable over RPC
+    OPS = {"put", "put_many", "remove", "clear", "count", "records", "misplaced", "send", "snapshot", "stats"}
+
+    def __init__(self, name, data_dir=SHARDS_DIR):
+        self.name = name
+        self.lock = threading.RLock()
+        self.lists = {channel: [] for channel in CHANNEL_STORES}
+        self.stores = {
+            channel: storage.JournaledStore(
+                Path(data_dir) / name / filename,
+                storage.apply_keyed_list_op("device_fingerprint", record_type.from_dict),
+                name=f"{name} {channel}",
+                encode=encode,
+                decode=decode
+            )
+            for channel, (filename, record_type, encode, decode) in CHANNEL_STORES.items()
+        }
+
+    def load(self):
+        with self.lock:
+            for channel, store in self.stores.items():
+                self.lists[channel] = store.load()
+        return self.stats()
+
+    def put(self, channel, record):
+        """Store a record, replacing the device's previous one; returns the shard's count"""
+        return self.put_many(channel, [record])
+
+    def put_many(self, channel, records):
+        record_type = CHANNEL_STORES[channel][1]
+        with self.lock:
+            fingerprints = {record["device_fingerprint"] for record in records}
+            updated = [item for item in self.lists[channel] if item.device_fingerprint not in fingerprints]
+            updated += [record_type.from_dict(record) for record in records]
+            self.lists[channel] = updated
+            for record in records:
+                self.stores[channel].append({"op": "put", "record": record}, updated)
+            return len(updated)
+
+    def remove(self, channel, field, values):
+        """Remove records whose `field` is in values, returns how many were removed"""
+        values = set(values)
+        if not values:
+            return 0
+        with self.lock:
+            current = self.lists[channel]
+            remaining = [item for item in current if item.get(field) not in values]
+            removed = len(current) - len(remaining)
+            if removed:
+                self.lists[channel] = remaining
+                self.stores[channel].append({"op": "remove", "field": field, "values": sorted(values)}, remaining)
+            return removed
+
+    def clear(self, channel):
+        with self.lock:
+            count = len(self.lists[channel])
+            self.lists[channel] = []
+            self.stores[channel].snapshot([])
+            return count
+
+    def _targets(self, channel, fingerprints=None):
+        records = self.lists[channel]
+        if fingerprints is None:
+            return records
+        wanted = set(fingerprints)
+        return [item for item in records if item.device_fingerprint in wanted]
+
+    def count(self, channel, fingerprints=None):
+        return len(self._targets(channel, fingerprints))
+
+    def records(self, channel):
+        return self.lists[channel]
+
+    def misplaced(self, nodes, vnodes, node):
+        """Records (as dicts) that a ring of `nodes` assigns to another shard than `node`"""
+        ring = HashRing(nodes, vnodes)
+        return {
+            channel: [item.to_dict() for item in records if ring.node_for(item.device_fingerprint) != node]
+            for channel, records in self.lists.items()
+        }
+
+    def send(self, channel, message, fingerprints=None):
+        """Send this shard's part of a blast, prunes its invalid endpoints / tokens
+
+        message["quiet_hours"]: skip devices inside their quiet hours (periodic cycles).
+        """
+        targets = self._targets(channel, fingerprints)
+        quiet = 0
+        if message.get("quiet_hours"):
+            audible = [record for record in targets if not scheduler.in_quiet_hours(record)]
+            quiet = len(targets) - len(audible)
+            targets = audible
+        if not targets:
+            return {"sent": 0, "failed": 0, "superseded": 0, "quiet": quiet, "pruned": 0}
+
+        # Superseded per device by a newer blast with the same collapse key on this shard
+        with collapse.blast(message.get("collapse_key"), fingerprints) as is_superseded:
+            if channel == "webpush":
+                from . import webpush_handler
+                vapid_private_key = os.getenv("VAPID_PRIVATE_KEY")
+                if not vapid_private_key:
+                    raise RuntimeError("VAPID keys not configured")
+                sent, failed, superseded, invalid = webpush_handler.deliver_webpush(
+                    targets, message["notification"], vapid_private_key,
+                    os.getenv("VAPID_CLAIM_EMAIL", "mailto:test@example.com"), message["headers"], is_superseded
+                )
+                field = "endpoint"
+            else:
+                from . import fcm_handler
+                sent, failed, superseded, invalid = fcm_handler.deliver_fcm(
+                    targets, message["data"], message.get("collapse_key"), is_superseded
+                )
+                field = "token"
+        pruned = self.remove(channel, field, invalid)
+        print(f"🧩 Shard {self.name} {channel}: sent={sent}, failed={failed}, superseded={superseded}, pruned={pruned}")
+        return {"sent": sent, "failed": failed, "superseded": superseded, "quiet": quiet, "pruned": pruned}
+
+    def snapshot(self):
+        with self.lock:
+            for channel, store in self.stores.items():
+                store.snapshot(self.lists[channel])
+
+    def stats(self):
+        return {"pid": os.getpid(), **{channel: len(records) for channel, records in self.lists.items()}}
+
+    def handle(self, request):
+        op = request.get("op")
+        if op not in self.OPS:
+            raise ValueError(f"Unknown shard op '{op}'")
+        return getattr(self, op)(**request.get("args", {}))
+
+
+def serve(name, host="127.0.0.1", port=SHARD_BASE_PORT, authkey=None, data_dir=SHARDS_DIR):
+    """Run a shard worker until it gets a shutdown request (blocking)"""
+    authkey = authkey or SHARD_AUTHKEY
+    if not authkey:
+        # Without a key any peer could send pickles, i.e. run code in the worker
+        raise ShardError("Set SHARD_AUTHKEY (a long random secret shared with the web server) to run a shard worker")
+
+    worker = ShardWorker(name, data_dir)
+    counts = worker.load()
+    listener = Listener((host, port), authkey=authkey)
+    stopping = threading.Event()
+    print(f"🧩 Shard {name} listening on {host}:{port} ({counts['webpush']} WebPush, {counts['fcm']} FCM)")
+
+    def handle_connection(connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                if request.get("op") == "shutdown":
+                    worker.snapshot()
+                    stopping.set()
+                    connection.send({"ok": True, "result": None})
+                    # Wake up the accept() below so the process can exit
+                    Client(("127.0.0.1" if host in ("", "0.0.0.0") else host, port), authkey=authkey).close()
+                    return
+                try:
+                    response = {"ok": True, "result": worker.handle(request)}
+                except Exception as e:
+                    print(f"❌ Shard {name} {request.get('op')}: {e}")
+                    response = {"ok": False, "error": str(e)}
+                connection.send(response)
+
+    try:
+        while not stopping.is_set():
+            try:
+                connection = listener.accept()
+            except AuthenticationError:
+                print(f"⚠️ Shard {name}: rejected a connection with a wrong SHARD_AUTHKEY")
+                continue
+            threading.Thread(target=handle_connection, args=(connection,), daemon=True).start()
+    except KeyboardInterrupt:
+        worker.snapshot()
+    finally:
+        listener.close()
+    print(f"🧩 Shard {name} stopped")
+
+
+# ============================================================================
+# COORDINATOR (in the web server)
+# ============================================================================
+
+class ShardClient:
+    """RPC client for one shard worker (pooled connections, safe to share between threads)"""
+
+    def __init__(self, name, address, authkey=SHARD_AUTHKEY):
+        self.name = name
+        self.address = address
+        self.authkey = authkey
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def call(self, op, **args):
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        # A pooled connection may belong to a worker that restarted: retry once on a new one,
+        # except for sends (the worker may already have sent before the connection broke)
+        retry = connection is not None and op != "send"
+        timeout = SHARD_SEND_TIMEOUT if op == "send" else SHARD_RPC_TIMEOUT
+        while True:
+            try:
+                if connection is None:
+                    connection = Client(self.address, authkey=self.authkey)
+                connection.send({"op": op, "args": args})
+                # A hung or partitioned worker must not hold the caller's thread forever
+                if not connection.poll(timeout):
+                    connection.close()
+                    raise ShardError(f"Shard {self.name} ({self.address[0]}:{self.address[1]}) did not answer {op} within {timeout:g}s")
+                response = connection.recv()
+                break
+            except (OSError, EOFError, AuthenticationError) as e:
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                if not retry:
+                    raise ShardError(f"Shard {self.name} ({self.address[0]}:{self.address[1]}) unavailable: {e}") from e
+                retry = False
+
+        with self._lock:
+            self._idle.append(connection)
+        if not response["ok"]:
+            raise ShardError(f"Shard {self.name}: {response['error']}")
+        return response["result"]
+
+    def close(self):
+        with self._lock:
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+
+
+def parse_worker_address(entry):
+    """"name=host:port" or "host:port" -> (name, (host, port))"""
+    name, _, address = entry.rpartition("=")
+    host, _, port = address.rpartition(":")
+    return name or address, (host or "127.0.0.1", int(port))
+
+
+class ShardCoordinator:
+    """Routes subscription operations to the owning shard and splits blasts across all shards"""
+
+    def __init__(self, addresses, processes=(), authkey=SHARD_AUTHKEY):
+        # name -> ShardClient; the names are the ring nodes, so keep them stable across restarts
+        self.clients = {name: ShardClient(name, address, authkey) for name, address in addresses.items()}
+        self.ring = HashRing(self.clients)
+        self.processes = list(processes)
+        self.executor = ThreadPoolExecutor(2 * len(self.clients), thread_name_prefix="shard-rpc")
+
+    def owner(self, fingerprint):
+        return self.clients[self.ring.node_for(fingerprint)]
+
+    def _by_owner(self, fingerprints):
+        groups = {}
+        for fingerprint in fingerprints:
+            groups.setdefault(self.ring.node_for(fingerprint), []).append(fingerprint)
+        return groups
+
+    def _gather(self, calls, strict=True):
+        """Run (shard name, op, args) calls in parallel, returns {name: result}
+
+        strict: any failing shard raises a 503. Otherwise failed shards are left
+        out of the result (and logged).
+        """
+        futures = {
+            name: self.executor.submit(self.clients[name].call, op, **args)
+            for name, op, args in calls
+        }
+        results = {}
+        failed = []
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except ShardError as e:
+                print(f"❌ {e}")
+                failed.append(name)
+        if failed and strict:
+            raise HTTPException(status_code=503, detail=f"Subscription shard(s) unavailable: {', '.join(failed)}")
+        return results
+
+    def _targeted(self, op, channel, fingerprints, **args):
+        """Calls for every shard, or only the owners of `fingerprints` when given"""
+        if fingerprints is None:
+            return [(name, op, {"channel": channel, **args}) for name in self.clients]
+        return [
+            (name, op, {"channel": channel, "fingerprints": owned, **args})
+            for name, owned in self._by_owner(fingerprints).items()
+        ]
+
+    def put(self, channel, record):
+        owner = self.owner(record["device_fingerprint"])
+        return self._gather([(owner.name, "put", {"channel": channel, "record": record})])[owner.name]
+
+    def import_records(self, channel, records):
+        """Store records (objects with .to_dict()) on their owning shards, returns how many"""
+        groups = {}
+        for record in records:
+            groups.setdefault(self.ring.node_for(record.device_fingerprint), []).append(record.to_dict())
+        self._gather([(name, "put_many", {"channel": channel, "records": group}) for name, group in groups.items()])
+        return sum(len(group) for group in groups.values())
+
+    def remove(self, channel, field, values):
+        values = sorted(set(values))
+        if not values:
+            return 0
+        if field == "device_fingerprint":
+            calls = [
+                (name, "remove", {"channel": channel, "field": field, "values": owned})
+                for name, owned in self._by_owner(values).items()
+            ]
+        else:
+            calls = [(name, "remove", {"channel": channel, "field": field, "values": values}) for name in self.clients]
+        return sum(self._gather(calls).values())
+
+    def clear(self, channel):
+        return sum(self._gather([(name, "clear", {"channel": channel}) for name in self.clients]).values())
+
+    def count(self, channel, fingerprints=None):
+        return sum(self._gather(self._targeted("count", channel, fingerprints)).values())
+
+    def blast(self, channel, message, fingerprints=None):
+        """Send on every shard in parallel, returns the merged counts
+
+        Shards that fail are reported in `unavailable` instead of failing the whole blast.
+        """
+        calls = self._targeted("send", channel, fingerprints, message=message)
+        results = self._gather(calls, strict=False)
+        merged = {"sent": 0, "failed": 0, "superseded": 0, "quiet": 0, "pruned": 0, "shards": len(results)}
+        for result in results.values():
+            for key in ("sent", "failed", "superseded", "quiet", "pruned"):
+                merged[key] += result.get(key, 0)
+        merged["unavailable"] = sorted(name for name, _, _ in calls if name not in results)
+        print(f"🧩 Blast over {len(calls)} shard(s): sent={merged['sent']}, failed={merged['failed']}, unavailable={merged['unavailable']}")
+        return merged
+
+    def records(self, channel):
+        """Every record, one shard at a time (only one shard's list is held in memory)"""
+        for name in self.clients:
+            yield from self._gather([(name, "records", {"channel": channel})])[name]
+
+    def rebalance(self):
+        """Move records whose owner changed (shards added / removed) to their new shard"""
+        moved = 0
+        misplaced = self._gather([
+            (name, "misplaced", {"nodes": self.ring.nodes, "vnodes": self.ring.vnodes, "node": name})
+            for name in self.clients
+        ])
+        for source, channels in misplaced.items():
+            for channel, records in channels.items():
+                if not records:
+                    continue
+                groups = {}
+                for record in records:
+                    groups.setdefault(self.ring.node_for(record["device_fingerprint"]), []).append(record)
+                # Copied before removal: a crash in between leaves a duplicate, never a loss
+                self._gather([(name, "put_many", {"channel": channel, "records": group}) for name, group in groups.items()])
+                self._gather([(source, "remove", {
+                    "channel": channel, "field": "device_fingerprint",
+                    "values": [record["device_fingerprint"] for record in records]
+                })])
+                moved += len(records)
+        if moved:
+            print(f"🧩 Rebalanced {moved} record(s) to their new shard")
+        return moved
+
+    def stats(self):
+        results = self._gather([(name, "stats", {}) for name in self.clients], strict=False)
+        return {
+            name: {"address": f"{client.address[0]}:{client.address[1]}", **results.get(name, {"error": "unavailable"})}
+            for name, client in self.clients.items()
+        }
+
+    def close(self, timeout=10):
+        """Snapshot every shard; local worker processes are shut down"""
+        self._gather([(name, "snapshot", {}) for name in self.clients], strict=False)
+        for process, name in self.processes:
+            try:
+                self.clients[name].call("shutdown")
+                process.wait(timeout)
+            except (ShardError, subprocess.TimeoutExpired):
+                process.terminate()
+        for client in self.clients.values():
+            client.close()
+        self.executor.shutdown(wait=False)
+
+
+def wait_for_worker(address, authkey, timeout=WORKER_START_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            Client(address, authkey=authkey).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def start_local_workers(count, authkey, base_port=SHARD_BASE_PORT):
+    """Start `count` worker processes on this machine, returns ({name: address}, [(process, name)])"""
+    addresses = {}
+    processes = []
+    env = dict(os.environ, SHARD_AUTHKEY=authkey.decode("utf-8"))
+    for i in range(count):
+        name = f"shard-{i + 1}"
+        port = base_port + i
+        # Same command as a worker on another node. Own session: Ctrl+C reaches only
+        # the server, which drains its blasts and then stops the workers
+        process = subprocess.Popen(
+            [sys.executable, "-m", "back_modules.sharding", "--name", name, "--port", str(port)],
+            start_new_session=True,
+            env=env
+        )
+        addresses[name] = ("127.0.0.1", port)
+        processes.append((process, name))
+    for address in addresses.values():
+        wait_for_worker(address, authkey)
+    return addresses, processes
+
+
+def start_coordinator():
+    """Connect to SHARD_WORKERS or start SHARD_LOCAL_WORKERS, then rebalance (None when sharding is off)"""
+    global coordinator
+    authkey = SHARD_AUTHKEY
+    if SHARD_WORKERS:
+        if not authkey:
+            raise ShardError("SHARD_WORKERS needs SHARD_AUTHKEY (the secret the workers were started with)")
+        addresses = dict(parse_worker_address(entry) for entry in SHARD_WORKERS)
+        processes = []
+    elif SHARD_LOCAL_WORKERS > 0:
+        # Workers started here only need to share a key with this process
+        authkey = authkey or secrets.token_hex(32).encode("utf-8")
+        addresses, processes = start_local_workers(SHARD_LOCAL_WORKERS, authkey)
+    else:
+        return None
+
+    coordinator = ShardCoordinator(addresses, processes, authkey)
+    coordinator.rebalance()
+    print(f"🧩 Subscriptions sharded over {len(addresses)} worker(s): {', '.join(addresses)}")
+    return coordinator
+
+
+def stop_coordinator():
+    global coordinator
+    if coordinator is not None:
+        coordinator.close()
+        coordinator = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a subscription shard worker")
+    parser.add_argument("--name", required=True, help="Shard name (its ring identity and data/shards/<name>/ directory)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=SHARD_BASE_PORT)
+    args = parser.parse_args()
+    # This module's settings were read at import: take SHARD_AUTHKEY from .env explicitly
+    from dotenv import load_dotenv
+    load_dotenv()
+    try:
+        serve(args.name, args.host, args.port, os.getenv("SHARD_AUTHKEY", "").encode("utf-8"))
+    except ShardError as e:
+        sys.exit(f"❌ {e}")
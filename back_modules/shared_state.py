@@ -0,0 +1,50 @@
+"""Shared-state helpers - hand-off from worker threads to the server event loop
+
+Threading model: request handlers run on the uvicorn event loop, while the
+periodic sender and the janitor run in daemon threads. Shared datasets are
+guarded by threading locks owned by the module that holds them
+(webpush_handler.subscriptions_lock, fcm_handler.fcm_tokens_lock,
+main.history_lock, main.activity_lock). asyncio locks would not exclude the
+worker threads. Coroutines that touch WebSockets must run on the server loop,
+so threads go through run_on_main_loop.
+"""
+import asyncio
+import threading
+import time
+
+# Event loop running the FastAPI app (set in the lifespan)
+main_loop = None
+
+# Set when the server starts draining; worker threads wait on it instead of sleeping
+shutdown_event = threading.Event()
+
+# Worker threads that checkpoint their work on shutdown (joined by join_workers)
+_workers = []
+
+
+def set_main_loop(loop):
+    global main_loop
+    main_loop = loop
+
+
+def run_on_main_loop(coro, timeout=10):
+    """Run a coroutine on the server event loop from a worker thread and wait for it"""
+    if main_loop is None or not main_loop.is_running():
+        # No server loop (e.g. scripts): run it in a private loop
+        return asyncio.run(coro)
+    future = asyncio.run_coroutine_threadsafe(coro, main_loop)
+    return future.result(timeout)
+
+
+def register_worker(thread):
+    _workers.append(thread)
+
+
+def join_workers(timeout):
+    """Signal shutdown and wait up to `timeout` seconds for registered workers to stop"""
+    shutdown_event.set()
+    deadline = time.monotonic() + timeout
+    for thread in _workers:
+        thread.join(max(0, deadline - time.monotonic()))
+        if thread.is_alive():
+            print(f"⚠️ Worker {thread.name} still running after drain timeout")
@@ -0,0 +1,50 @@
+"""Startup helpers - enabled push channels and per-phase startup timing"""
+import os
+import time
+from contextlib import contextmanager
+
+# Comma separated list of enabled channels ("webpush", "fcm")
+# Disabled channels never import their SDK (pywebpush / firebase_admin)
+PUSH_CHANNELS = {
+    channel.strip().lower()
+    for channel in os.getenv("PUSH_CHANNELS", "webpush,fcm").split(",")
+    if channel.strip()
+}
+
+
+def channel_enabled(channel):
+    """True if the push channel is enabled for this deployment"""
+    return channel in PUSH_CHANNELS
+
+
+class StartupReport:
+    """Collects how long each startup phase took"""
+
+    def __init__(self, started_at=None):
+        self.started_at = started_at or time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block of startup work"""
+        phase_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - phase_start))
+
+    def record(self, name, seconds):
+        """Add a phase measured elsewhere"""
+        self.phases.append((name, seconds))
+
+    def as_dict(self):
+        return {
+            "phases": {name: round(seconds * 1000, 1) for name, seconds in self.phases},
+            "total_ms": round((time.perf_counter() - self.started_at) * 1000, 1)
+        }
+
+    def print_report(self):
+        print("⏱️ Startup timing:")
+        for name, seconds in self.phases:
+            print(f"   {name:<24} {seconds * 1000:8.1f} ms")
+        print(f"   {'total':<24} {(time.perf_counter() - self.started_at) * 1000:8.1f} ms")
@@ -0,0 +1,297 @@
+"""Crash-safe JSON storage - atomic snapshots plus an append-only journal of mutations"""
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+# Journal entries written before a snapshot is compacted
+DEFAULT_COMPACT_EVERY = 500
+
+
+def atomic_write_text(path, text):
+    """Write text to path via temp file + fsync + rename, so readers never see a partial file"""
+    atomic_write_bytes(path, text.encode("utf-8"))
+
+
+def atomic_write_bytes(path, data):
+    """Write bytes to path via temp file + fsync + rename, so readers never see a partial file"""
+    tmp_path = write_temp(path, data)
+    try:
+        install_temp(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def write_temp(path, data):
+    """Write and fsync data to a temp file next to path; returns the temp path"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path
+
+
+def install_temp(tmp_path, path):
+    """Rename a temp file from write_temp over path and persist the rename"""
+    path = Path(path)
+    os.replace(tmp_path, path)
+
+    # Persist the rename itself (not supported on Windows)
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def apply_keyed_list_op(key_field, make_item=None):
+    """Journal ops for a list of records identified by key_field (put / remove / clear)
+
+    Records only need a dict-like .get(); make_item converts the journaled dict.
+    """
+    def apply(state, op):
+        if op["op"] == "put":
+            key = op["record"].get(key_field)
+            state[:] = [item for item in state if item.get(key_field) != key]
+            state.append(make_item(op["record"]) if make_item else op["record"])
+        elif op["op"] == "remove":
+            values = set(op["values"])
+            state[:] = [item for item in state if item.get(op["field"]) not in values]
+        elif op["op"] == "clear":
+            state.clear()
+    return apply
+
+
+def apply_capped_list_op(max_items, trim_batch=0):
+    """Journal ops for an append-only list keeping the last max_items (append / clear)
+
+    With trim_batch the list may grow to max_items + trim_batch before its head is
+    trimmed back to max_items, so appends don't shift the whole list every time.
+    """
+    def apply(state, op):
+        if op["op"] == "append":
+            state.append(op["item"])
+            if len(state) > max_items + trim_batch:
+                del state[:len(state) - max_items]
+        elif op["op"] == "clear":
+            state.clear()
+    return apply
+
+
+def apply_dict_op(state, op):
+    """Journal ops for a dict (set / delete / clear)"""
+    if op["op"] == "set":
+        state[op["key"]] = op["value"]
+    elif op["op"] == "delete":
+        for key in op["keys"]:
+            state.pop(key, None)
+    elif op["op"] == "clear":
+        state.clear()
+
+
+def migrate_list_store(legacy, target, convert):
+    """Move a list store into a new store/format once, removing the legacy files afterwards"""
+    if target.path.exists() or target.journal_path.exists() or target.rotated_path.exists():
+        return False
+    if not (legacy.path.exists() or legacy.journal_path.exists() or legacy.rotated_path.exists()):
+        return False
+
+    state = [convert(item) for item in legacy.load()]
+    target.snapshot(state)
+    legacy.delete()
+    print(f"🔄 Migrated {len(state)} {target.name} to {target.path}")
+    return True
+
+
+class CorruptStoreError(RuntimeError):
+    """A snapshot could not be decoded; it was moved aside and loading refused"""
+
+
+class JournaledStore:
+    """A JSON snapshot file plus `<file>.journal` with one JSON op per line
+
+    Mutations are appended (and fsynced) to the journal instead of rewriting the file.
+    Every `compact_every` ops the journal is rotated to `<file>.journal.old` and a
+    background thread writes a new snapshot from a shallow copy of the state, then
+    drops the rotated journal. Loading replays the rotated journal and the journal on
+    top of the snapshot; a torn last line from a crash mid-append is ignored.
+    A crash between the snapshot rename and the journal removal replays ops already
+    in the snapshot: put/remove/set are idempotent, capped-list appends may repeat.
+
+    An undecodable snapshot is moved to `<file>.corrupt` and loading fails rather
+    than replaying the journal onto empty state; the operator restores or deletes it.
+    """
+
+    def __init__(self, path, apply_op, empty=list, compact_every=DEFAULT_COMPACT_EVERY, name=None,
+                 encode=None, decode=None, fsync=True):
+        self.path = Path(path)
+        # Snapshot codec (bytes); JSON when not given
+        self.encode = encode or (lambda state: json.dumps(state, indent=2).encode("utf-8"))
+        self.decode = decode or (lambda data: json.loads(data.decode("utf-8")))
+        self.journal_path = self.path.with_name(self.path.name + ".journal")
+        self.rotated_path = self.path.with_name(self.path.name + ".journal.old")
+        self.corrupt_path = self.path.with_name(self.path.name + ".corrupt")
+        self.apply_op = apply_op
+        self.empty = empty
+        self.compact_every = compact_every
+        self.name = name or self.path.stem
+        # fsync every append; off only for stores whose last writes may be lost on power failure
+        self.fsync = fsync
+        self.pending = 0
+        self._journal = None
+        self._lock = threading.RLock()
+        # Running background compaction, and a counter that invalidates it when a
+        # synchronous snapshot()/delete() lands first
+        self._compactor = None
+        self._epoch = 0
+
+    def load(self):
+        """Return the snapshot with the journal replayed on top"""
+        with self._lock:
+            if self.corrupt_path.exists():
+                raise CorruptStoreError(
+                    f"{self.corrupt_path} was kept aside by an earlier failed load; "
+                    f"restore it as {self.path} or delete it before starting"
+                )
+
+            state = self.empty()
+            if self.path.exists():
+                try:
+                    content = self.path.read_bytes()
+                    if content.strip():
+                        state = self.decode(content)
+                except Exception as e:
+                    os.replace(self.path, self.corrupt_path)
+                    print(f"❌ {self.name} snapshot is unreadable ({e}), moved to {self.corrupt_path}")
+                    raise CorruptStoreError(
+                        f"{self.name} snapshot could not be decoded: {e}. It was moved to {self.corrupt_path}; "
+                        f"restore it, or delete it to start from the journal alone"
+                    ) from e
+
+            replayed = 0
+            for journal_path in (self.rotated_path, self.journal_path):
+                if not journal_path.exists():
+                    continue
+                with open(journal_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            op = json.loads(line)
+                        except json.JSONDecodeError:
+                            print(f"⚠️ Skipping torn {self.name} journal entry")
+                            continue
+                        self.apply_op(state, op)
+                        replayed += 1
+            if replayed:
+                print(f"📒 Replayed {replayed} {self.name} journal entr{'y' if replayed == 1 else 'ies'}")
+
+            self.pending = replayed
+            return state
+
+    def append(self, op, state):
+        """Journal one mutation already applied to state; starts a compaction when the journal grows"""
+        with self._lock:
+            if self._journal is None:
+                self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+                # Terminate a torn last line so it can't swallow the next entry
+                if self._journal.tell() > 0 and not self._ends_with_newline(self.journal_path):
+                    self._journal.write("\n")
+            self._journal.write(json.dumps(op, separators=(",", ":")) + "\n")
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self.pending += 1
+
+            if self.pending >= self.compact_every and self._compactor is None:
+                self._start_compaction(state)
+
+    @staticmethod
+    def _ends_with_newline(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _start_compaction(self, state):
+        """Rotate the journal and snapshot a copy of state on a background thread"""
+        self._close_journal()
+        if self.rotated_path.exists():
+            # Left over by a failed compaction: keep its ops ahead of the current ones
+            with open(self.rotated_path, "ab") as rotated:
+                if rotated.tell() > 0 and not self._ends_with_newline(self.rotated_path):
+                    rotated.write(b"\n")
+                rotated.write(self.journal_path.read_bytes())
+                rotated.flush()
+                os.fsync(rotated.fileno())
+            self.journal_path.unlink()
+        else:
+            os.replace(self.journal_path, self.rotated_path)
+        self.pending = 0
+
+        self._compactor = threading.Thread(
+            target=self._compact, args=(state.copy(), self._epoch),
+            name=f"compact-{self.name}", daemon=True
+        )
+        self._compactor.start()
+
+    def _compact(self, state, epoch):
+        tmp_path = None
+        try:
+            tmp_path = write_temp(self.path, self.encode(state))
+            with self._lock:
+                if epoch != self._epoch:
+                    # A synchronous snapshot already covers the rotated journal
+                    return
+                install_temp(tmp_path, self.path)
+                tmp_path = None
+                self.rotated_path.unlink(missing_ok=True)
+        except Exception as e:
+            print(f"❌ Error compacting {self.name}: {e}. The journal is kept and compaction retried later.")
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            with self._lock:
+                self._compactor = None
+
+    def wait_for_compaction(self, timeout=None):
+        """Block until a running background compaction finishes"""
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join(timeout)
+
+    def snapshot(self, state):
+        """Write the full state atomically and truncate the journal"""
+        with self._lock:
+            atomic_write_bytes(self.path, self.encode(state))
+            self._close_journal()
+            for path in (self.journal_path, self.rotated_path):
+                path.unlink(missing_ok=True)
+            self._epoch += 1
+            self.pending = 0
+
+    def delete(self):
+        """Remove snapshot and journal"""
+        with self._lock:
+            self._close_journal()
+            for path in (self.path, self.journal_path, self.rotated_path):
+                path.unlink(missing_ok=True)
+            self._epoch += 1
+            self.pending = 0
@@ -1,77 +1,165 @@
 """WebPush (VAPID) notification handler"""
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-from pywebpush import webpush, WebPushException
+from pydantic import BaseModel, Field
+from typing import Annotated, Dict, List, Optional
 from pathlib import Path
+import asyncio
 import json
 import os
+import threading
 import time
 from datetime import datetime
 
+from . import collapse, scheduler, startup, storage, compact_store, shared_state, receipts, sharding
+
 router = APIRouter()
 
-# Data file
-SUBSCRIPTIONS_FILE = Path("data/subscriptions.json")
+# Data files (compact binary snapshot; the JSON file is migrated on first load)
+SUBSCRIPTIONS_FILE = Path("data/subscriptions.bin")
+LEGACY_SUBSCRIPTIONS_FILE = Path("data/subscriptions.json")
 
 # Notification interval configuration (in minutes)
 NOTIFICATION_INTERVAL_MINUTES = 60  # Change this value to adjust notification frequency
 
+# Periodic deliveries are spread over this fraction of the interval (per-device jitter)
+PERIODIC_SPREAD_FRACTION = 0.8
+
+# Outbound cap for periodic deliveries (both channels combined, 0 = unlimited)
+PERIODIC_MAX_SENDS_PER_SECOND = float(os.getenv("PERIODIC_MAX_SENDS_PER_SECOND", "20"))
+
+# Collapse keys used by the periodic sender (one pending periodic notification per device)
+PERIODIC_COLLAPSE_KEY = "webpush-periodic"
+
+# Progress of a periodic cycle interrupted by shutdown (resumed on the next start)
+PERIODIC_CHECKPOINT_FILE = Path("data/periodic_checkpoint.json")
+
 # Global variable to track next periodic notification time
 next_periodic_notification_time = None
 
 
+# Stored fields are size-capped and NUL-free (compact_store snapshot limits)
+SubscriptionKey = Annotated[str, Field(max_length=compact_store.MAX_KEY_LENGTH, pattern=compact_store.NO_NUL_PATTERN)]
+
+
 class PushSubscription(BaseModel):
-    endpoint: str
-    keys: dict
-    device_fingerprint: str
+    endpoint: str = Field(max_length=compact_store.MAX_ENDPOINT_LENGTH, pattern=compact_store.NO_NUL_PATTERN)
+    keys: Dict[str, SubscriptionKey] = Field(max_length=4)
+    device_fingerprint: str = Field(max_length=compact_store.MAX_FINGERPRINT_LENGTH, pattern=compact_store.NO_NUL_PATTERN)
+    # IANA name, e.g. "Europe/Madrid"
+    timezone: Optional[str] = Field(None, max_length=compact_store.MAX_TIMEZONE_LENGTH, pattern=compact_store.NO_NUL_PATTERN)
+    quiet_start: Optional[int] = Field(None, ge=0, le=23)  # Local hour when periodic deliveries pause
+    quiet_end: Optional[int] = Field(None, ge=0, le=23)  # Local hour when periodic deliveries resume
 
 
 class NotificationPayload(BaseModel):
     title: str
     body: str
     icon: str = "/static/icon-192.png"
+    collapse_key: Optional[str] = None
+    # Only these devices (all subscribers when omitted)
+    device_fingerprints: Optional[List[str]] = None
+
+
+# Snapshot + journal of subscription mutations (keyed by device fingerprint)
+subscriptions_store = storage.JournaledStore(
+    SUBSCRIPTIONS_FILE,
+    storage.apply_keyed_list_op("device_fingerprint", compact_store.WebPushRecord.from_dict),
+    name="subscriptions",
+    encode=compact_store.encode_webpush,
+    decode=compact_store.decode_webpush
+)
+legacy_subscriptions_store = storage.JournaledStore(LEGACY_SUBSCRIPTIONS_FILE, storage.apply_keyed_list_op("device_fingerprint"), name="subscriptions")
 
 
 def load_subscriptions():
-    """Load subscriptions from JSON file"""
-    if SUBSCRIPTIONS_FILE.exists():
-        try:
-            with open(SUBSCRIPTIONS_FILE, "r") as f:
-                content = f.read().strip()
-                if content:
-                    return json.loads(content)
-        except (json.JSONDecodeError, Exception) as e:
-            print(f"⚠️ Error loading subscriptions: {e}. Starting with empty list.")
-    return []
+    """Load subscriptions (WebPushRecord list) from snapshot + journal"""
+    storage.migrate_list_store(legacy_subscriptions_store, subscriptions_store, compact_store.WebPushRecord.from_dict)
+    return subscriptions_store.load()
 
 
 def save_subscriptions(subscriptions):
-    """Save subscriptions to JSON file"""
-    SUBSCRIPTIONS_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(SUBSCRIPTIONS_FILE, "w") as f:
-        json.dump(subscriptions, f, indent=2)
+    """Write a full subscriptions snapshot (atomic) and reset the journal"""
+    subscriptions_store.snapshot(subscriptions)
+
+
+def prune_subscriptions(endpoints=(), fingerprints=()):
+    """Remove subscriptions by endpoint or device fingerprint in one pass and save once"""
+    global subscriptions
+    endpoints = set(endpoints)
+    fingerprints = set(fingerprints)
+    if not endpoints and not fingerprints:
+        return 0
+    
+    if sharding.coordinator:
+        removed = sharding.coordinator.remove("webpush", "endpoint", endpoints)
+        removed += sharding.coordinator.remove("webpush", "device_fingerprint", fingerprints)
+        if removed:
+            print(f"🗑️ Pruned {removed} invalid subscription(s)")
+        return removed
+    
+    with subscriptions_lock:
+        remaining = [
+            sub for sub in subscriptions
+            if sub.get("endpoint") not in endpoints
+            and sub.get("device_fingerprint") not in fingerprints
+        ]
+        removed = len(subscriptions) - len(remaining)
+        if removed:
+            subscriptions = remaining
+            if endpoints:
+                subscriptions_store.append({"op": "remove", "field": "endpoint", "values": sorted(endpoints)}, subscriptions)
+            if fingerprints:
+                subscriptions_store.append({"op": "remove", "field": "device_fingerprint", "values": sorted(fingerprints)}, subscriptions)
+    if removed:
+        print(f"🗑️ Pruned {removed} invalid subscription(s)")
+    return removed
 
 
-# Load subscriptions on module import
-subscriptions = load_subscriptions()
+def init_subscriptions():
+    """Load subscriptions into memory (called at startup)"""
+    global subscriptions
+    with subscriptions_lock:
+        subscriptions = load_subscriptions()
+    return subscriptions
+
+
+async def subscription_total():
+    """Number of subscriptions (summed over the shard workers when sharded)"""
+    if sharding.coordinator:
+        return await asyncio.to_thread(sharding.coordinator.count, "webpush")
+    return len(subscriptions)
+
+
+# In-memory subscriptions, loaded at startup by init_subscriptions (not on import).
+# Copy-on-write: writers build a new list under subscriptions_lock and rebind the
+# global, so readers (fan-out loops, the periodic thread) iterate a stable snapshot
+# without locking. Never mutate the list in place.
+subscriptions = []
+subscriptions_lock = threading.RLock()
 
 
 @router.post("/api/subscribe")
 async def subscribe(subscription: PushSubscription, add_history_callback=None, broadcast_callback=None):
     """Store push subscription"""
     global subscriptions
+    record = compact_store.WebPushRecord.from_dict(subscription.model_dump())
     
-    # Remove old subscription from same device
-    subscriptions[:] = [
-        sub for sub in subscriptions 
-        if sub.get("device_fingerprint") != subscription.device_fingerprint
-    ]
-    
-    # Add new subscription
-    subscriptions.append(subscription.model_dump())
-    save_subscriptions(subscriptions)
+    if sharding.coordinator:
+        # Stored (replacing the device's old subscription) by the shard owning the fingerprint
+        await asyncio.to_thread(sharding.coordinator.put, "webpush", record.to_dict())
+    else:
+        with subscriptions_lock:
+            # Replace old subscription from same device
+            updated = [
+                sub for sub in subscriptions 
+                if sub.get("device_fingerprint") != subscription.device_fingerprint
+            ]
+            updated.append(record)
+            subscriptions = updated
+            subscriptions_store.append({"op": "put", "record": record.to_dict()}, subscriptions)
+    total = await subscription_total()
     print(f"✅ New subscription from device: {subscription.device_fingerprint[:16]}...")
-    print(f"📊 Total subscriptions: {len(subscriptions)}")
+    print(f"📊 Total subscriptions: {total}")
     
     # Add to history if callback provided
     if add_history_callback and broadcast_callback:
@@ -80,25 +168,35 @@ async def subscribe(subscription: PushSubscription, add_history_callback=None, b
             message="📱 Dispositivo suscrito",
             details={
                 "device": subscription.device_fingerprint[:16],
-                "total": len(subscriptions)
+                "total": total
             }
         )
         await broadcast_callback()
     
-    return {"status": "subscribed", "total": len(subscriptions)}
+    return {"status": "subscribed", "total": total}
 
 
 @router.post("/api/unsubscribe")
 async def unsubscribe(subscription: PushSubscription, add_history_callback=None, broadcast_callback=None):
     """Remove push subscription"""
     global subscriptions
-    initial_count = len(subscriptions)
-    subscriptions = [
-        s for s in subscriptions 
-        if s.get("device_fingerprint") != subscription.device_fingerprint
-    ]
-    removed = initial_count - len(subscriptions)
-    save_subscriptions(subscriptions)
+    if sharding.coordinator:
+        removed = await asyncio.to_thread(
+            sharding.coordinator.remove, "webpush", "device_fingerprint", [subscription.device_fingerprint]
+        )
+    else:
+        with subscriptions_lock:
+            initial_count = len(subscriptions)
+            subscriptions = [
+                s for s in subscriptions 
+                if s.get("device_fingerprint") != subscription.device_fingerprint
+            ]
+            removed = initial_count - len(subscriptions)
+            subscriptions_store.append(
+                {"op": "remove", "field": "device_fingerprint", "values": [subscription.device_fingerprint]},
+                subscriptions
+            )
+    total = await subscription_total()
     print(f"🗑️ Unsubscribed device: {subscription.device_fingerprint[:16]}...")
     
     # Add to history if callback provided
@@ -108,17 +206,20 @@ async def unsubscribe(subscription: PushSubscription, add_history_callback=None,
             message="📴 Dispositivo desuscrito",
             details={
                 "device": subscription.device_fingerprint[:16],
-                "total": len(subscriptions)
+                "total": total
             }
         )
         await broadcast_callback()
     
-    return {"status": "unsubscribed", "removed": removed, "total": len(subscriptions)}
+    return {"status": "unsubscribed", "removed": removed, "total": total}
 
 
 @router.get("/api/check-subscription/{fingerprint}")
 async def check_subscription(fingerprint: str):
     """Check if a device is subscribed"""
+    if sharding.coordinator:
+        count = await asyncio.to_thread(sharding.coordinator.count, "webpush", [fingerprint])
+        return {"is_subscribed": count > 0}
     is_subscribed = any(
         sub.get("device_fingerprint") == fingerprint 
         for sub in subscriptions
@@ -130,9 +231,13 @@ async def check_subscription(fingerprint: str):
 async def clear_subscriptions(add_history_callback=None, broadcast_callback=None):
     """Clear all subscriptions"""
     global subscriptions
-    count = len(subscriptions)
-    subscriptions.clear()
-    save_subscriptions(subscriptions)
+    if sharding.coordinator:
+        count = await asyncio.to_thread(sharding.coordinator.clear, "webpush")
+    else:
+        with subscriptions_lock:
+            count = len(subscriptions)
+            subscriptions = []
+            save_subscriptions(subscriptions)
     print(f"🗑️ Cleared all subscriptions ({count} removed)")
     
     # Add to history if callback provided
@@ -150,14 +255,70 @@ async def clear_subscriptions(add_history_callback=None, broadcast_callback=None
     return {"status": "cleared", "removed": count}
 
 
+def deliver_webpush(targets, notification_data, vapid_private_key, vapid_email, push_headers=None, is_superseded=None):
+    """Blocking sends to every target, returns (sent, failed, superseded, invalid endpoints)
+    
+    Shared by the blast endpoint and the shard workers. is_superseded(fingerprint)
+    is checked before each send; devices a newer blast with the same collapse key
+    also targets are skipped.
+    """
+    from pywebpush import webpush, WebPushException
+    
+    sent_count = 0
+    failed_count = 0
+    superseded_count = 0
+    # Invalid endpoints are collected and pruned once after the loop
+    invalid_endpoints = set()
+    
+    for idx, subscription in enumerate(targets):
+        if is_superseded and is_superseded(subscription.get("device_fingerprint")):
+            superseded_count += 1
+            continue
+        try:
+            print(f"📤 Sending to subscription {idx + 1}/{len(targets)}: {subscription.get('device_fingerprint', 'unknown')[:16]}...")
+            webpush(
+                subscription_info=subscription.subscription_info(),
+                data=json.dumps(notification_data),
+                vapid_private_key=vapid_private_key,
+                vapid_claims={"sub": vapid_email},
+                headers=push_headers
+            )
+            sent_count += 1
+            print(f"✅ Sent successfully to subscription {idx + 1}")
+        except WebPushException as e:
+            print(f"❌ WebPushException for subscription {idx + 1}: {e}")
+            print(f"   Status code: {e.response.status_code if e.response else 'N/A'}")
+            print(f"   Response text: {e.response.text if e.response else 'N/A'}")
+            failed_count += 1
+            # Mark invalid subscription for removal
+            if e.response and e.response.status_code in [404, 410]:
+                invalid_endpoints.add(subscription.get("endpoint"))
+        except Exception as e:
+            print(f"❌ Error sending notification to subscription {idx + 1}: {e}")
+            failed_count += 1
+    
+    return sent_count, failed_count, superseded_count, invalid_endpoints
+
+
 @router.post("/api/send-notification")
 async def send_notification(payload: NotificationPayload, add_history_callback=None, broadcast_callback=None):
     """Send push notification to all subscribers"""
     print("=" * 50)
     print("📬 Send notification endpoint called")
-    print(f"📊 Total subscriptions: {len(subscriptions)}")
+    if sharding.coordinator:
+        # Subscriptions live in the shard workers, each one filters its own
+        targets = None
+        target_count = await asyncio.to_thread(sharding.coordinator.count, "webpush", payload.device_fingerprints)
+    else:
+        # Copy-on-write snapshot: concurrent (un)subscribes don't affect this fan-out
+        targets = subscriptions
+        if payload.device_fingerprints is not None:
+            wanted = set(payload.device_fingerprints)
+            targets = [sub for sub in targets if sub.device_fingerprint in wanted]
+        target_count = len(targets)
+    print(f"📊 Total subscriptions: {target_count}")
     
-    if not subscriptions:
+    if not target_count:
         print("⚠️ No subscribers found")
         return {"status": "no_subscribers", "sent": 0}
     
@@ -171,8 +332,17 @@ async def send_notification(payload: NotificationPayload, add_history_callback=N
     if not vapid_private_key or not vapid_public_key:
         raise HTTPException(status_code=500, detail="VAPID keys not configured")
     
-    # Generate unique tag
-    notification_tag = f"pwa-poc-{int(time.time())}"
+    # Collapsible sends reuse the key as tag so the device replaces the previous notification
+    if payload.collapse_key:
+        notification_tag = payload.collapse_key
+        push_headers = {"Topic": collapse.topic_for(payload.collapse_key)}
+    else:
+        notification_tag = f"pwa-poc-{int(time.time())}"
+        push_headers = None
+    
+    # Message id lets the service worker report delivery / click receipts
+    message_id = receipts.new_message_id()
+    receipts.register_message(message_id, "webpush", payload.title, target_count)
     
     notification_data = {
         "title": payload.title,
@@ -180,40 +350,36 @@ async def send_notification(payload: NotificationPayload, add_history_callback=N
         "icon": payload.icon,
         "badge": "/static/icon-192.png",
         "tag": notification_tag,
-        "timestamp": int(time.time() * 1000)
+        "timestamp": int(time.time() * 1000),
+        "message_id": message_id
     }
     
     print(f"📦 Notification data: {notification_data}")
     
-    sent_count = 0
-    failed_count = 0
-    
-    for idx, subscription in enumerate(subscriptions[:]):
-        try:
-            print(f"📤 Sending to subscription {idx + 1}/{len(subscriptions)}: {subscription.get('device_fingerprint', 'unknown')[:16]}...")
-            webpush(
-                subscription_info=subscription,
-                data=json.dumps(notification_data),
-                vapid_private_key=vapid_private_key,
-                vapid_claims={"sub": vapid_email}
+    def fan_out():
+        """Blocking HTTP sends to every target (runs in a worker thread)"""
+        if sharding.coordinator:
+            # Each shard worker sends to its own subscriptions and prunes its invalid endpoints
+            result = sharding.coordinator.blast(
+                "webpush",
+                {"notification": notification_data, "headers": push_headers, "collapse_key": payload.collapse_key},
+                payload.device_fingerprints
             )
-            sent_count += 1
-            print(f"✅ Sent successfully to subscription {idx + 1}")
-        except WebPushException as e:
-            print(f"❌ WebPushException for subscription {idx + 1}: {e}")
-            print(f"   Status code: {e.response.status_code if e.response else 'N/A'}")
-            print(f"   Response text: {e.response.text if e.response else 'N/A'}")
-            failed_count += 1
-            # Remove invalid subscription
-            if e.response and e.response.status_code in [404, 410]:
-                subscriptions.remove(subscription)
-                save_subscriptions(subscriptions)
-                print(f"🗑️ Removed invalid subscription")
-        except Exception as e:
-            print(f"❌ Error sending notification to subscription {idx + 1}: {e}")
-            failed_count += 1
+            return result["sent"], result["failed"], result["superseded"]
+        
+        # A newer send with the same collapse key reaches the devices it shares with this one instead
+        with collapse.blast(payload.collapse_key, payload.device_fingerprints) as is_superseded:
+            sent_count, failed_count, superseded_count, invalid_endpoints = deliver_webpush(
+                targets, notification_data, vapid_private_key, vapid_email, push_headers, is_superseded
+            )
+        prune_subscriptions(endpoints=invalid_endpoints)
+        return sent_count, failed_count, superseded_count
+    
+    # Off the event loop, so heartbeats and WebSockets are served during the blast
+    sent_count, failed_count, superseded_count = await asyncio.to_thread(fan_out)
+    receipts.record_send_results(message_id, sent_count, failed_count)
     
-    print(f"📊 Results: Sent={sent_count}, Failed={failed_count}")
+    print(f"📊 Results: Sent={sent_count}, Failed={failed_count}, Superseded={superseded_count}")
     print("=" * 50)
     
     # Add to history if callback provided
@@ -226,7 +392,9 @@ async def send_notification(payload: NotificationPayload, add_history_callback=N
                 "body": payload.body,
                 "sent": sent_count,
                 "failed": failed_count,
-                "tag": notification_tag
+                "superseded": superseded_count,
+                "tag": notification_tag,
+                "message_id": message_id
             }
         )
         await broadcast_callback()
@@ -235,148 +403,330 @@ async def send_notification(payload: NotificationPayload, add_history_callback=N
         "status": "sent",
         "sent": sent_count,
         "failed": failed_count,
-        "total_subscribers": len(subscriptions),
-        "tag": notification_tag
+        "superseded": superseded_count,
+        "total_subscribers": await subscription_total(),
+        "tag": notification_tag,
+        "message_id": message_id
     }
 
 
+def load_periodic_checkpoint():
+    """Checkpoint left by an interrupted periodic cycle, None if there is none"""
+    if not PERIODIC_CHECKPOINT_FILE.exists():
+        return None
+    try:
+        return json.loads(PERIODIC_CHECKPOINT_FILE.read_text(encoding="utf-8"))
+    except (json.JSONDecodeError, Exception) as e:
+        print(f"⚠️ Ignoring periodic checkpoint: {e}")
+        return None
+
+
+def save_periodic_checkpoint(checkpoint):
+    storage.atomic_write_text(PERIODIC_CHECKPOINT_FILE, json.dumps(checkpoint))
+
+
+def clear_periodic_checkpoint():
+    if PERIODIC_CHECKPOINT_FILE.exists():
+        PERIODIC_CHECKPOINT_FILE.unlink()
+
+
+def send_sharded_periodic_cycle(webpush_enabled, fcm_enabled, add_history_callback=None, broadcast_callback=None):
+    """One periodic cycle while subscriptions are sharded: one blast per channel
+
+    Each shard worker skips its devices inside their quiet hours. Deliveries are
+    not spread over the interval and an interrupted cycle is not checkpointed.
+    """
+    from .fcm_handler import FCM_PERIODIC_COLLAPSE_KEY
+    
+    current_time = datetime.now().strftime('%H:%M:%S')
+    vapid_private_key = os.getenv("VAPID_PRIVATE_KEY")
+    summaries = []
+    
+    if webpush_enabled and vapid_private_key:
+        target_count = sharding.coordinator.count("webpush")
+        if target_count:
+            message_id = receipts.new_message_id()
+            receipts.register_message(message_id, "webpush", "⏰📡 WebPush - Notificación Periódica", target_count)
+            result = sharding.coordinator.blast("webpush", {
+                "notification": {
+                    "title": "⏰📡 WebPush - Notificación Periódica",
+                    "body": f"Mensaje automático enviado desde BACK (backend) a las {current_time}",
+                    "icon": "/static/icon-192.png",
+                    "badge": "/static/icon-192.png",
+                    "tag": PERIODIC_COLLAPSE_KEY,
+                    "timestamp": int(time.time() * 1000),
+                    "message_id": message_id
+                },
+                "headers": {"Topic": collapse.topic_for(PERIODIC_COLLAPSE_KEY)},
+                "collapse_key": PERIODIC_COLLAPSE_KEY,
+                "quiet_hours": True
+            })
+            receipts.record_send_results(message_id, result["sent"], result["failed"])
+            results = {"sent": result["sent"], "failed": result["failed"], "quiet": result["quiet"]}
+            summaries.append(("webpush_periodic", f"⏰📡 Notificación periódica WebPush enviada a {results['sent']} dispositivo(s)", results))
+    
+    if fcm_enabled:
+        target_count = sharding.coordinator.count("fcm")
+        if target_count:
+            message_id = receipts.new_message_id()
+            receipts.register_message(message_id, "fcm", "⏰🔥 FCM - Notificación Periódica", target_count)
+            result = sharding.coordinator.blast("fcm", {
+                "data": {
+                    "title": "⏰🔥 FCM - Notificación Periódica",
+                    "body": f"Mensaje automático enviado desde BACK (backend) a las {current_time}",
+                    "icon": "/static/icon-192.png",
+                    "badge": "/static/icon-192.png",
+                    "tag": FCM_PERIODIC_COLLAPSE_KEY,
+                    "message_id": message_id
+                },
+                "collapse_key": FCM_PERIODIC_COLLAPSE_KEY,
+                "quiet_hours": True
+            })
+            receipts.record_send_results(message_id, result["sent"], result["failed"])
+            results = {"sent": result["sent"], "failed": result["failed"], "quiet": result["quiet"]}
+            summaries.append(("fcm_periodic", f"⏰🔥 Notificación periódica FCM enviada a {results['sent']} dispositivo(s)", results))
+    
+    if add_history_callback and broadcast_callback:
+        for event_type, message, details in summaries:
+            try:
+                add_history_callback(event_type, message, details)
+                shared_state.run_on_main_loop(broadcast_callback())
+            except Exception as e:
+                pass
+    
+    total_sent = sum(details["sent"] for _, _, details in summaries)
+    total_quiet = sum(details["quiet"] for _, _, details in summaries)
+    print(f"⏰ Notificación periódica enviada a {total_sent} dispositivo(s) ({total_quiet} en horario silencioso) a las {datetime.now().strftime('%H:%M:%S')}")
+
+
+def wait_for_next_periodic_cycle(cycle_start, interval_seconds):
+    """Sleep until the next cycle starts, True if the server is shutting down"""
+    global next_periodic_notification_time
+    # Cycles start every interval, regardless of how long delivery took
+    next_periodic_notification_time = max(cycle_start + interval_seconds, time.time())
+    interval_text = f"{NOTIFICATION_INTERVAL_MINUTES} minute{'s' if NOTIFICATION_INTERVAL_MINUTES != 1 else ''}"
+    print(f"\n⏰ Next notification cycle (every {interval_text}) at {datetime.fromtimestamp(next_periodic_notification_time).strftime('%H:%M:%S')}")
+    print(f"💤 Sleeping until next cycle...\n")
+    
+    # Waits end early when the server starts draining
+    return shared_state.shutdown_event.wait(max(0, next_periodic_notification_time - time.time()))
+
+
 def send_periodic_notifications(add_history_callback=None, broadcast_callback=None):
-    """Send periodic notifications (both WebPush and FCM) - interval configured in NOTIFICATION_INTERVAL_MINUTES"""
+    """Send periodic notifications (both WebPush and FCM) - interval configured in NOTIFICATION_INTERVAL_MINUTES
+    
+    Deliveries are spread over the interval with a deterministic per-device offset,
+    skipped for devices inside their quiet hours and capped by a token bucket.
+    On shutdown the cycle stops between deliveries and is checkpointed; the next
+    start rebuilds the same plan (same cycle start, same offsets) and continues
+    after the last delivery instead of re-sending or skipping the rest.
+    While subscriptions are sharded each cycle is a blast per channel instead
+    (see send_sharded_periodic_cycle).
+    """
     global next_periodic_notification_time
     from dotenv import load_dotenv
-    from firebase_admin import messaging
-    from .fcm_handler import load_fcm_tokens, save_fcm_tokens
+    from . import fcm_handler
+    from .fcm_handler import prune_fcm_tokens, get_messaging, FCM_PERIODIC_COLLAPSE_KEY
     
     load_dotenv()
     
-    # Set initial next notification time (30 seconds from now)
-    next_periodic_notification_time = time.time() + 30
+    # Only the SDKs of enabled channels are imported
+    webpush_enabled = startup.channel_enabled("webpush")
+    fcm_enabled = startup.channel_enabled("fcm")
+    if webpush_enabled:
+        from pywebpush import webpush, WebPushException
+    if fcm_enabled:
+        messaging = get_messaging()
+    
+    rate_limiter = scheduler.TokenBucket(PERIODIC_MAX_SENDS_PER_SECOND)
     
-    # Wait 30 seconds before first notification
-    time.sleep(30)
+    checkpoint = load_periodic_checkpoint()
+    if checkpoint:
+        # Resume the cycle interrupted by the previous shutdown right away
+        next_periodic_notification_time = time.time()
+    else:
+        # Set initial next notification time (30 seconds from now)
+        next_periodic_notification_time = time.time() + 30
+        
+        # Wait 30 seconds before first notification
+        if shared_state.shutdown_event.wait(30):
+            return
     
     while True:
+        interval_seconds = NOTIFICATION_INTERVAL_MINUTES * 60
+        # A checkpoint is only resumed while its cycle is still current
+        if checkpoint and time.time() < checkpoint["cycle_start"] + interval_seconds:
+            cycle_start = checkpoint["cycle_start"]
+            print(f"⏯️ Resuming periodic cycle from {datetime.fromtimestamp(cycle_start).strftime('%H:%M:%S')}")
+        else:
+            checkpoint = None
+            cycle_start = time.time()
+        clear_periodic_checkpoint()
+        # Due time of the last processed delivery in this cycle
+        delivered_until = checkpoint["delivered_until"] if checkpoint else None
+        interrupted = False
+        
+        if sharding.coordinator:
+            # The plan needs every record in this process; shard workers take one blast per channel
+            try:
+                send_sharded_periodic_cycle(webpush_enabled, fcm_enabled, add_history_callback, broadcast_callback)
+            except Exception as e:
+                print(f"❌ Error in periodic notification thread: {e}")
+            if wait_for_next_periodic_cycle(cycle_start, interval_seconds):
+                return
+            continue
+        
         try:
-            current_time = datetime.now().strftime('%H:%M:%S')
-            
-            # WEBPUSH NOTIFICATIONS
-            current_subscriptions = load_subscriptions()
+            # Copy-on-write snapshots of the in-memory stores (no disk re-reads)
+            current_subscriptions = subscriptions if webpush_enabled else []
+            fcm_tokens = fcm_handler.fcm_tokens if fcm_enabled else []
             
             vapid_private_key = os.getenv("VAPID_PRIVATE_KEY")
             vapid_email = os.getenv("VAPID_EMAIL") or "mailto:admin@example.com"
             
-            webpush_sent = 0
-            webpush_failed = 0
+            records = [("fcm", token_data) for token_data in fcm_tokens]
+            if vapid_private_key:
+                records += [("webpush", subscription) for subscription in current_subscriptions]
             
-            if current_subscriptions and vapid_private_key:
-                notification_data = {
-                    "title": "⏰📡 WebPush - Notificación Periódica",
-                    "body": f"Mensaje automático enviado desde BACK (backend) a las {current_time}",
-                    "icon": "/static/icon-192.png",
-                    "badge": "/static/icon-192.png",
-                    "tag": f"webpush-periodic-{int(time.time())}",
-                    "timestamp": int(time.time() * 1000)
-                }
+            # One message id per channel and cycle for delivery receipts
+            if checkpoint:
+                message_ids = checkpoint["message_ids"]
+            else:
+                message_ids = {"webpush": receipts.new_message_id(), "fcm": receipts.new_message_id()}
+                if current_subscriptions and vapid_private_key:
+                    receipts.register_message(message_ids["webpush"], "webpush", "⏰📡 WebPush - Notificación Periódica", len(current_subscriptions))
+                if fcm_tokens:
+                    receipts.register_message(message_ids["fcm"], "fcm", "⏰🔥 FCM - Notificación Periódica", len(fcm_tokens))
+            
+            plan = scheduler.build_delivery_plan(records, cycle_start, interval_seconds * PERIODIC_SPREAD_FRACTION)
+            print(f"⏰ Periodic cycle: {len(plan)} delivery(ies) spread over {int(interval_seconds * PERIODIC_SPREAD_FRACTION)}s")
+            
+            results = checkpoint["results"] if checkpoint else {
+                "webpush": {"sent": 0, "failed": 0, "quiet": 0},
+                "fcm": {"sent": 0, "failed": 0, "quiet": 0}
+            }
+            invalid_endpoints = set()
+            invalid_tokens = set()
+            
+            for due_time, channel, record in plan:
+                # Already processed before the restart
+                if delivered_until is not None and due_time <= delivered_until:
+                    continue
+                
+                # Waits end early when the server starts draining
+                if shared_state.shutdown_event.wait(max(0, due_time - time.time())):
+                    interrupted = True
+                    break
+                delivered_until = due_time
+                
+                if scheduler.in_quiet_hours(record):
+                    results[channel]["quiet"] += 1
+                    continue
                 
-                for idx, subscription in enumerate(current_subscriptions[:]):
+                rate_limiter.acquire()
+                current_time = datetime.now().strftime('%H:%M:%S')
+                
+                if channel == "webpush":
+                    notification_data = {
+                        "title": "⏰📡 WebPush - Notificación Periódica",
+                        "body": f"Mensaje automático enviado desde BACK (backend) a las {current_time}",
+                        "icon": "/static/icon-192.png",
+                        "badge": "/static/icon-192.png",
+                        "tag": PERIODIC_COLLAPSE_KEY,
+                        "timestamp": int(time.time() * 1000),
+                        "message_id": message_ids["webpush"]
+                    }
                     try:
                         webpush(
-                            subscription_info=subscription,
+                            subscription_info=record.subscription_info(),
                             data=json.dumps(notification_data),
                             vapid_private_key=vapid_private_key,
-                            vapid_claims={"sub": vapid_email}
+                            vapid_claims={"sub": vapid_email},
+                            headers={"Topic": collapse.topic_for(PERIODIC_COLLAPSE_KEY)}
                         )
-                        webpush_sent += 1
+                        results[channel]["sent"] += 1
                     except WebPushException as e:
-                        # Remove expired/invalid subscriptions (410 Gone, 404 Not Found)
+                        # Collect expired/invalid subscriptions (410 Gone, 404 Not Found)
                         if e.response and e.response.status_code in [404, 410]:
-                            current_subscriptions.remove(subscription)
-                            save_subscriptions(current_subscriptions)
-                        webpush_failed += 1
-                    except Exception as e:
-                        webpush_failed += 1
-                
-                # Add event to history always
-                if add_history_callback and broadcast_callback:
-                    try:
-                        event = add_history_callback(
-                            "webpush_periodic",
-                            f"⏰📡 Notificación periódica WebPush enviada a {webpush_sent} dispositivo(s)"
-                        )
-                        # Broadcast to all connected clients
-                        import asyncio
-                        asyncio.run(broadcast_callback())
+                            invalid_endpoints.add(record.get("endpoint"))
+                        results[channel]["failed"] += 1
                     except Exception as e:
-                        pass
-            
-            # Wait 5 seconds between WebPush and FCM
-            time.sleep(5)
-            
-            # FCM NOTIFICATIONS
-            fcm_tokens = load_fcm_tokens()
-            
-            fcm_sent = 0
-            fcm_failed = 0
-            
-            if fcm_tokens:
-                for idx, token_data in enumerate(fcm_tokens[:]):
+                        results[channel]["failed"] += 1
+                else:
+                    token = record.get("token")
+                    if not token:
+                        continue
                     try:
-                        token = token_data.get("token")
-                        if not token:
-                            continue
-                        
                         message = messaging.Message(
                             data={
                                 "title": "⏰🔥 FCM - Notificación Periódica",
                                 "body": f"Mensaje automático enviado desde BACK (backend) a las {current_time}",
                                 "icon": "/static/icon-192.png",
                                 "badge": "/static/icon-192.png",
-                                "tag": f"fcm-periodic-{int(time.time())}"
+                                "tag": FCM_PERIODIC_COLLAPSE_KEY,
+                                "message_id": message_ids["fcm"]
                             },
                             token=token,
+                            android=messaging.AndroidConfig(collapse_key=FCM_PERIODIC_COLLAPSE_KEY),
                             webpush=messaging.WebpushConfig(
                                 headers={
-                                    "Urgency": "high"
+                                    "Urgency": "high",
+                                    "Topic": collapse.topic_for(FCM_PERIODIC_COLLAPSE_KEY)
                                 }
                             )
                         )
-                        
-                        response = messaging.send(message)
-                        fcm_sent += 1
-                        
+                        messaging.send(message)
+                        results[channel]["sent"] += 1
                     except messaging.UnregisteredError:
-                        fcm_tokens.remove(token_data)
-                        save_fcm_tokens(fcm_tokens)
-                        fcm_failed += 1
+                        invalid_tokens.add(token)
+                        results[channel]["failed"] += 1
                     except Exception as e:
-                        fcm_failed += 1
+                        results[channel]["failed"] += 1
+            
+            prune_subscriptions(endpoints=invalid_endpoints)
+            prune_fcm_tokens(tokens=invalid_tokens)
+            
+            if interrupted:
+                save_periodic_checkpoint({
+                    "cycle_start": cycle_start,
+                    "delivered_until": delivered_until,
+                    "message_ids": message_ids,
+                    "results": results
+                })
+                print(f"⏸️ Periodic cycle checkpointed ({results['webpush']['sent'] + results['fcm']['sent']} sent so far)")
+                return
+            checkpoint = None
+            
+            for channel, message_id in message_ids.items():
+                if results[channel]["sent"] or results[channel]["failed"]:
+                    receipts.record_send_results(message_id, results[channel]["sent"], results[channel]["failed"])
+            
+            # Add events to history always (one per channel with subscribers)
+            if add_history_callback and broadcast_callback:
+                summaries = []
+                if current_subscriptions and vapid_private_key:
+                    summaries.append(("webpush_periodic", f"⏰📡 Notificación periódica WebPush enviada a {results['webpush']['sent']} dispositivo(s)", results["webpush"]))
+                if fcm_tokens:
+                    summaries.append(("fcm_periodic", f"⏰🔥 Notificación periódica FCM enviada a {results['fcm']['sent']} dispositivo(s)", results["fcm"]))
                 
-                # Add event to history always
-                if add_history_callback and broadcast_callback:
+                for event_type, message, details in summaries:
                     try:
-                        event = add_history_callback(
-                            "fcm_periodic",
-                            f"⏰🔥 Notificación periódica FCM enviada a {fcm_sent} dispositivo(s)"
-                        )
-                        # Broadcast to all connected clients
-                        import asyncio
-                        asyncio.run(broadcast_callback())
+                        add_history_callback(event_type, message, details)
+                        # Broadcast to all connected clients (on the server event loop)
+                        shared_state.run_on_main_loop(broadcast_callback())
                     except Exception as e:
                         pass
             
             # Summary log
-            print(f"⏰ Notificación periódica enviada a {webpush_sent + fcm_sent} dispositivo(s) a las {current_time}")
+            total_sent = results["webpush"]["sent"] + results["fcm"]["sent"]
+            total_quiet = results["webpush"]["quiet"] + results["fcm"]["quiet"]
+            print(f"⏰ Notificación periódica enviada a {total_sent} dispositivo(s) ({total_quiet} en horario silencioso) a las {datetime.now().strftime('%H:%M:%S')}")
             
         except Exception as e:
             print(f"❌ Error in periodic notification thread: {e}")
             import traceback
             traceback.print_exc()
         
-        # Set next notification time
-        next_periodic_notification_time = time.time() + (NOTIFICATION_INTERVAL_MINUTES * 60)
-        interval_text = f"{NOTIFICATION_INTERVAL_MINUTES} minute{'s' if NOTIFICATION_INTERVAL_MINUTES != 1 else ''}"
-        print(f"\n⏰ Next notification scheduled in {interval_text} at {datetime.fromtimestamp(next_periodic_notification_time).strftime('%H:%M:%S')}")
-        print(f"💤 Sleeping for {interval_text}...\n")
-        
         # Wait before next notification
-        time.sleep(NOTIFICATION_INTERVAL_MINUTES * 60)
+        if wait_for_next_periodic_cycle(cycle_start, interval_seconds):
+            return
@@ -0,0 +1,149 @@
+"""WebSocket connection manager - batched history frames with per-client type filters
+
+Every history frame carries a resume token: the history sequence number that
+follows the newest event it covers. A client that reconnects sends its last token
+and gets only the events it missed; sequence numbers are unique per event, so
+events sharing a timestamp are neither dropped nor replayed twice. On shutdown each client gets the token plus a randomized reconnect
+delay, so a restart doesn't turn into a reconnect storm.
+"""
+import asyncio
+import json
+import random
+from typing import Dict, List
+
+from fastapi import WebSocket
+
+# History events published within this window are sent as one frame
+BATCH_WINDOW_SECONDS = 0.05
+
+# A client that can't take a frame within this time is dropped
+SEND_TIMEOUT_SECONDS = 5
+
+# Clients told to reconnect after a restart spread their reconnects over this window
+RECONNECT_SPREAD_MS = (2000, 15000)
+
+# WebSocket close code for "service restart" (RFC 6455)
+CLOSE_SERVICE_RESTART = 1012
+
+
+def resume_token(next_seq):
+    return next_seq
+
+
+def parse_resume_token(token):
+    """Sequence number of a resume token, None if it isn't valid"""
+    if isinstance(token, bool) or not isinstance(token, int) or token < 0:
+        return None
+    return token
+
+
+class ConnectionManager:
+    def __init__(self, batch_window: float = BATCH_WINDOW_SECONDS):
+        self.active_connections: List[WebSocket] = []
+        # Event types each client opted out of
+        self.filters: Dict[WebSocket, frozenset] = {}
+        self.batch_window = batch_window
+        self.pending_events = []
+        self.flush_task = None
+
+    async def connect(self, websocket: WebSocket):
+        await websocket.accept()
+        self.active_connections.append(websocket)
+        print(f"🔌 Cliente conectado. Total: {len(self.active_connections)}")
+
+    def disconnect(self, websocket: WebSocket):
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+        self.filters.pop(websocket, None)
+        print(f"🔌 Cliente desconectado. Quedan: {len(self.active_connections)}")
+
+    def set_filter(self, websocket: WebSocket, exclude_types):
+        """Stop sending these history event types to one client"""
+        self.filters[websocket] = frozenset(exclude_types or ())
+
+    async def publish_event(self, event: dict):
+        """Queue a history event; events within the batch window share one frame"""
+        self.pending_events.append(event)
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.batch_window)
+        await self.flush()
+
+    async def flush(self):
+        """Send queued history events as one `history_batch` frame per client"""
+        events, self.pending_events = self.pending_events, []
+        self.flush_task = None
+        if not events:
+            return
+
+        # Encode once per distinct filter instead of once per client
+        frames = {}
+        targets = []
+        for connection in self.active_connections:
+            exclude = self.filters.get(connection, frozenset())
+            if exclude not in frames:
+                visible = [event for event in events if event.get("type") not in exclude]
+                frames[exclude] = json.dumps({
+                    "type": "history_batch",
+                    "events": visible,
+                    "resume_token": resume_token(events[-1]["seq"] + 1)
+                }) if visible else None
+            if frames[exclude] is not None:
+                targets.append((connection, frames[exclude]))
+
+        await self._send_all(targets)
+
+    async def broadcast(self, message: dict):
+        """Send a control message to every client, after any queued events"""
+        await self.flush()
+        text = json.dumps(message)
+        await self._send_all([(connection, text) for connection in self.active_connections])
+
+    async def send_replay(self, websocket: WebSocket, events, token):
+        """Send missed events to one reconnecting client (filtered like live frames)"""
+        exclude = self.filters.get(websocket, frozenset())
+        visible = [event for event in events if event.get("type") not in exclude]
+        await self._send_all([(websocket, json.dumps({
+            "type": "history_batch",
+            "events": visible,
+            "resume_token": token,
+            "replay": True
+        }))])
+
+    async def drain(self, token):
+        """Flush queued events, hand every client its resume token and close with 1012"""
+        await self.flush()
+        connections = list(self.active_connections)
+        await self._send_all([
+            (connection, json.dumps({
+                "type": "server_draining",
+                "resume_token": token,
+                "reconnect_in_ms": random.randint(*RECONNECT_SPREAD_MS)
+            }))
+            for connection in connections
+        ])
+        for connection in connections:
+            try:
+                await connection.close(code=CLOSE_SERVICE_RESTART)
+            except Exception:
+                pass
+        print(f"🔌 Drained {len(connections)} WebSocket client(s)")
+
+    async def _send_all(self, targets):
+        async def send(connection, text):
+            try:
+                await asyncio.wait_for(connection.send_text(text), SEND_TIMEOUT_SECONDS)
+                return None
+            except Exception:
+                return connection
+
+        # Send concurrently so one slow client doesn't delay the rest
+        results = await asyncio.gather(*(send(connection, text) for connection, text in targets))
+
+        # Remove disconnected connections
+        for conn in results:
+            if conn is not None and conn in self.active_connections:
+                self.active_connections.remove(conn)
+                self.filters.pop(conn, None)
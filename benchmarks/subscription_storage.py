@@ -0,0 +1,88 @@
+"""
+Benchmark: memory per subscription and snapshot load time, dicts + JSON vs compact records + binary
+
+Run from the project root:
+    python benchmarks/subscription_storage.py [count]
+"""
+import base64
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from back_modules import compact_store  # noqa: E402
+
+PUSH_ORIGINS = [
+    "https://fcm.googleapis.com",
+    "https://updates.push.services.mozilla.com",
+    "https://web.push.apple.com",
+    "https://wns2-db5p.notify.windows.com",
+]
+
+
+def b64(size):
+    return base64.urlsafe_b64encode(os.urandom(size)).decode("ascii").rstrip("=")
+
+
+def make_subscription(i):
+    """A subscription dict shaped like PushSubscription.model_dump()"""
+    return {
+        "endpoint": f"{PUSH_ORIGINS[i % len(PUSH_ORIGINS)]}/fcm/send/{b64(105)}",
+        "keys": {"p256dh": b64(65), "auth": b64(16)},
+        "device_fingerprint": os.urandom(32).hex(),
+        "timezone": "Europe/Madrid",
+        "quiet_start": None,
+        "quiet_end": None,
+    }
+
+
+def measure_memory(build):
+    gc.collect()
+    tracemalloc.start()
+    data = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return data, current
+
+
+def best_of(runs, func):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    print(f"📊 {count:,} synthetic WebPush subscriptions\n")
+
+    source = [make_subscription(i) for i in range(count)]
+    json_text = json.dumps(source)
+
+    binary = compact_store.encode_webpush([compact_store.WebPushRecord.from_dict(d) for d in source])
+    del source
+
+    # Both measured as loaded from their snapshot, with nothing else alive sharing their strings
+    dicts, dict_bytes = measure_memory(lambda: json.loads(json_text))
+    del dicts
+    records, record_bytes = measure_memory(lambda: compact_store.decode_webpush(binary))
+    del records
+
+    json_load = best_of(3, lambda: json.loads(json_text))
+    binary_load = best_of(3, lambda: compact_store.decode_webpush(binary))
+
+    print(f"{'':<22}{'dict + JSON':>14}{'records + binary':>20}")
+    print(f"{'memory / subscription':<22}{dict_bytes / count:>12.0f} B{record_bytes / count:>18.0f} B")
+    print(f"{'snapshot size':<22}{len(json_text) / 1e6:>11.1f} MB{len(binary) / 1e6:>17.1f} MB")
+    print(f"{'snapshot load':<22}{json_load * 1000:>11.0f} ms{binary_load * 1000:>17.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
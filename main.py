@@ -2,73 +2,187 @@
 PWA POC - Main Application
 Clean main file with modular push notification handlers
 """
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+import time
+_import_started = time.perf_counter()
+
+from fastapi import FastAPI, Header, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 import os
 import json
 from pathlib import Path
 import logging
-from typing import List
+from typing import List, Optional
+from contextlib import asynccontextmanager
+import asyncio
+import signal
 import threading
-import time
 from datetime import datetime
+from collections import deque
+
+# Environment before back_modules: their settings (PUSH_CHANNELS, limits, SHARD_*...)
+# are read from os.environ when they are imported
+_env_started = time.perf_counter()
+load_dotenv()
+_env_seconds = time.perf_counter() - _env_started
 
-# Import push notification modules
-from back_modules import webpush_handler, fcm_handler
+# Import push notification modules (channel SDKs are imported lazily on first use)
+from back_modules import webpush_handler, fcm_handler, janitor, startup, assets, storage, shared_state, receipts, export, sharding
+from back_modules.admission import BlastAdmission
+from back_modules.rate_limit import RateLimiter, RateLimitMiddleware
+from back_modules import loop_monitor
+from back_modules.job_scheduler import JobScheduler, ScheduledNotification
+from back_modules.websocket_manager import ConnectionManager, resume_token, parse_resume_token
+from back_modules.history_index import HistoryIndex
 
 # App version
 APP_VERSION = "1.0.22"
 
-# Load environment variables
-load_dotenv()
+# Wall-clock start (uptime in /api/health)
+server_started_at = time.time()
+
+# Seconds a restart waits for running blasts and worker checkpoints
+DRAIN_TIMEOUT_SECONDS = int(os.getenv("DRAIN_TIMEOUT_SECONDS", "30"))
+
+# Missed events replayed to a reconnecting WebSocket (more than this: client reloads)
+MAX_RESUME_EVENTS = 500
+
+# Startup timing (imports measured from the top of this file)
+startup_report = startup.StartupReport(started_at=_import_started)
+startup_report.record("imports", time.perf_counter() - _import_started - _env_seconds)
+startup_report.record("load_env", _env_seconds)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load data stores and initialize enabled push channels"""
+    global history, background_activity
+    
+    # Worker threads schedule WebSocket broadcasts on this loop
+    shared_state.set_main_loop(asyncio.get_running_loop())
+    
+    # SIGTERM / Ctrl+C drain sends and WebSocket clients before the server closes connections
+    install_drain_signal_handlers(asyncio.get_running_loop())
+    
+    # Opt-in (DIAGNOSTICS_MODE=1): loop lag and slow-callback stacks
+    if loop_monitor.DIAGNOSTICS_MODE:
+        loop_monitor.monitor.start()
+    
+    with startup_report.phase("load_history"):
+        history = load_history()
+        history_index.rebuild(history, load_history_seq())
+    
+    with startup_report.phase("load_activity"):
+        background_activity = load_background_activity()
+    
+    with startup_report.phase("load_assets"):
+        load_assets()
+    
+    with startup_report.phase("load_receipts"):
+        receipts.load_receipts()
+        threading.Thread(target=receipts.run_flusher, daemon=True).start()
+    
+    with startup_report.phase("load_scheduled_jobs"):
+        scheduled_jobs.load()
+        threading.Thread(
+            target=scheduled_jobs.run, args=(add_history_event, broadcast_history, blast_admission), daemon=True
+        ).start()
+    
+    if startup.channel_enabled("webpush"):
+        with startup_report.phase("load_webpush"):
+            webpush_handler.init_subscriptions()
+    
+    if startup.channel_enabled("fcm"):
+        with startup_report.phase("load_fcm"):
+            fcm_handler.init_fcm_tokens()
+        with startup_report.phase("init_firebase"):
+            fcm_handler.get_messaging()
+    
+    # Opt-in (SHARD_WORKERS / SHARD_LOCAL_WORKERS): subscriptions live in shard workers
+    if sharding.SHARD_WORKERS or sharding.SHARD_LOCAL_WORKERS:
+        with startup_report.phase("start_shards"):
+            await asyncio.to_thread(sharding.start_coordinator)
+            await asyncio.to_thread(migrate_subscriptions_to_shards)
+    
+    # Prunes subscriptions of devices without recent heartbeats (needs the stores loaded above)
+    threading.Thread(
+        target=janitor.run_janitor,
+        args=(get_background_activity, add_history_event, broadcast_history),
+        daemon=True,
+        name="subscription-janitor"
+    ).start()
+    print(f"🧹 Janitor started (inactive after {janitor.INACTIVE_DEVICE_HOURS}h)")
+    
+    print(f"📡 Push channels: {', '.join(sorted(startup.PUSH_CHANNELS)) or 'none'}")
+    startup_report.print_report()
+    yield
+    
+    loop_monitor.monitor.stop()
+    
+    # Let workers finish or checkpoint their current delivery (off the loop: they may need it)
+    # (already begun when the shutdown came from a signal)
+    await begin_drain()
+    await asyncio.to_thread(scheduled_jobs.stop, DRAIN_TIMEOUT_SECONDS)
+    await asyncio.to_thread(shared_state.join_workers, DRAIN_TIMEOUT_SECONDS)
+    
+    # Compact journals into fresh snapshots so the next start has nothing to replay
+    print("💾 Writing snapshots before shutdown...")
+    receipts.flush()
+    scheduled_jobs.snapshot()
+    with history_lock:
+        save_history(history)
+    with activity_lock:
+        save_background_activity(background_activity)
+    if startup.channel_enabled("webpush"):
+        with webpush_handler.subscriptions_lock:
+            webpush_handler.save_subscriptions(webpush_handler.subscriptions)
+    if startup.channel_enabled("fcm"):
+        with fcm_handler.fcm_tokens_lock:
+            fcm_handler.save_fcm_tokens(fcm_handler.fcm_tokens)
+    # Shards snapshot their own stores; local worker processes are stopped
+    await asyncio.to_thread(sharding.stop_coordinator)
 
-# Initialize Firebase
-fcm_handler.init_firebase()
 
 # Initialize FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
-# Serve static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Per-IP / per-fingerprint token buckets for the unauthenticated write endpoints
+rate_limiter = RateLimiter()
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
+
+# App shell and static files are served from memory (see load_assets)
+asset_cache = assets.AssetCache()
 
 # Data files
 HISTORY_FILE = Path("data/history.json")
 BACKGROUND_ACTIVITY_FILE = Path("data/background_activity.json")
+# Next history sequence number, kept when history is cleared (resume tokens must never be reused)
+HISTORY_SEQ_FILE = Path("data/history_seq.json")
 
+# Maximum number of events kept in history (filtered queries use indexes, so this can grow)
+HISTORY_MAX_EVENTS = int(os.getenv("HISTORY_MAX_EVENTS", "1000"))
+# The oldest events are dropped in batches of this size, so appends stay O(1) amortized
+HISTORY_TRIM_BATCH = max(1, HISTORY_MAX_EVENTS // 10)
 
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        print(f"🔌 Cliente conectado. Total: {len(self.active_connections)}")
+# Snapshot + journal stores (mutations are appended, snapshots are written atomically)
+history_store = storage.JournaledStore(
+    HISTORY_FILE, storage.apply_capped_list_op(HISTORY_MAX_EVENTS, HISTORY_TRIM_BATCH), name="history"
+)
+# Heartbeats are frequent liveness data appended on the event loop: skip the per-append fsync
+background_activity_store = storage.JournaledStore(
+    BACKGROUND_ACTIVITY_FILE, storage.apply_dict_op, empty=dict, name="background activity", fsync=False
+)
 
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        print(f"🔌 Cliente desconectado. Quedan: {len(self.active_connections)}")
 
-    async def broadcast(self, message: dict):
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception:
-                disconnected.append(connection)
-        
-        # Remove disconnected connections
-        for conn in disconnected:
-            if conn in self.active_connections:
-                self.active_connections.remove(conn)
+# WebSocket connection manager (batched frames, per-client filters)
+manager = ConnectionManager()
 
+# Concurrency cap, queue limit and idempotency keys for manual blasts
+blast_admission = BlastAdmission()
 
-manager = ConnectionManager()
+# Durable one-shot / recurring notifications (loaded and started in the lifespan)
+scheduled_jobs = JobScheduler()
 
 
 # Data models
@@ -80,45 +194,58 @@ class TestResponse(BaseModel):
     data: str
 
 
+class DeliveryReceipt(BaseModel):
+    message_id: str = Field(max_length=64)
+    event: str = Field(max_length=16)  # "received" | "clicked"
+    at: Optional[float] = None  # Client time (ms since epoch)
+
+
+class ReceiptBatch(BaseModel):
+    # Sending device: rate limited by the middleware, and every receipt is deduped per device
+    fingerprint: str = Field(min_length=1, max_length=256)
+    receipts: List[DeliveryReceipt] = Field(max_length=receipts.MAX_RECEIPTS_PER_BATCH)
+
+
 # Helper functions
 def load_history():
-    """Load history from JSON file"""
-    if HISTORY_FILE.exists():
-        try:
-            with open(HISTORY_FILE, "r") as f:
-                content = f.read().strip()
-                if content:
-                    return json.loads(content)
-        except (json.JSONDecodeError, Exception) as e:
-            print(f"⚠️ Error loading history: {e}. Starting with empty list.")
-    return []
+    """Load history from snapshot + journal"""
+    return history_store.load()
+
+
+def load_history_seq():
+    """Next sequence number saved when history was last cleared (0 if never)"""
+    if not HISTORY_SEQ_FILE.exists():
+        return 0
+    try:
+        return int(json.loads(HISTORY_SEQ_FILE.read_text(encoding="utf-8"))["next_seq"])
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        print(f"⚠️ Ignoring history sequence file: {e}")
+        return 0
+
+
+def save_history_seq(next_seq):
+    storage.atomic_write_text(HISTORY_SEQ_FILE, json.dumps({"next_seq": next_seq}))
 
 
 def save_history(history_data):
-    """Save history to JSON file"""
-    HISTORY_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(HISTORY_FILE, "w") as f:
-        json.dump(history_data, f, indent=2)
+    """Write a full history snapshot (atomic) and reset the journal"""
+    history_store.snapshot(history_data)
 
 
 def load_background_activity():
-    """Load background activity log from JSON file"""
-    if BACKGROUND_ACTIVITY_FILE.exists():
-        try:
-            with open(BACKGROUND_ACTIVITY_FILE, "r") as f:
-                content = f.read().strip()
-                if content:
-                    return json.loads(content)
-        except (json.JSONDecodeError, Exception) as e:
-            print(f"⚠️ Error loading background activity: {e}. Starting with empty dict.")
-    return {}
+    """Load background activity log from snapshot + journal"""
+    return background_activity_store.load()
 
 
 def save_background_activity(activity_log):
-    """Save background activity log to JSON file"""
-    BACKGROUND_ACTIVITY_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with open(BACKGROUND_ACTIVITY_FILE, "w") as f:
-        json.dump(activity_log, f, indent=2)
+    """Write a full background activity snapshot (atomic) and reset the journal"""
+    background_activity_store.snapshot(activity_log)
+
+
+def get_background_activity():
+    """Return a copy of the in-memory background activity log (safe to iterate from threads)"""
+    with activity_lock:
+        return dict(background_activity)
 
 
 def add_history_event(event_type: str, message: str, details: dict = None):
@@ -126,56 +253,102 @@ def add_history_event(event_type: str, message: str, details: dict = None):
     event = {
         "type": event_type,
         "message": message,
-        "details": details or {},
-        "timestamp": time.time()
+        "details": details or {}
     }
     print(f"🔵 Adding event to history: {event_type} - {message}")
-    history.append(event)
-    # Keep only last 1000 events
-    if len(history) > 1000:
-        history.pop(0)
-    save_history(history)
-    print(f"💾 History saved. Total events: {len(history)}")
+    # Called from request handlers and worker threads
+    with history_lock:
+        # Stamped under the lock: timestamps stay in append order (time range queries bisect them)
+        event["timestamp"] = time.time()
+        history.append(event)
+        history_index.add(event)
+        # Keep the last HISTORY_MAX_EVENTS events, trimming the head in batches
+        if len(history) > HISTORY_MAX_EVENTS + HISTORY_TRIM_BATCH:
+            evicted = history[:len(history) - HISTORY_MAX_EVENTS]
+            del history[:len(evicted)]
+            for old_event in evicted:
+                history_index.evict(old_event)
+        history_store.append({"op": "append", "item": event}, history)
+        unbroadcast_events.append(event)
+        total = len(history)
+    print(f"💾 History saved. Total events: {total}")
     return event
 
 
 async def broadcast_history():
-    """Broadcast only the latest event to all connected clients (not entire history)"""
-    if history:
-        latest_event = history[-1]  # Get last event only
-        await manager.broadcast({
-            "type": "history_update", 
-            "event": latest_event  # Single event, not entire array
-        })
-    else:
-        await manager.broadcast({
-            "type": "history_update",
-            "event": None
-        })
-
-
-# Load data on startup
-history = load_history()
+    """Publish events added since the last broadcast (batched into one frame per window)"""
+    with history_lock:
+        events = list(unbroadcast_events)
+        unbroadcast_events.clear()
+    for event in events:
+        await manager.publish_event(event)
+
+
+def load_assets():
+    """Load the app shell and static files into memory with ETags and compressed variants"""
+    asset_cache.add_file("/", "templates/index.html", media_type="text/html")
+    asset_cache.add_file("/manifest.json", "static/manifest.json", media_type="application/manifest+json")
+    asset_cache.add_file("/sw.js", "static/sw.js", media_type="application/javascript")
+    asset_cache.add_directory("/static", "static")
+    print(f"📦 Loaded {len(asset_cache.assets)} assets ({asset_cache.total_bytes() / 1024:.0f} KB with compressed variants)")
+
+
+def migrate_subscriptions_to_shards():
+    """Hand subscriptions stored by this process (pre-sharding) to their shards, once"""
+    with webpush_handler.subscriptions_lock:
+        if webpush_handler.subscriptions:
+            moved = sharding.coordinator.import_records("webpush", webpush_handler.subscriptions)
+            webpush_handler.subscriptions = []
+            webpush_handler.save_subscriptions([])
+            print(f"🧩 Moved {moved} local subscription(s) to the shards")
+    with fcm_handler.fcm_tokens_lock:
+        if fcm_handler.fcm_tokens:
+            moved = sharding.coordinator.import_records("fcm", fcm_handler.fcm_tokens)
+            fcm_handler.fcm_tokens = []
+            fcm_handler.save_fcm_tokens([])
+            print(f"🧩 Moved {moved} local FCM token(s) to the shards")
+
+
+def require_channel(channel: str):
+    """Reject requests for a push channel disabled in PUSH_CHANNELS"""
+    if not startup.channel_enabled(channel):
+        raise HTTPException(status_code=503, detail=f"Push channel '{channel}' is disabled")
+
+
+# Loaded on startup (see lifespan). Mutated from the event loop and worker
+# threads, so every access goes through its lock (see back_modules/shared_state.py)
+history = []
+history_lock = threading.RLock()
+# Type / device / time indexes over history, updated under history_lock
+history_index = HistoryIndex()
+# Events added but not yet sent over the WebSocket (drained by broadcast_history)
+unbroadcast_events = deque(maxlen=HISTORY_MAX_EVENTS)
+background_activity = {}
+activity_lock = threading.RLock()
 
 
 # ============================================================================
 # COMMON ROUTES
 # ============================================================================
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    with open("templates/index.html", "r", encoding="utf-8") as f:
-        return f.read()
+@app.api_route("/", methods=["GET", "HEAD"])
+async def root(request: Request):
+    return asset_cache.response(request, "/")
+
 
+@app.api_route("/manifest.json", methods=["GET", "HEAD"])
+async def manifest(request: Request):
+    return asset_cache.response(request, "/manifest.json")
 
-@app.get("/manifest.json")
-async def manifest():
-    return FileResponse("static/manifest.json")
 
+@app.api_route("/sw.js", methods=["GET", "HEAD"])
+async def service_worker(request: Request):
+    return asset_cache.response(request, "/sw.js")
 
-@app.get("/sw.js")
-async def service_worker():
-    return FileResponse("static/sw.js", media_type="application/javascript")
+
+@app.api_route("/static/{file_path:path}", methods=["GET", "HEAD"])
+async def static_file(request: Request, file_path: str):
+    return asset_cache.response(request, f"/static/{file_path}")
 
 
 @app.get("/api/version")
@@ -184,6 +357,61 @@ async def get_version():
     return {"version": APP_VERSION}
 
 
+@app.get("/api/startup-report")
+async def get_startup_report():
+    """Return how long each startup phase took (ms)"""
+    return startup_report.as_dict()
+
+
+@app.get("/api/admission")
+async def get_admission_stats():
+    """Blast admission counters (running / waiting / rejected / replayed)"""
+    return blast_admission.stats()
+
+
+@app.get("/api/rate-limits")
+async def get_rate_limit_stats():
+    """Rate limiter counters (allowed / limited per key type and route, tracked buckets)"""
+    return rate_limiter.stats()
+
+
+@app.get("/api/shards")
+async def get_shard_stats():
+    """Shard workers with their record counts (empty when subscriptions aren't sharded)"""
+    if not sharding.coordinator:
+        return {"enabled": False, "shards": {}}
+    return {"enabled": True, "shards": await asyncio.to_thread(sharding.coordinator.stats)}
+
+
+@app.get("/api/health")
+async def get_health():
+    """Backend health for the diagnostics panel (loop lag needs DIAGNOSTICS_MODE=1)"""
+    with history_lock:
+        history_events = len(history)
+    return {
+        "status": "draining" if blast_admission.draining else "ok",
+        "version": APP_VERSION,
+        "uptime_seconds": int(time.time() - server_started_at),
+        "event_loop": loop_monitor.monitor.stats(),
+        "websocket_clients": len(manager.active_connections),
+        "threads": threading.active_count(),
+        "history_events": history_events,
+        "webpush_subscriptions": await webpush_handler.subscription_total(),
+        "fcm_tokens": await fcm_handler.fcm_token_total(),
+        "blasts_running": blast_admission.running,
+    }
+
+
+@app.get("/debug/profile")
+async def debug_profile(seconds: float = 5):
+    """Sample all threads for N seconds, collapsed stacks (flamegraph.pl / speedscope input)"""
+    if not loop_monitor.DIAGNOSTICS_MODE:
+        raise HTTPException(status_code=404, detail="Diagnostics mode is off (DIAGNOSTICS_MODE=1)")
+    # Sampled from a worker thread so the event loop itself shows up in the profile
+    stacks = await asyncio.to_thread(loop_monitor.profile, seconds)
+    return PlainTextResponse(stacks)
+
+
 @app.get("/api/vapid-public-key")
 async def get_vapid_public_key():
     """Return the VAPID public key for push subscription"""
@@ -197,25 +425,102 @@ async def get_vapid_public_key():
 # WEBSOCKET
 # ============================================================================
 
+def latest_resume_token():
+    """Resume token covering every event in history (the next sequence number)"""
+    with history_lock:
+        return resume_token(history_index.next_seq)
+
+
+def missed_events(token):
+    """Events from the sequence in token on, or None when the client must reload history
+
+    (unknown token, events already evicted, or more than MAX_RESUME_EVENTS missed)
+    """
+    start_seq = parse_resume_token(token)
+    with history_lock:
+        if start_seq is None or not history_index.base <= start_seq <= history_index.next_seq:
+            return None
+        if history_index.next_seq - start_seq > MAX_RESUME_EVENTS:
+            return None
+        events, _ = history_index.read(history, start_seq, history_index.next_seq - start_seq)
+        return events
+
+
+async def resume_session(websocket: WebSocket, token):
+    """Replay the events a reconnecting client missed, or ask it to reload history"""
+    missed = missed_events(token)
+    if missed is None:
+        await websocket.send_json({"type": "resync", "resume_token": latest_resume_token()})
+        return
+    await manager.send_replay(websocket, missed, latest_resume_token())
+
+
+async def begin_drain():
+    """Stop admitting sends and hand WebSocket clients a resume token (before connections close)"""
+    if blast_admission.draining:
+        return
+    print("🚦 Draining: refusing new blasts, checkpointing workers...")
+    blast_admission.draining = True
+    shared_state.shutdown_event.set()
+    await manager.drain(latest_resume_token())
+
+
+def install_drain_signal_handlers(loop):
+    """Run begin_drain on SIGINT/SIGTERM before the server's own handler starts its shutdown
+
+    The server closes every connection before the lifespan shutdown runs, so WebSocket
+    clients could not be told to resume from there. Wraps the handlers the server
+    installed (uvicorn restores its originals on exit); a second signal is passed on
+    immediately, so Ctrl+C twice still forces the exit.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        server_handler = signal.getsignal(sig)
+        if not callable(server_handler):
+            continue
+        
+        def handler(signum, frame, server_handler=server_handler):
+            if blast_admission.draining:
+                server_handler(signum, frame)
+                return
+            drain = asyncio.run_coroutine_threadsafe(begin_drain(), loop)
+            drain.add_done_callback(lambda _: loop.call_soon_threadsafe(server_handler, signum, frame))
+        
+        signal.signal(sig, handler)
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    global history
-    
     await manager.connect(websocket)
     
-    # Reload history from file before sending (ensures fresh data)
-    history = load_history()
-    
     # Don't send initial history via WebSocket - frontend loads from API
     # This prevents sending large amounts of data on every reconnect
+    # The session token lets the client resume from here after a reconnect
+    await websocket.send_json({"type": "session", "resume_token": latest_resume_token()})
     
     try:
         while True:
             # Receive messages from client (if needed in future)
             data = await websocket.receive_text()
-            message = json.loads(data)
+            try:
+                message = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            # Valid JSON that isn't an object carries no command
+            if not isinstance(message, dict):
+                continue
             
-            # Future: could handle client-to-server messages here
+            # Client opts out of noisy event types: {"type": "subscribe_filter", "exclude": [...]}
+            if message.get("type") == "subscribe_filter":
+                exclude = message.get("exclude")
+                if not isinstance(exclude, list):
+                    exclude = []
+                manager.set_filter(websocket, [t for t in exclude if isinstance(t, str)])
+            
+            # Reconnected client asks for what it missed: {"type": "resume", "resume_token": "..."}
+            if message.get("type") == "resume":
+                await resume_session(websocket, message.get("resume_token"))
             
     except WebSocketDisconnect:
         pass  # Normal disconnect
@@ -230,15 +535,30 @@ async def websocket_endpoint(websocket: WebSocket):
 # ============================================================================
 
 @app.get("/api/history")
-async def get_history(page: int = 1, limit: int = 20):
-    """Get paginated history"""
-    total = len(history)
+async def get_history(
+    page: int = 1,
+    limit: int = 20,
+    type: Optional[str] = None,
+    fingerprint: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None
+):
+    """Get paginated history, optionally filtered by event type(s), device and time range
+
+    type accepts a comma-separated list; since/until are unix timestamps (inclusive).
+    """
+    if page < 1 or limit < 1:
+        raise HTTPException(status_code=400, detail="page and limit must be positive")
     start_idx = (page - 1) * limit
     end_idx = start_idx + limit
+    types = [t for t in type.split(",") if t] if type else None
     
     # Return events in reverse order (newest first) and paginate
-    reversed_history = list(reversed(history))
-    paginated_history = reversed_history[start_idx:end_idx]
+    with history_lock:
+        paginated_history, total = history_index.query(
+            history, types=types, fingerprint=fingerprint, since=since, until=until,
+            offset=start_idx, limit=limit
+        )
     
     return {
         "history": paginated_history,
@@ -254,8 +574,14 @@ async def clear_history():
     """Clear history and broadcast to all clients"""
     global history
     print("🗑️ Clearing history...")
-    history.clear()
-    save_history(history)
+    with history_lock:
+        history.clear()
+        history_index.clear()
+        unbroadcast_events.clear()
+        # Events no longer carry the sequence: without this it would restart at 0 and
+        # tokens handed out before the clear would match the new events
+        save_history_seq(history_index.next_seq)
+        save_history(history)
     print(f"📡 Broadcasting clear to {len(manager.active_connections)} clients...")
     # Broadcast clear signal to all clients
     await manager.broadcast({'type': 'history_clear'})
@@ -295,22 +621,21 @@ async def test_endpoint(request: TestRequest):
 async def heartbeat(request: TestRequest):
     """Register background activity from Service Worker"""
     try:
-        activity_log = load_background_activity()
-        
         fingerprint = request.fingerprint or "unknown"
         current_time = time.time()
         
-        activity_log[fingerprint] = {
+        activity = {
             "last_activity": current_time,
             "timestamp": datetime.fromtimestamp(current_time).strftime('%Y-%m-%d %H:%M:%S')
         }
-        
-        save_background_activity(activity_log)
+        with activity_lock:
+            background_activity[fingerprint] = activity
+            background_activity_store.append({"op": "set", "key": fingerprint, "value": activity}, background_activity)
         
         return {
             "status": "ok",
             "fingerprint": fingerprint,
-            "registered_at": activity_log[fingerprint]["timestamp"]
+            "registered_at": activity["timestamp"]
         }
     except Exception as e:
         print(f"❌ Error in heartbeat: {e}")
@@ -321,9 +646,10 @@ async def heartbeat(request: TestRequest):
 async def get_activity(fingerprint: str):
     """Get last activity time for a fingerprint"""
     try:
-        activity_log = load_background_activity()
+        with activity_lock:
+            activity = background_activity.get(fingerprint)
         
-        if fingerprint not in activity_log:
+        if activity is None:
             return {
                 "fingerprint": fingerprint,
                 "last_activity": None,
@@ -331,7 +657,7 @@ async def get_activity(fingerprint: str):
                 "status": "never_seen"
             }
         
-        last_activity = activity_log[fingerprint]["last_activity"]
+        last_activity = activity["last_activity"]
         current_time = time.time()
         minutes_ago = (current_time - last_activity) / 60
         
@@ -345,7 +671,7 @@ async def get_activity(fingerprint: str):
         
         return {
             "fingerprint": fingerprint,
-            "last_activity": activity_log[fingerprint]["timestamp"],
+            "last_activity": activity["timestamp"],
             "seconds_ago": int(current_time - last_activity),
             "minutes_ago": round(minutes_ago, 1),
             "status": status
@@ -354,16 +680,37 @@ async def get_activity(fingerprint: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def upcoming_entry(kind, run_at, title, job_id=None, recurring=False):
+    return {
+        "kind": kind,
+        "id": job_id,
+        "title": title,
+        "run_at": run_at,
+        "seconds_remaining": max(0, int(run_at - time.time())),
+        "next_notification_at": datetime.fromtimestamp(run_at).strftime('%Y-%m-%d %H:%M:%S'),
+        "recurring": recurring
+    }
+
+
 @app.get("/api/next-notification")
-async def get_next_notification():
-    """Get time until next periodic notification"""
+async def get_next_notification(limit: int = 10):
+    """Get time until next periodic notification, plus the upcoming scheduled jobs"""
     from back_modules.webpush_handler import next_periodic_notification_time
     
+    upcoming = [
+        upcoming_entry("scheduled", job["next_run_at"], job["title"], job["id"], bool(job["interval_seconds"]))
+        for job in scheduled_jobs.upcoming(limit)
+    ]
+    if next_periodic_notification_time is not None:
+        upcoming.append(upcoming_entry("periodic", next_periodic_notification_time, "Notificación periódica", recurring=True))
+    upcoming = sorted(upcoming, key=lambda entry: entry["run_at"])[:limit]
+    
     if next_periodic_notification_time is None:
         return {
             "status": "unknown",
             "seconds_remaining": None,
-            "next_notification_at": None
+            "next_notification_at": None,
+            "upcoming": upcoming
         }
     
     current_time = time.time()
@@ -376,10 +723,162 @@ async def get_next_notification():
     return {
         "status": "scheduled",
         "seconds_remaining": seconds_remaining,
-        "next_notification_at": datetime.fromtimestamp(next_periodic_notification_time).strftime('%Y-%m-%d %H:%M:%S')
+        "next_notification_at": datetime.fromtimestamp(next_periodic_notification_time).strftime('%Y-%m-%d %H:%M:%S'),
+        "upcoming": upcoming
     }
 
 
+# ============================================================================
+# SCHEDULED NOTIFICATIONS
+# ============================================================================
+
+@app.post("/api/scheduled-notifications", status_code=201)
+async def create_scheduled_notification(request: ScheduledNotification):
+    """Schedule a one-shot (run_at / delay_seconds) or recurring (interval_seconds) notification"""
+    job = scheduled_jobs.add(request)
+    print(f"🗓️ Scheduled job {job['id']} at {datetime.fromtimestamp(job['next_run_at']).strftime('%Y-%m-%d %H:%M:%S')}")
+    return job
+
+
+@app.get("/api/scheduled-notifications")
+async def list_scheduled_notifications(limit: int = 50):
+    """Pending jobs, soonest first"""
+    return {"total": len(scheduled_jobs), "jobs": scheduled_jobs.upcoming(limit)}
+
+
+@app.get("/api/scheduled-notifications/{job_id}")
+async def get_scheduled_notification(job_id: str):
+    job = scheduled_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return job
+
+
+@app.delete("/api/scheduled-notifications/{job_id}")
+async def cancel_scheduled_notification(job_id: str):
+    if not scheduled_jobs.cancel(job_id):
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return {"status": "cancelled", "id": job_id}
+
+
+# ============================================================================
+# DELIVERY RECEIPTS (reported by the Service Worker)
+# ============================================================================
+
+@app.post("/api/receipts", status_code=202)
+async def post_receipts(batch: ReceiptBatch):
+    """Buffer a batch of push received / notification click receipts (no disk I/O)"""
+    if not receipts.ingest([dict(receipt.model_dump(), fingerprint=batch.fingerprint) for receipt in batch.receipts]):
+        raise HTTPException(status_code=503, detail="Receipt buffer full", headers={"Retry-After": "5"})
+    return {"accepted": len(batch.receipts)}
+
+
+@app.get("/api/receipts")
+async def list_receipts(limit: int = 20):
+    """Delivery stats of the most recent messages"""
+    return {"messages": receipts.list_message_stats(limit)}
+
+
+@app.get("/api/receipts/{message_id}")
+async def get_receipts(message_id: str):
+    """Delivery / click counts and latency percentiles for one message"""
+    stats = receipts.get_message_stats(message_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Unknown message id")
+    return stats
+
+
+# ============================================================================
+# EXPORT (streaming NDJSON / CSV, gzip when accepted)
+# ============================================================================
+
+# History events copied per lock acquisition while streaming
+EXPORT_HISTORY_CHUNK = 500
+
+HISTORY_EXPORT_COLUMNS = ["timestamp", "time", "type", "message", "details"]
+SUBSCRIPTION_EXPORT_COLUMNS = ["device_fingerprint", "endpoint", "timezone", "quiet_start", "quiet_end", "last_activity"]
+FCM_TOKEN_EXPORT_COLUMNS = ["device_fingerprint", "token", "timezone", "quiet_start", "quiet_end", "last_activity"]
+ACTIVITY_EXPORT_COLUMNS = ["fingerprint", "last_activity", "timestamp"]
+
+
+def in_time_range(value, since, until):
+    if since is None and until is None:
+        return True
+    if value is None:
+        return False
+    return (since is None or value >= since) and (until is None or value <= until)
+
+
+def iter_history_rows(since=None, until=None):
+    """History events in a time range, oldest first, copied a chunk at a time"""
+    with history_lock:
+        cursor, high = history_index.seq_window(history, since, until)
+    while cursor < high:
+        with history_lock:
+            events, cursor = history_index.read(history, cursor, min(EXPORT_HISTORY_CHUNK, high - cursor))
+        if not events:
+            break
+        for event in events:
+            yield {
+                "timestamp": event["timestamp"],
+                "time": datetime.fromtimestamp(event["timestamp"]).strftime('%Y-%m-%d %H:%M:%S'),
+                "type": event["type"],
+                "message": event["message"],
+                "details": event.get("details", {}),
+            }
+
+
+def last_activity_of(fingerprint):
+    with activity_lock:
+        activity = background_activity.get(fingerprint)
+    return activity["last_activity"] if activity else None
+
+
+def iter_device_rows(records, columns, since=None, until=None):
+    """Rows for subscription records; the time range applies to the device's last activity"""
+    for record in records:
+        last_activity = last_activity_of(record.device_fingerprint)
+        if not in_time_range(last_activity, since, until):
+            continue
+        row = {column: getattr(record, column) for column in columns if column != "last_activity"}
+        row["last_activity"] = last_activity
+        yield row
+
+
+def iter_activity_rows(since=None, until=None):
+    for fingerprint, activity in get_background_activity().items():
+        if in_time_range(activity.get("last_activity"), since, until):
+            yield {"fingerprint": fingerprint, **activity}
+
+
+@app.get("/api/export/history")
+async def export_history(request: Request, format: str = "ndjson", since: Optional[float] = None, until: Optional[float] = None):
+    """Stream history events (oldest first); since/until are unix timestamps"""
+    return export.stream_response(request, iter_history_rows(since, until), HISTORY_EXPORT_COLUMNS, format, "history")
+
+
+@app.get("/api/export/subscriptions")
+async def export_subscriptions(request: Request, format: str = "ndjson", since: Optional[float] = None, until: Optional[float] = None):
+    """Stream WebPush subscriptions (without encryption keys), filtered by last activity"""
+    # Copy-on-write list: iterating this snapshot needs no lock and no copy (sharded: one shard at a time)
+    records = sharding.coordinator.records("webpush") if sharding.coordinator else webpush_handler.subscriptions
+    rows = iter_device_rows(records, SUBSCRIPTION_EXPORT_COLUMNS, since, until)
+    return export.stream_response(request, rows, SUBSCRIPTION_EXPORT_COLUMNS, format, "subscriptions")
+
+
+@app.get("/api/export/fcm-tokens")
+async def export_fcm_tokens(request: Request, format: str = "ndjson", since: Optional[float] = None, until: Optional[float] = None):
+    """Stream FCM tokens, filtered by last activity"""
+    records = sharding.coordinator.records("fcm") if sharding.coordinator else fcm_handler.fcm_tokens
+    rows = iter_device_rows(records, FCM_TOKEN_EXPORT_COLUMNS, since, until)
+    return export.stream_response(request, rows, FCM_TOKEN_EXPORT_COLUMNS, format, "fcm_tokens")
+
+
+@app.get("/api/export/activity")
+async def export_activity(request: Request, format: str = "ndjson", since: Optional[float] = None, until: Optional[float] = None):
+    """Stream the background activity log, filtered by last activity"""
+    return export.stream_response(request, iter_activity_rows(since, until), ACTIVITY_EXPORT_COLUMNS, format, "activity")
+
 
 # ============================================================================
 # WEBPUSH ROUTES (from webpush_handler module)
@@ -388,11 +887,13 @@ async def get_next_notification():
 # Mount WebPush routes with history callbacks
 @app.post("/api/subscribe")
 async def subscribe_route(subscription: webpush_handler.PushSubscription):
+    require_channel("webpush")
     return await webpush_handler.subscribe(subscription, add_history_event, broadcast_history)
 
 
 @app.post("/api/unsubscribe")
 async def unsubscribe_route(subscription: webpush_handler.PushSubscription):
+    require_channel("webpush")
     return await webpush_handler.unsubscribe(subscription, add_history_event, broadcast_history)
 
 
@@ -403,12 +904,21 @@ async def check_subscription_route(fingerprint: str):
 
 @app.post("/api/clear-subscriptions")
 async def clear_subscriptions_route():
+    require_channel("webpush")
     return await webpush_handler.clear_subscriptions(add_history_event, broadcast_history)
 
 
 @app.post("/api/send-notification")
-async def send_notification_route(payload: webpush_handler.NotificationPayload):
-    return await webpush_handler.send_notification(payload, add_history_event, broadcast_history)
+async def send_notification_route(
+    payload: webpush_handler.NotificationPayload,
+    idempotency_key: Optional[str] = Header(None)
+):
+    require_channel("webpush")
+    return await blast_admission.run(
+        "webpush", payload.model_dump(),
+        lambda: webpush_handler.send_notification(payload, add_history_event, broadcast_history),
+        idempotency_key
+    )
 
 
 # ============================================================================
@@ -418,11 +928,13 @@ async def send_notification_route(payload: webpush_handler.NotificationPayload):
 # Mount FCM routes with history callbacks
 @app.post("/api/fcm/subscribe")
 async def fcm_subscribe_route(subscription: fcm_handler.FCMSubscription):
+    require_channel("fcm")
     return await fcm_handler.fcm_subscribe(subscription, add_history_event, broadcast_history)
 
 
 @app.post("/api/fcm/unsubscribe")
 async def fcm_unsubscribe_route(subscription: fcm_handler.FCMSubscription):
+    require_channel("fcm")
     return await fcm_handler.fcm_unsubscribe(subscription, add_history_event, broadcast_history)
 
 
@@ -433,12 +945,21 @@ async def fcm_check_subscription_route(fingerprint: str):
 
 @app.post("/api/fcm/clear-subscriptions")
 async def fcm_clear_subscriptions_route():
+    require_channel("fcm")
     return await fcm_handler.fcm_clear_subscriptions(add_history_event, broadcast_history)
 
 
 @app.post("/api/fcm/send")
-async def fcm_send_route(payload: fcm_handler.FCMNotificationPayload):
-    return await fcm_handler.fcm_send_notification(payload, add_history_event, broadcast_history)
+async def fcm_send_route(
+    payload: fcm_handler.FCMNotificationPayload,
+    idempotency_key: Optional[str] = Header(None)
+):
+    require_channel("fcm")
+    return await blast_admission.run(
+        "fcm", payload.model_dump(),
+        lambda: fcm_handler.fcm_send_notification(payload, add_history_event, broadcast_history),
+        idempotency_key
+    )
 
 
 # ============================================================================
@@ -451,18 +972,16 @@ if __name__ == "__main__":
     # Suppress ConnectionResetError on Windows
     logging.getLogger("asyncio").setLevel(logging.CRITICAL)
     
-    # Clear background activity log on startup
-    if BACKGROUND_ACTIVITY_FILE.exists():
-        BACKGROUND_ACTIVITY_FILE.unlink()
-        print("🗑️ Cleared background activity log from previous session")
-    
     # Start periodic notification thread (WebPush)
     print("🧵 Starting periodic WebPush notification thread...")
     periodic_thread = threading.Thread(
         target=webpush_handler.send_periodic_notifications, 
         args=(add_history_event, broadcast_history),
-        daemon=True
+        daemon=True,
+        name="periodic-notifications"
     )
+    # Joined on shutdown so an interrupted cycle is checkpointed
+    shared_state.register_worker(periodic_thread)
     periodic_thread.start()
     print("✅ Periodic notification thread started (will send every 10 minutes)")
     
@@ -477,5 +996,7 @@ if __name__ == "__main__":
         host="0.0.0.0", 
         port=8000,
         log_level="warning",
-        access_log=False
+        access_log=False,
+        # Running blasts get this long to finish on restart
+        timeout_graceful_shutdown=DRAIN_TIMEOUT_SECONDS
     )
@@ -1,11 +1,11 @@
 // Main App - PWA POC
 // Imports from modules
-import { connectWebSocket } from './websocket.js';
+import { connectWebSocket, getExcludedTypes, setEventFilter } from './websocket.js';
 import { generateDeviceFingerprint } from './fingerprint.js';
 import { initHistory, renderHistory, updateHistoryFromWebSocket, setupInfiniteScroll, clearHistory } from './history.js';
 import { initWebPush, toggleWebPushSubscription, sendWebPushNotification, clearWebPushSubscriptions } from './webpush.js';
 import { initFCM, toggleFCMSubscription, sendFCMNotification, clearFCMSubscriptions } from './fcm.js';
-import { initDiagnostics, updateDiagnosticPanel, updateActivityMonitor, registerPeriodicSync, sendHeartbeat } from './diagnostics.js';
+import { initDiagnostics, updateDiagnosticPanel, updateActivityMonitor, updateBackendHealth, registerPeriodicSync, sendHeartbeat } from './diagnostics.js';
 
 // Global state
 let swRegistration = null;
@@ -201,18 +201,28 @@ clearHistoryButton.addEventListener('click', async () => {
     }
 });
 
+// Live history filter: periodic notifications are the noisiest event types
+const PERIODIC_EVENT_TYPES = ['webpush_periodic', 'fcm_periodic'];
+const hidePeriodicToggle = document.getElementById('hidePeriodicToggle');
+hidePeriodicToggle.checked = PERIODIC_EVENT_TYPES.every(type => getExcludedTypes().includes(type));
+hidePeriodicToggle.addEventListener('change', () => {
+    setEventFilter(hidePeriodicToggle.checked ? PERIODIC_EVENT_TYPES : []);
+});
+
 // Activity monitor refresh button
 const activityRefresh = document.getElementById('activityRefresh');
 activityRefresh.addEventListener('click', async () => {
     activityRefresh.disabled = true;
     activityRefresh.textContent = '⏳ Consultando...';
-    await updateActivityMonitor();
+    await Promise.all([updateActivityMonitor(), updateBackendHealth()]);
     activityRefresh.disabled = false;
     activityRefresh.textContent = '🔄 Actualizar';
 });
 
 // Auto-update activity every 15 seconds (reduced for mobile performance)
 setInterval(updateActivityMonitor, 15000);
+updateBackendHealth();
+setInterval(updateBackendHealth, 15000);
 
 // Heartbeat fallback (frontend)
 function startFrontendHeartbeat() {
@@ -262,7 +272,8 @@ navigator.serviceWorker.addEventListener('message', (event) => {
     await renderHistory();
     
     // Connect WebSocket for live updates (uses different function)
-    connectWebSocket(updateHistoryFromWebSocket);
+    // (renderHistory reloads everything when too many events were missed during a reconnect)
+    connectWebSocket(updateHistoryFromWebSocket, renderHistory);
     
     // Setup infinite scroll
     setupInfiniteScroll();
@@ -140,6 +140,39 @@ export async function updateActivityMonitor() {
     }
 }
 
+export async function updateBackendHealth() {
+    const diagBackend = document.getElementById('diagBackend');
+    const diagEventLoop = document.getElementById('diagEventLoop');
+    if (!diagBackend || !diagEventLoop) return;
+    
+    try {
+        const response = await fetch('/api/health');
+        const data = await response.json();
+        
+        const uptimeMinutes = Math.floor(data.uptime_seconds / 60);
+        diagBackend.textContent = `✅ v${data.version} · ${uptimeMinutes} min · ${data.websocket_clients} WS`;
+        diagBackend.className = 'diagnostic-value success';
+        
+        // Loop lag is only measured with DIAGNOSTICS_MODE=1
+        const loop = data.event_loop;
+        if (!loop.enabled) {
+            diagEventLoop.textContent = '⚪ Sin monitorizar';
+            diagEventLoop.className = 'diagnostic-value';
+        } else if (loop.lag_ms.p99 !== null && loop.lag_ms.p99 >= loop.threshold_ms) {
+            diagEventLoop.textContent = `⚠️ p99 ${loop.lag_ms.p99} ms · ${loop.slow_calls} bloqueos`;
+            diagEventLoop.className = 'diagnostic-value warning';
+        } else {
+            diagEventLoop.textContent = `✅ p99 ${loop.lag_ms.p99 ?? 0} ms · ${loop.slow_calls} bloqueos`;
+            diagEventLoop.className = 'diagnostic-value success';
+        }
+    } catch (error) {
+        diagBackend.textContent = '❌ Sin respuesta';
+        diagBackend.className = 'diagnostic-value error';
+        diagEventLoop.textContent = '-';
+        diagEventLoop.className = 'diagnostic-value';
+    }
+}
+
 export async function registerPeriodicSync(onSuccess) {
     const diagPeriodicSync = document.getElementById('diagPeriodicSync');
     
@@ -1,4 +1,6 @@
 // Firebase Cloud Messaging Module
+import { newIdempotencyKey } from './fingerprint.js';
+
 let swRegistration = null;
 let isSubscribedFCM = false;
 let currentFCMToken = null;
@@ -73,7 +75,8 @@ async function subscribeToFCM() {
                 },
                 body: JSON.stringify({
                     token: token,
-                    device_fingerprint: deviceFingerprint
+                    device_fingerprint: deviceFingerprint,
+                    timezone: Intl.DateTimeFormat().resolvedOptions().timeZone
                 })
             });
             
@@ -169,12 +172,15 @@ export async function sendFCMNotification() {
         const response = await fetch('/api/fcm/send', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                // Lets the server drop a duplicate of this blast if the request is retried
+                'Idempotency-Key': newIdempotencyKey()
             },
             body: JSON.stringify({
                 title: '🔥 FCM - Prueba Manual',
                 body: 'Mensaje de prueba enviado desde PWA (frontend)',
-                icon: '/static/icon-192.png'
+                icon: '/static/icon-192.png',
+                collapse_key: 'fcm-manual'
             })
         });
         
@@ -95,3 +95,11 @@ export async function generateDeviceFingerprint() {
     
     return fingerprint;
 }
+
+// Unique key per send request (servers dedupe retried blasts by it)
+export function newIdempotencyKey() {
+    if (crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
@@ -7,6 +7,11 @@ let loadedEventIds = new Set();
 let scrollObserver = null;
 let historyList = null;
 
+// Events sharing a timestamp and type are still distinct: prefer the sequence number
+function eventKey(event) {
+    return event.seq ?? `${event.timestamp}-${event.type}`;
+}
+
 export function initHistory(historyListElement) {
     historyList = historyListElement;
 }
@@ -39,7 +44,7 @@ export async function renderHistory() {
         
         // Render events
         data.history.forEach((event, index) => {
-            const eventId = `${event.timestamp}-${event.type}`;
+            const eventId = eventKey(event);
             loadedEventIds.add(eventId);
             
             const historyItem = document.createElement('li');
@@ -92,7 +97,7 @@ export function updateHistoryFromWebSocket(eventData) {
     }
     
     // Check if this event is already loaded
-    const eventId = `${eventData.timestamp}-${eventData.type}`;
+    const eventId = eventKey(eventData);
     
     if (loadedEventIds.has(eventId)) {
         console.log('⏭️ Event already loaded, skipping:', eventId);
@@ -210,7 +215,7 @@ async function loadMoreHistory() {
         
         // Append new events
         data.history.forEach((event) => {
-            const eventId = `${event.timestamp}-${event.type}`;
+            const eventId = eventKey(event);
             
             // Skip if already loaded
             if (loadedEventIds.has(eventId)) return;
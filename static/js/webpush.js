@@ -1,4 +1,6 @@
 // WebPush (VAPID) Module
+import { newIdempotencyKey } from './fingerprint.js';
+
 let swRegistration = null;
 let isSubscribed = false;
 let deviceFingerprint = '';
@@ -119,7 +121,8 @@ async function subscribeToPush() {
         
         const subscriptionWithFingerprint = {
             ...subscription.toJSON(),
-            device_fingerprint: deviceFingerprint
+            device_fingerprint: deviceFingerprint,
+            timezone: Intl.DateTimeFormat().resolvedOptions().timeZone
         };
         
         const subscribeResponse = await fetch('/api/subscribe', {
@@ -182,12 +185,15 @@ export async function sendWebPushNotification() {
         const response = await fetch('/api/send-notification', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                // Lets the server drop a duplicate of this blast if the request is retried
+                'Idempotency-Key': newIdempotencyKey()
             },
             body: JSON.stringify({
                 title: '📡 WebPush - Prueba Manual',
                 body: 'Mensaje de prueba enviado desde PWA (frontend)',
-                icon: '/static/icon-192.png'
+                icon: '/static/icon-192.png',
+                collapse_key: 'webpush-manual'
             })
         });
         
@@ -1,7 +1,44 @@
 // WebSocket Management Module
 export let ws = null;
 
-export function connectWebSocket(onHistoryUpdate) {
+// Sequence number of the next event expected; sent back after a reconnect to get only missed events
+let resumeToken = null;
+let reconnectAttempt = 0;
+// Delay requested by the server when it restarts (overrides the backoff once)
+let serverReconnectDelay = null;
+
+// Exponential backoff cap for reconnects
+const MAX_RECONNECT_DELAY_MS = 30000;
+
+// Full jitter: random delay up to the exponential cap, so clients don't reconnect in lockstep
+function nextReconnectDelay() {
+    if (serverReconnectDelay !== null) {
+        const delay = serverReconnectDelay;
+        serverReconnectDelay = null;
+        return delay;
+    }
+    const cap = Math.min(MAX_RECONNECT_DELAY_MS, 1000 * 2 ** reconnectAttempt);
+    reconnectAttempt++;
+    return Math.floor(Math.random() * cap);
+}
+
+// Event types this client doesn't want pushed live (persisted across reloads)
+const FILTER_STORAGE_KEY = 'wsExcludeTypes';
+
+export function getExcludedTypes() {
+    try {
+        return JSON.parse(localStorage.getItem(FILTER_STORAGE_KEY)) || [];
+    } catch (e) {
+        return [];
+    }
+}
+
+export function setEventFilter(excludeTypes) {
+    localStorage.setItem(FILTER_STORAGE_KEY, JSON.stringify(excludeTypes || []));
+    sendWebSocketMessage({ type: 'subscribe_filter', exclude: excludeTypes || [] });
+}
+
+export function connectWebSocket(onHistoryUpdate, onResync) {
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
     const wsUrl = `${protocol}//${window.location.host}/ws`;
     
@@ -10,28 +47,66 @@ export function connectWebSocket(onHistoryUpdate) {
     
     ws.onopen = () => {
         console.log('✅ WebSocket connected successfully');
+        reconnectAttempt = 0;
+        // Filters are per connection: send it before resuming so the replay is filtered too
+        const excluded = getExcludedTypes();
+        if (excluded.length > 0) {
+            sendWebSocketMessage({ type: 'subscribe_filter', exclude: excluded });
+        }
+        // Reconnect: ask only for the events missed while disconnected
+        if (resumeToken !== null) {
+            sendWebSocketMessage({ type: 'resume', resume_token: resumeToken });
+        }
     };
     
     ws.onmessage = (event) => {
         const data = JSON.parse(event.data);
         console.log('📨 WebSocket message received:', data.type);
         
-        // Backend sends history_update with single event (not full array)
-        if (data.type === 'history_update' && onHistoryUpdate) {
-            console.log('📜 New event received:', data.event ? 'single event' : 'empty');
-            onHistoryUpdate(data.event);  // Pass single event, not array
+        // First frame of a new connection: cursor for the next reconnect
+        if (data.type === 'session' && resumeToken === null) {
+            resumeToken = data.resume_token;
+        }
+        
+        // Backend batches events produced within a short window into one frame
+        // (replay: true when these are the events missed during a reconnect)
+        if (data.type === 'history_batch' && onHistoryUpdate) {
+            console.log(`📜 ${data.events.length} ${data.replay ? 'missed' : 'new'} event(s) received`);
+            const cursor = resumeToken;
+            data.events
+                .filter(historyEvent => cursor === null || historyEvent.seq >= cursor)
+                .forEach(historyEvent => onHistoryUpdate(historyEvent));
+            if (typeof data.resume_token === 'number' && (cursor === null || data.resume_token > cursor)) {
+                resumeToken = data.resume_token;
+            }
+        }
+        
+        // Too many events missed to replay: reload history from the API
+        if (data.type === 'resync') {
+            console.log('🔄 Too many missed events, reloading history');
+            resumeToken = data.resume_token;
+            if (onResync) onResync();
+        }
+        
+        // Server is restarting: keep the cursor and reconnect after the delay it picked
+        if (data.type === 'server_draining') {
+            console.log(`🚦 Server restarting, reconnecting in ${data.reconnect_in_ms} ms`);
+            resumeToken = data.resume_token;
+            serverReconnectDelay = data.reconnect_in_ms;
         }
         
         // Backend sends history_clear when someone clears history
         if (data.type === 'history_clear' && onHistoryUpdate) {
             console.log('🗑️ History cleared by another user');
             onHistoryUpdate(null);  // Signal to clear
+            resumeToken = null;
         }
     };
     
     ws.onclose = () => {
-        console.log('⚠️ WebSocket disconnected, reconnecting in 3s...');
-        setTimeout(() => connectWebSocket(onHistoryUpdate), 3000);
+        const delay = nextReconnectDelay();
+        console.log(`⚠️ WebSocket disconnected, reconnecting in ${(delay / 1000).toFixed(1)}s...`);
+        setTimeout(() => connectWebSocket(onHistoryUpdate, onResync), delay);
     };
     
     ws.onerror = (error) => {
@@ -58,7 +58,10 @@ messaging.onBackgroundMessage((payload) => {
   console.log('📬 SW: Notification options:', notificationOptions);
   console.log('📬 SW: ===== END FCM HANDLER =====');
   
-  return self.registration.showNotification(notificationTitle, notificationOptions);
+  return Promise.all([
+    self.registration.showNotification(notificationTitle, notificationOptions),
+    queueReceipt(data.message_id, 'received')
+  ]);
 });
 
 console.log('🔥 SW: Firebase messaging initialized');
@@ -156,6 +159,51 @@ async function sendHeartbeat() {
   }
 }
 
+// Delivery receipts - batched so a burst of pushes/clicks becomes a single request
+const RECEIPT_BATCH_MS = 1000;
+const RECEIPT_BATCH_MAX = 100;  // Server-side cap per request
+let pendingReceipts = [];
+let receiptFlush = null;
+
+function queueReceipt(messageId, eventName) {
+  if (!messageId) {
+    return Promise.resolve();
+  }
+  
+  pendingReceipts.push({ message_id: messageId, event: eventName, at: Date.now() });
+  
+  // All events queued within the window share the same flush (and waitUntil promise)
+  if (!receiptFlush) {
+    receiptFlush = new Promise(resolve => setTimeout(resolve, RECEIPT_BATCH_MS)).then(flushReceipts);
+  }
+  return receiptFlush;
+}
+
+async function flushReceipts() {
+  const batch = pendingReceipts;
+  pendingReceipts = [];
+  receiptFlush = null;
+  
+  try {
+    // Every receipt in a request is attributed to (and deduped per) this device
+    const fingerprint = await getDeviceFingerprint();
+    
+    for (let i = 0; i < batch.length; i += RECEIPT_BATCH_MAX) {
+      await fetch('/api/receipts', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ fingerprint, receipts: batch.slice(i, i + RECEIPT_BATCH_MAX) }),
+        keepalive: true
+      });
+    }
+    console.log(`🧾 SW: Sent ${batch.length} delivery receipt(s)`);
+  } catch (e) {
+    console.error('❌ SW: Error sending delivery receipts:', e);
+  }
+}
+
 // Periodic Background Sync event - send heartbeat every 5 minutes
 self.addEventListener('periodicsync', event => {
   console.log('⏰ SW: Periodic sync event triggered:', event.tag);
@@ -222,7 +270,8 @@ self.addEventListener('push', event => {
         body: fcmData.body || 'No body',
         icon: fcmData.icon || '/static/icon-192.png',
         badge: fcmData.badge || '/static/icon-192.png',
-        tag: fcmData.tag || 'fcm-notification'
+        tag: fcmData.tag || 'fcm-notification',
+        message_id: fcmData.message_id
       };
     } else {
       // WebPush message - check if it has title and body
@@ -249,7 +298,8 @@ self.addEventListener('push', event => {
     data: {
       dateOfArrival: Date.now(),
       primaryKey: 1,
-      url: '/'
+      url: '/',
+      message_id: notificationData.message_id
     },
     actions: [
       {
@@ -265,11 +315,12 @@ self.addEventListener('push', event => {
   
   console.log('Showing notification with options:', options);
   
-  event.waitUntil(
+  event.waitUntil(Promise.all([
     self.registration.showNotification(notificationData.title, options)
       .then(() => console.log('Notification shown successfully'))
-      .catch(err => console.error('Error showing notification:', err))
-  );
+      .catch(err => console.error('Error showing notification:', err)),
+    queueReceipt(notificationData.message_id, 'received')
+  ]));
 });
 
 // Notification click event
@@ -278,6 +329,11 @@ self.addEventListener('notificationclick', event => {
   
   event.notification.close();
   
+  const messageId = event.notification.data && event.notification.data.message_id;
+  if (event.action !== 'close') {
+    event.waitUntil(queueReceipt(messageId, 'clicked'));
+  }
+  
   if (event.action === 'explore') {
     event.waitUntil(
       clients.openWindow('/')
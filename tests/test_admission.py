@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from back_modules.admission import BlastAdmission
+
+
+def counting_job(calls, result="sent", delay=0.01):
+    async def job():
+        calls.append(result)
+        await asyncio.sleep(delay)
+        return result
+    return job
+
+
+def test_concurrent_retries_with_the_same_key_send_once():
+    async def scenario():
+        admission = BlastAdmission()
+        calls = []
+        results = await asyncio.gather(*[
+            admission.run("webpush", {"title": "Hola"}, counting_job(calls), idempotency_key="k1")
+            for _ in range(3)
+        ])
+        return admission, calls, results
+
+    admission, calls, results = asyncio.run(scenario())
+    assert calls == ["sent"]
+    assert results == ["sent", "sent", "sent"]
+    assert admission.counters["replayed"] == 2
+
+
+def test_finished_result_is_replayed_per_scope():
+    async def scenario():
+        admission = BlastAdmission()
+        calls = []
+        await admission.run("webpush", {"title": "Hola"}, counting_job(calls), idempotency_key="k1")
+        await admission.run("webpush", {"title": "Hola"}, counting_job(calls), idempotency_key="k1")
+        await admission.run("fcm", {"title": "Hola"}, counting_job(calls), idempotency_key="k1")
+        return calls
+
+    assert asyncio.run(scenario()) == ["sent", "sent"]
+
+
+def test_reused_key_with_a_different_payload_is_rejected():
+    async def scenario():
+        admission = BlastAdmission()
+        await admission.run("webpush", {"title": "Hola"}, counting_job([]), idempotency_key="k1")
+        await admission.run("webpush", {"title": "Adiós"}, counting_job([]), idempotency_key="k1")
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(scenario())
+    assert error.value.status_code == 422
+
+
+def test_failed_blast_can_be_retried_with_the_same_key():
+    async def failing():
+        raise RuntimeError("push service down")
+
+    async def scenario():
+        admission = BlastAdmission()
+        with pytest.raises(RuntimeError):
+            await admission.run("webpush", {"title": "Hola"}, failing, idempotency_key="k1")
+        calls = []
+        result = await admission.run("webpush", {"title": "Hola"}, counting_job(calls), idempotency_key="k1")
+        return result, calls
+
+    assert asyncio.run(scenario()) == ("sent", ["sent"])
+
+
+def test_full_queue_gets_429_and_draining_gets_503():
+    async def scenario():
+        admission = BlastAdmission(max_concurrent=1, max_queued=1)
+        blocker = asyncio.Event()
+
+        async def blocked():
+            await blocker.wait()
+            return "sent"
+
+        running = [asyncio.create_task(admission.run("webpush", {}, blocked)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as full:
+            await admission.run("webpush", {}, blocked)
+        blocker.set()
+        await asyncio.gather(*running)
+
+        admission.draining = True
+        with pytest.raises(HTTPException) as draining:
+            await admission.run("webpush", {}, blocked)
+        return full.value, draining.value
+
+    full, draining = asyncio.run(scenario())
+    assert full.status_code == 429 and int(full.headers["Retry-After"]) >= 1
+    assert draining.status_code == 503
@@ -0,0 +1,48 @@
+from starlette.requests import Request
+
+from back_modules import assets
+
+
+def make_request(method="GET", headers=None):
+    raw_headers = [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    return Request({"type": "http", "method": method, "path": "/", "headers": raw_headers})
+
+
+def make_cache(tmp_path):
+    (tmp_path / "app.js").write_text("console.log('hello');\n" * 100)
+    cache = assets.AssetCache()
+    cache.add_file("/static/app.js", tmp_path / "app.js")
+    return cache
+
+
+def test_accepted_encodings_skips_q0():
+    assert assets.accepted_encodings("gzip, br;q=0, deflate;q=0.5") == {"gzip", "deflate"}
+
+
+def test_serves_best_variant_with_etag(tmp_path):
+    cache = make_cache(tmp_path)
+    response = cache.response(make_request(headers={"Accept-Encoding": "gzip, br"}), "/static/app.js")
+    expected = "br" if assets.brotli is not None else "gzip"
+    assert response.headers["content-encoding"] == expected
+    assert response.headers["etag"].endswith(f'-{expected}"')
+
+
+def test_if_none_match_any_encoding_gives_304(tmp_path):
+    cache = make_cache(tmp_path)
+    etag = cache.response(make_request(headers={"Accept-Encoding": "gzip"}), "/static/app.js").headers["etag"]
+    response = cache.response(make_request(headers={"If-None-Match": etag}), "/static/app.js")
+    assert response.status_code == 304
+
+
+def test_head_has_length_but_no_body(tmp_path):
+    cache = make_cache(tmp_path)
+    get = cache.response(make_request(headers={"Accept-Encoding": "gzip"}), "/static/app.js")
+    head = cache.response(make_request("HEAD", {"Accept-Encoding": "gzip"}), "/static/app.js")
+    assert head.status_code == 200
+    assert head.body == b""
+    assert head.headers["content-length"] == str(len(get.body))
+    assert head.headers["etag"] == get.headers["etag"]
+
+
+def test_unknown_path_is_404(tmp_path):
+    assert make_cache(tmp_path).response(make_request(), "/static/missing.js").status_code == 404
@@ -0,0 +1,44 @@
+from back_modules import collapse
+
+
+def test_newer_blast_supersedes_only_shared_devices():
+    with collapse.blast("promo") as fleet_superseded:
+        with collapse.blast("promo", ["a", "b"]):
+            assert fleet_superseded("a")
+            assert fleet_superseded("b")
+            assert not fleet_superseded("c")
+
+
+def test_older_blast_never_supersedes_newer():
+    with collapse.blast("news", ["a"]) as older_superseded:
+        with collapse.blast("news") as newer_superseded:
+            assert older_superseded("a")
+            assert not newer_superseded("a")
+
+
+def test_finished_newer_blast_still_supersedes_running_older():
+    older = collapse.claim("late", None)
+    newer = collapse.claim("late", ["a"])
+    collapse.release("late", newer)
+    assert collapse.is_superseded("late", older, "a")
+    assert not collapse.is_superseded("late", older, "b")
+    collapse.release("late", older)
+    assert "late" not in collapse._blasts
+
+
+def test_keys_are_forgotten_when_blasts_finish():
+    for i in range(100):
+        with collapse.blast(f"key-{i}"):
+            pass
+    assert not any(key.startswith("key-") for key in collapse._blasts)
+
+
+def test_no_collapse_key_yields_none():
+    with collapse.blast(None) as is_superseded:
+        assert is_superseded is None
+
+
+def test_topic_for_long_keys_is_valid():
+    assert collapse.topic_for("short_key") == "short_key"
+    topic = collapse.topic_for("a key with spaces that is much longer than thirty-two characters")
+    assert collapse.TOPIC_PATTERN.match(topic)
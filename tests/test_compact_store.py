@@ -0,0 +1,86 @@
+import pytest
+from pydantic import ValidationError
+
+from back_modules import compact_store, fcm_handler, webpush_handler
+from back_modules.compact_store import FCMTokenRecord, WebPushRecord
+
+
+def webpush_fields(record):
+    return {name: getattr(record, name) for name in WebPushRecord.__slots__}
+
+
+def fcm_fields(record):
+    return {name: getattr(record, name) for name in FCMTokenRecord.__slots__}
+
+
+def test_webpush_round_trip_keeps_nul_empty_none_and_large_keys():
+    records = [
+        WebPushRecord("fp\x00a", "https://push.example", "/send/a\x00b", b"\x04" * 65, b"\x01" * 16, "Europe/Madrid", 22, 7),
+        WebPushRecord("", "https://push.example", "", "not-base64!", "x" * 70000, None, None, None),
+        WebPushRecord(None, "https://other.example", "/ñ", b"", "", "", 0, 23),
+    ]
+    decoded = compact_store.decode_webpush(compact_store.encode_webpush(records))
+    assert [webpush_fields(r) for r in decoded] == [webpush_fields(r) for r in records]
+
+
+def test_fcm_round_trip_keeps_nul_and_none():
+    records = [
+        FCMTokenRecord("tok\x00en", "fp-1", "UTC", 1, 2),
+        FCMTokenRecord("t" * 70000, None, None, None, None),
+    ]
+    decoded = compact_store.decode_fcm(compact_store.encode_fcm(records))
+    assert [fcm_fields(r) for r in decoded] == [fcm_fields(r) for r in records]
+
+
+def test_empty_snapshots_round_trip():
+    assert compact_store.decode_webpush(compact_store.encode_webpush([])) == []
+    assert compact_store.decode_fcm(compact_store.encode_fcm([])) == []
+
+
+def test_version_1_snapshots_still_decode():
+    webpush_v1 = (
+        b"PWSUB\x01\x11\x00\x00\x00https://p.example\x04\x00\x00\x00\x00\x00\x00\x00\x04\x00\x00\x00fp-1"
+        b"\x02\x00\x00\x00/a\x00\x00\x00\x00\x02\x00\x00\x00\x16\x07\x02\x00\x00\x00\x00\x01"
+        b"\x04\x00\x00\x00\x02\x00\x02\x00\x04\x00\x00\x00\x04\x05au"
+    )
+    [record] = compact_store.decode_webpush(webpush_v1)
+    assert webpush_fields(record) == webpush_fields(
+        WebPushRecord("fp-1", "https://p.example", "/a", b"\x04\x05", "au", None, 22, 7)
+    )
+
+    fcm_v1 = b"PWFCM\x01\x04\x00\x00\x00\x01\x00\x00\x00\x05\x00\x00\x00tok-1\x04\x00\x00\x00fp-1\x03\x00\x00\x00UTC\x02\x00\x00\x00\x01\x02"
+    [token] = compact_store.decode_fcm(fcm_v1)
+    assert fcm_fields(token) == fcm_fields(FCMTokenRecord("tok-1", "fp-1", "UTC", 1, 2))
+
+
+def test_truncated_snapshot_is_rejected():
+    data = compact_store.encode_webpush([WebPushRecord("fp", "https://p.example", "/a", b"k", b"a")])
+    with pytest.raises(ValueError):
+        compact_store.decode_webpush(data[:-3])
+
+
+def valid_subscription(**overrides):
+    fields = {"endpoint": "https://push.example/send/1", "keys": {"p256dh": "BNc", "auth": "tB"}, "device_fingerprint": "fp-1"}
+    fields.update(overrides)
+    return fields
+
+
+@pytest.mark.parametrize("overrides", [
+    {"device_fingerprint": "fp\x00x"},
+    {"endpoint": "https://push.example/" + "a" * compact_store.MAX_ENDPOINT_LENGTH},
+    {"keys": {"p256dh": "k" * (compact_store.MAX_KEY_LENGTH + 1), "auth": "a"}},
+    {"keys": {"p256dh": "k", "auth": "a\x00"}},
+    {"timezone": "Europe/\x00"},
+])
+def test_subscriptions_with_nul_or_oversize_fields_are_rejected(overrides):
+    webpush_handler.PushSubscription(**valid_subscription())
+    with pytest.raises(ValidationError):
+        webpush_handler.PushSubscription(**valid_subscription(**overrides))
+
+
+def test_fcm_tokens_with_nul_or_oversize_fields_are_rejected():
+    fcm_handler.FCMSubscription(token="tok", device_fingerprint="fp")
+    with pytest.raises(ValidationError):
+        fcm_handler.FCMSubscription(token="t" * (compact_store.MAX_TOKEN_LENGTH + 1), device_fingerprint="fp")
+    with pytest.raises(ValidationError):
+        fcm_handler.FCMSubscription(token="tok", device_fingerprint="f\x00p")
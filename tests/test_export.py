@@ -0,0 +1,103 @@
+import csv
+import gzip
+import io
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from back_modules import compact_store, export, webpush_handler
+from back_modules.history_index import HistoryIndex
+
+TRICKY_TITLE = 'Oferta, "50%"\nhoy; =SUM(A1)'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    events = [
+        {"type": "notification", "message": f"🔔 Notificación enviada: {TRICKY_TITLE}",
+         "details": {"title": TRICKY_TITLE, "sent": 2}, "timestamp": 100.0},
+        {"type": "test", "message": "ñandú", "details": {}, "timestamp": 200.0},
+        {"type": "test", "message": "tercero", "details": {}, "timestamp": 300.0},
+    ]
+    index = HistoryIndex()
+    index.rebuild(events)
+    monkeypatch.setattr(main, "history", events)
+    monkeypatch.setattr(main, "history_index", index)
+    monkeypatch.setattr(main, "EXPORT_HISTORY_CHUNK", 2)
+    monkeypatch.setattr(main, "background_activity", {
+        "device-a": {"last_activity": 150.0, "timestamp": "a"},
+        "device-b": {"last_activity": 250.0, "timestamp": "b"},
+    })
+    monkeypatch.setattr(webpush_handler, "subscriptions", [
+        compact_store.WebPushRecord.from_dict({
+            "endpoint": f"https://push.example.com/send/{fingerprint}",
+            "keys": {"p256dh": "BAAA", "auth": "AAAA"},
+            "device_fingerprint": fingerprint,
+        })
+        for fingerprint in ("device-a", "device-b", "device-never-seen")
+    ])
+    return TestClient(main.app)
+
+
+def ndjson(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_history_ndjson_round_trip_in_chunks(client):
+    response = client.get("/api/export/history", headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert "content-encoding" not in response.headers
+    rows = ndjson(response)
+    assert [row["message"] for row in rows] == [e["message"] for e in main.history]
+    assert rows[0]["details"] == {"title": TRICKY_TITLE, "sent": 2}
+
+
+def test_history_csv_escapes_user_text(client):
+    response = client.get("/api/export/history?format=csv", headers={"Accept-Encoding": "identity"})
+    assert response.headers["content-disposition"] == 'attachment; filename="history.csv"'
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row["message"] for row in rows] == [e["message"] for e in main.history]
+    assert json.loads(rows[0]["details"])["title"] == TRICKY_TITLE
+    assert list(rows[0]) == main.HISTORY_EXPORT_COLUMNS
+
+
+def test_time_filters(client):
+    rows = ndjson(client.get("/api/export/history?since=150&until=300"))
+    assert [row["timestamp"] for row in rows] == [200.0, 300.0]
+
+    rows = ndjson(client.get("/api/export/activity?since=200"))
+    assert [row["fingerprint"] for row in rows] == ["device-b"]
+
+    # Devices without activity only match when no range is given
+    rows = ndjson(client.get("/api/export/subscriptions"))
+    assert [row["device_fingerprint"] for row in rows] == ["device-a", "device-b", "device-never-seen"]
+    rows = ndjson(client.get("/api/export/subscriptions?until=200"))
+    assert [(row["device_fingerprint"], row["last_activity"]) for row in rows] == [("device-a", 150.0)]
+    # Encryption keys are never exported
+    assert "keys" not in rows[0] and rows[0]["endpoint"] == "https://push.example.com/send/device-a"
+
+
+def test_gzip_when_accepted(client):
+    response = client.get("/api/export/history", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    # The client decompresses transparently
+    assert len(ndjson(response)) == 3
+
+
+def test_unknown_format_is_rejected(client):
+    assert client.get("/api/export/history?format=xml").status_code == 400
+
+
+def test_stream_helpers_round_trip():
+    rows = [{"a": i, "b": TRICKY_TITLE, "c": {"n": [i]}} for i in range(500)]
+    chunks = list(export.chunked(export.csv_lines(rows, ["a", "b", "c"]), size=1024))
+    assert len(chunks) > 1 and all(len(chunk) >= 1024 for chunk in chunks[:-1])
+
+    text = gzip.decompress(b"".join(export.gzip_chunks(iter(chunks)))).decode("utf-8")
+    parsed = list(csv.DictReader(io.StringIO(text)))
+    assert len(parsed) == 500
+    assert parsed[7] == {"a": "7", "b": TRICKY_TITLE, "c": '{"n": [7]}'}
@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+import main
+from back_modules import storage
+from back_modules.history_index import HistoryIndex
+
+
+def event(seq, event_type="test", device=None):
+    details = {"device": device} if device else {}
+    return {"type": event_type, "message": str(seq), "details": details, "timestamp": float(seq)}
+
+
+def indexed(events):
+    index = HistoryIndex()
+    index.rebuild(events)
+    return index
+
+
+def test_query_filters_by_type_device_and_time():
+    history = [event(i, "notification" if i % 2 else "test", f"device-{i % 3}") for i in range(30)]
+    index = indexed(history)
+
+    page, total = index.query(history, types=["notification"], fingerprint="device-1", since=5, until=25)
+    assert [e["timestamp"] for e in page] == [25.0, 19.0, 13.0, 7.0]
+    assert total == 4
+
+    page, total = index.query(history, offset=2, limit=3)
+    assert [e["timestamp"] for e in page] == [27.0, 26.0, 25.0]
+    assert total == 30
+
+
+def test_eviction_keeps_sequence_numbers_stable():
+    history = [event(i) for i in range(10)]
+    index = indexed(history)
+    start, _ = index.seq_window(history, since=6)
+
+    for _ in range(4):
+        index.evict(history.pop(0))
+    history.append(event(10))
+    index.add(history[-1])
+
+    events, next_seq = index.read(history, start, 100)
+    assert [e["timestamp"] for e in events] == [6.0, 7.0, 8.0, 9.0, 10.0]
+    assert next_seq == index.next_seq
+    # Reads from an evicted position start at the oldest retained event
+    assert index.read(history, 0, 1)[0][0]["timestamp"] == 4.0
+
+
+@pytest.fixture
+def fresh_history(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "history", [])
+    monkeypatch.setattr(main, "history_index", HistoryIndex())
+    monkeypatch.setattr(main, "HISTORY_MAX_EVENTS", 20)
+    monkeypatch.setattr(main, "HISTORY_TRIM_BATCH", 5)
+    monkeypatch.setattr(main, "history_store", storage.JournaledStore(
+        tmp_path / "history.json", storage.apply_capped_list_op(20, 5), fsync=False
+    ))
+    monkeypatch.setattr(main, "print", lambda *args: None, raising=False)
+
+
+def test_concurrent_appends_keep_timestamps_in_order_and_history_capped(fresh_history):
+    def add_events():
+        for i in range(50):
+            main.add_history_event("test", str(i))
+
+    threads = [threading.Thread(target=add_events) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    timestamps = [e["timestamp"] for e in main.history]
+    assert timestamps == sorted(timestamps)
+    assert 20 <= len(main.history) <= 25
+    assert main.history_index.next_seq - main.history_index.base == len(main.history)
+    # The journal replays to the same list
+    assert main.history_store.load() == main.history
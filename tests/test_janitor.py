@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from back_modules import compact_store, fcm_handler, janitor, startup, storage, webpush_handler
+
+NOW = 1_000_000.0
+HOUR = 3600
+
+
+def webpush(fingerprint):
+    return {
+        "endpoint": f"https://push.example.com/send/{fingerprint}",
+        "keys": {"p256dh": "BAAA", "auth": "AAAA"},
+        "device_fingerprint": fingerprint,
+    }
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    monkeypatch.setattr(webpush_handler, "subscriptions_store", storage.JournaledStore(
+        tmp_path / "subscriptions.bin",
+        storage.apply_keyed_list_op("device_fingerprint", compact_store.WebPushRecord.from_dict),
+        encode=compact_store.encode_webpush, decode=compact_store.decode_webpush, fsync=False
+    ))
+    monkeypatch.setattr(fcm_handler, "fcm_tokens_store", storage.JournaledStore(
+        tmp_path / "subscriptions_fcm.bin",
+        storage.apply_keyed_list_op("device_fingerprint", compact_store.FCMTokenRecord.from_dict),
+        encode=compact_store.encode_fcm, decode=compact_store.decode_fcm, fsync=False
+    ))
+    monkeypatch.setattr(webpush_handler, "subscriptions", [
+        compact_store.WebPushRecord.from_dict(webpush(fingerprint)) for fingerprint in ("stale", "fresh", "silent")
+    ])
+    monkeypatch.setattr(fcm_handler, "fcm_tokens", [
+        compact_store.FCMTokenRecord.from_dict({"token": f"token-{fingerprint}", "device_fingerprint": fingerprint})
+        for fingerprint in ("stale", "fresh")
+    ])
+    webpush_handler.subscriptions_store.snapshot(webpush_handler.subscriptions)
+    fcm_handler.fcm_tokens_store.snapshot(fcm_handler.fcm_tokens)
+    monkeypatch.setattr(janitor, "INACTIVE_DEVICE_HOURS", 72)
+    monkeypatch.setattr(janitor.time, "time", lambda: NOW)
+
+
+def fingerprints(records):
+    return sorted(record.device_fingerprint for record in records)
+
+
+def test_stale_devices_are_pruned_and_fresh_ones_kept(stores):
+    activity = {
+        "stale": {"last_activity": NOW - 100 * HOUR},
+        "fresh": {"last_activity": NOW - HOUR},
+    }
+    assert janitor.prune_inactive_subscriptions(activity) == (1, 1)
+
+    # Devices that never sent a heartbeat are kept
+    assert fingerprints(webpush_handler.subscriptions) == ["fresh", "silent"]
+    assert fingerprints(fcm_handler.fcm_tokens) == ["fresh"]
+    # The removals are journaled
+    assert fingerprints(webpush_handler.subscriptions_store.load()) == ["fresh", "silent"]
+    assert fingerprints(fcm_handler.fcm_tokens_store.load()) == ["fresh"]
+
+
+def test_nothing_is_pruned_without_stale_devices(stores):
+    assert janitor.prune_inactive_subscriptions({"fresh": {"last_activity": NOW}}) == (0, 0)
+    assert len(webpush_handler.subscriptions) == 3
+
+
+def test_prune_by_endpoint_and_token(stores):
+    assert webpush_handler.prune_subscriptions(endpoints=[webpush("fresh")["endpoint"]]) == 1
+    assert fcm_handler.prune_fcm_tokens(tokens=["token-stale", "token-unknown"]) == 1
+    assert fingerprints(webpush_handler.subscriptions) == ["silent", "stale"]
+    assert fingerprints(fcm_handler.fcm_tokens) == ["fresh"]
+    assert webpush_handler.prune_subscriptions() == 0
+
+
+@pytest.mark.parametrize("route, channel", [
+    (main.clear_subscriptions_route, "webpush"),
+    (main.fcm_clear_subscriptions_route, "fcm"),
+])
+def test_clearing_a_disabled_channel_is_refused(route, channel, monkeypatch):
+    monkeypatch.setattr(startup, "PUSH_CHANNELS", {"webpush", "fcm"} - {channel})
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(route())
+    assert error.value.status_code == 503
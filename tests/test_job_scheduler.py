@@ -0,0 +1,159 @@
+import math
+import time
+from concurrent.futures import Future
+
+import pytest
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from back_modules import job_scheduler, startup
+from back_modules.job_scheduler import JobScheduler, ScheduledNotification, TimerHeap
+
+
+def test_timer_heap_pops_in_due_order_and_honours_reschedule_and_cancel():
+    timers = TimerHeap()
+    for job_id, due in (("a", 30), ("b", 10), ("c", 20), ("d", 5)):
+        timers.push(job_id, due)
+    timers.push("a", 1)
+    timers.cancel("c")
+
+    assert timers.next_due() == 1
+    assert timers.upcoming(10) == [(1, "a"), (5, "d"), (10, "b")]
+    assert timers.pop_due(7) == ["a", "d"]
+    assert len(timers) == 1
+    assert timers.pop_due(100) == ["b"]
+    assert timers.next_due() is None
+
+
+def test_timer_heap_drops_stale_entries_once_they_dominate():
+    timers = TimerHeap()
+    for i in range(200):
+        timers.push(f"job-{i}", i)
+    for i in range(150):
+        timers.cancel(f"job-{i}")
+    assert len(timers._heap) <= 2 * len(timers)
+    assert timers.upcoming(3) == [(150, "job-150"), (151, "job-151"), (152, "job-152")]
+
+
+@pytest.fixture
+def scheduler(tmp_path, monkeypatch):
+    monkeypatch.setattr(startup, "PUSH_CHANNELS", {"webpush"})
+    return JobScheduler(tmp_path / "jobs.json")
+
+
+@pytest.mark.parametrize("fields", [
+    {"delay_seconds": 1e20},
+    {"delay_seconds": math.nan},
+    {"run_at": math.inf},
+    {"run_at": -1},
+    {"delay_seconds": 10, "interval_seconds": 1e20},
+])
+def test_out_of_range_times_are_rejected(fields):
+    with pytest.raises(ValidationError):
+        ScheduledNotification(title="t", body="b", **fields)
+
+
+def test_run_at_more_than_a_year_ahead_is_rejected(scheduler):
+    with pytest.raises(HTTPException) as error:
+        scheduler.add(ScheduledNotification(title="t", body="b", run_at=1e20))
+    assert error.value.status_code == 400
+    assert len(scheduler) == 0
+
+
+def test_unreachable_jobs_stored_earlier_are_dropped_on_load(scheduler, tmp_path):
+    job = scheduler.add(ScheduledNotification(title="t", body="b", delay_seconds=60))
+    bad = dict(job, id="far", next_run_at=1e20)
+    scheduler.store.append({"op": "set", "key": "far", "value": bad}, {})
+
+    reloaded = JobScheduler(tmp_path / "jobs.json")
+    assert reloaded.load() == 1
+    assert reloaded.get("far") is None
+    assert JobScheduler(tmp_path / "jobs.json").load() == 1
+
+
+def test_runner_sleep_is_capped(scheduler, monkeypatch):
+    waits = []
+
+    def fake_wait(timeout=None):
+        waits.append(timeout)
+        scheduler.stopping = True
+
+    scheduler.add(ScheduledNotification(title="t", body="b", delay_seconds=job_scheduler.MAX_SCHEDULE_AHEAD_SECONDS))
+    monkeypatch.setattr(scheduler.changed, "wait", fake_wait)
+    scheduler.run()
+    assert waits == [job_scheduler.MAX_RUNNER_SLEEP_SECONDS]
+
+
+class RecordingAdmission:
+    def __init__(self, status_code=None):
+        self.calls = []
+        self.status_code = status_code
+
+    async def run(self, scope, payload, job, idempotency_key=None):
+        self.calls.append((scope, payload["title"], idempotency_key))
+        if self.status_code:
+            raise HTTPException(status_code=self.status_code, detail="refused")
+        return {"sent": 1}
+
+
+def test_fires_go_through_blast_admission(scheduler):
+    job = scheduler.add(ScheduledNotification(title="Hola", body="b", delay_seconds=0))
+    admission = RecordingAdmission()
+    scheduler._fire(dict(job, runs=1), job, None, None, admission)
+    assert admission.calls == [("scheduled-webpush", "Hola", f"{job['id']}:1")]
+
+
+def submit_fire(scheduler, job, running):
+    """Take a due job out like the runner does and register its fire as in flight"""
+    with scheduler.changed:
+        before = dict(job)
+        scheduler.timers.pop_due(time.time() + 1)
+        scheduler._advance(job)
+        future = Future()
+        if running:
+            future.set_running_or_notify_cancel()
+        scheduler.inflight[future] = before
+        future.add_done_callback(scheduler._fire_done)
+    return before, future
+
+
+def test_job_cancelled_while_its_fire_runs_is_not_restored(scheduler, tmp_path):
+    job = scheduler.add(ScheduledNotification(title="Hola", body="b", delay_seconds=0))
+    before, future = submit_fire(scheduler, job, running=True)
+
+    assert scheduler.cancel(job["id"])
+    scheduler._fire(dict(job), before, None, None, RecordingAdmission(status_code=503))
+    future.set_result(None)
+
+    assert scheduler.get(job["id"]) is None
+    assert scheduler.cancelled == set()
+    assert JobScheduler(tmp_path / "jobs.json").load() == 0
+
+
+def test_job_cancelled_while_its_fire_is_queued_is_not_restored_on_stop(scheduler, tmp_path):
+    job = scheduler.add(ScheduledNotification(title="Hola", body="b", delay_seconds=0, interval_seconds=60))
+    _, future = submit_fire(scheduler, job, running=False)
+
+    assert scheduler.cancel(job["id"])
+    assert future.cancelled()
+    scheduler.stop(timeout=0)
+
+    assert scheduler.get(job["id"]) is None
+    assert JobScheduler(tmp_path / "jobs.json").load() == 0
+
+
+def test_cancelling_an_unknown_job_fails(scheduler):
+    assert not scheduler.cancel("missing")
+
+
+def test_fire_refused_while_draining_is_kept_for_the_next_start(scheduler):
+    job = scheduler.add(ScheduledNotification(title="Hola", body="b", delay_seconds=0))
+    with scheduler.changed:
+        before = dict(job)
+        scheduler.timers.pop_due(time.time() + 1)
+        scheduler._advance(job)
+    assert scheduler.get(job["id"]) is None
+
+    scheduler._fire(dict(job), before, None, None, RecordingAdmission(status_code=503))
+    assert scheduler.get(job["id"]) == before
+    assert scheduler.upcoming(1)[0]["id"] == job["id"]
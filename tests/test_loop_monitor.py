@@ -0,0 +1,58 @@
+import asyncio
+import re
+import threading
+import time
+
+from back_modules import loop_monitor
+from back_modules.loop_monitor import LoopMonitor
+
+
+def block_loop(seconds):
+    time.sleep(seconds)
+
+
+def test_blocking_call_is_measured_as_lag_and_reported(monkeypatch):
+    monkeypatch.setattr(loop_monitor, "print", lambda *args: None, raising=False)
+    monitor = LoopMonitor(threshold=0.1, interval=0.02)
+
+    async def scenario():
+        monitor.start()
+        await asyncio.sleep(0.1)
+        block_loop(0.3)
+        await asyncio.sleep(0.15)
+        monitor.stop()
+
+    asyncio.run(scenario())
+    stats = monitor.stats()
+    assert 280 <= stats["lag_ms"]["max"] < 1000
+    assert stats["lag_ms"]["p50"] < 100
+    assert stats["slow_calls"] == 1
+    call = stats["recent_slow_calls"][0]
+    assert call["blocked_ms"] >= 250
+    assert call["where"].startswith("block_loop (tests/test_loop_monitor.py:")
+
+
+def spin(stop):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+def test_profile_output_is_collapsed_stacks():
+    stop = threading.Event()
+    thread = threading.Thread(target=spin, args=(stop,), name="spinner")
+    thread.start()
+    try:
+        output = loop_monitor.profile(0.1, interval=0.005)
+    finally:
+        stop.set()
+        thread.join()
+
+    lines = output.splitlines()
+    assert all(re.fullmatch(r"[^ ].* \d+", line) for line in lines)
+    spinner = [line for line in lines if line.startswith("spinner;")]
+    assert spinner
+    # Thread name, then frames outermost first, down to the sampled function
+    for line in spinner:
+        frames = line.rsplit(" ", 1)[0].split(";")
+        assert frames[-1].startswith("spin (tests/test_loop_monitor.py:")
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in spinner) >= 5
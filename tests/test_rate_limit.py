@@ -0,0 +1,100 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from back_modules import rate_limit
+from back_modules.rate_limit import ExpiringBuckets
+
+
+def test_burst_then_refill_at_rate():
+    buckets = ExpiringBuckets()
+    assert [buckets.take("a", rate=1.0, burst=3, now=0.0) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("a", rate=1.0, burst=3, now=0.0) == pytest.approx(1.0)
+    # Half a token refilled: the wait shrinks accordingly
+    assert buckets.take("a", rate=1.0, burst=3, now=0.5) == pytest.approx(0.5)
+    assert buckets.take("a", rate=1.0, burst=3, now=2.5) == 0
+
+
+def test_buckets_are_independent_per_key():
+    buckets = ExpiringBuckets()
+    assert buckets.take("a", rate=1.0, burst=1, now=0.0) == 0
+    assert buckets.take("a", rate=1.0, burst=1, now=0.0) > 0
+    assert buckets.take("b", rate=1.0, burst=1, now=0.0) == 0
+
+
+def test_idle_buckets_expire_once_full_again():
+    buckets = ExpiringBuckets()
+    buckets.take("a", rate=1.0, burst=2, now=0.0)
+    buckets.take("b", rate=1.0, burst=2, now=0.5)
+    assert len(buckets) == 2
+    # "a" is full again at t=1, "b" at t=1.5
+    buckets.take("c", rate=1.0, burst=2, now=1.2)
+    assert len(buckets) == 2
+    assert "a" not in buckets._buckets
+
+
+def test_full_table_refuses_new_keys_instead_of_evicting_live_ones():
+    buckets = ExpiringBuckets(max_buckets=2)
+    for key in ("a", "b", "a"):
+        buckets.take(key, rate=1.0, burst=5, now=0.0)
+    assert buckets.take("c", rate=1.0, burst=5, now=0.0) == pytest.approx(5.0)
+    assert list(buckets._buckets) == ["b", "a"]
+    assert buckets.refused == 1
+    # Existing keys keep working
+    assert buckets.take("b", rate=1.0, burst=5, now=0.0) == 0
+
+
+def test_full_table_makes_room_from_expired_buckets_behind_live_ones():
+    buckets = ExpiringBuckets(max_buckets=2)
+    buckets.take("slow", rate=0.1, burst=5, now=0.0)   # full again at t=10
+    buckets.take("fast", rate=10.0, burst=5, now=0.0)  # full again at t=0.1
+    assert buckets.take("new", rate=1.0, burst=5, now=2.0) == 0
+    assert list(buckets._buckets) == ["slow", "new"]
+
+
+def test_fingerprints_per_owner_are_capped():
+    buckets = ExpiringBuckets(max_per_owner=3)
+    waits = [buckets.take(f"fp-{i}", rate=1.0, burst=5, now=0.0, owner="ip-1") for i in range(5)]
+    assert waits[:3] == [0, 0, 0] and all(wait > 0 for wait in waits[3:])
+    assert buckets.take("fp-0", rate=1.0, burst=5, now=0.0, owner="ip-1") == 0
+    assert buckets.take("fp-9", rate=1.0, burst=5, now=0.0, owner="ip-2") == 0
+    # Owner slots are freed as its buckets expire
+    assert buckets.take("fp-3", rate=1.0, burst=5, now=10.0, owner="ip-1") == 0
+    assert buckets._owned == {"ip-1": 1}
+
+
+def test_rotating_fingerprints_from_one_address_is_limited(monkeypatch):
+    # The test client's peer acts as the local proxy reporting client addresses
+    monkeypatch.setattr(rate_limit, "TRUSTED_PROXIES", {"testclient"})
+    app = FastAPI()
+
+    @app.post("/api/heartbeat")
+    async def heartbeat():
+        return {"status": "ok"}
+
+    limiter = rate_limit.RateLimiter(enabled=True)
+    limiter.buckets = ExpiringBuckets(max_per_owner=3)
+    app.add_middleware(rate_limit.RateLimitMiddleware, limiter=limiter)
+    client = TestClient(app)
+
+    def post(fingerprint, forwarded_for):
+        return client.post("/api/heartbeat", json={"fingerprint": fingerprint},
+                           headers={"X-Forwarded-For": forwarded_for}).status_code
+
+    assert [post(f"fp-{i}", "203.0.113.9") for i in range(5)] == [200, 200, 200, 429, 429]
+    # Devices behind other addresses are unaffected
+    assert post("fp-legit", "198.51.100.7") == 200
+    assert limiter.stats()["refused_new_buckets"] == 2
+
+
+def test_forwarded_for_is_trusted_only_from_local_proxies():
+    headers = {b"x-forwarded-for": b"203.0.113.9, 198.51.100.7"}
+    assert rate_limit.client_ip({"client": ("127.0.0.1", 1)}, headers) == "198.51.100.7"
+    assert rate_limit.client_ip({"client": ("192.0.2.1", 1)}, headers) == "192.0.2.1"
+
+
+def test_only_limited_post_routes_are_checked():
+    limiter = rate_limit.RateLimiter(enabled=True)
+    assert limiter.group_for({"type": "http", "method": "POST", "path": "/api/heartbeat"}) == "heartbeat"
+    assert limiter.group_for({"type": "http", "method": "GET", "path": "/api/heartbeat"}) is None
+    assert limiter.group_for({"type": "http", "method": "POST", "path": "/api/history/clear"}) is None
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+import main
+from back_modules import rate_limit, receipts
+
+
+@pytest.fixture(autouse=True)
+def fresh_receipts(monkeypatch):
+    monkeypatch.setattr(receipts, "_messages", OrderedDict())
+    monkeypatch.setattr(receipts, "_pending", [])
+
+
+def test_repeated_receipts_count_once_per_device():
+    receipts.register_message("m1", "webpush", "Hola", targeted=2)
+    receipts.ingest([{"message_id": "m1", "event": "received", "fingerprint": "a"}] * 3)
+    receipts.ingest([
+        {"message_id": "m1", "event": "received", "fingerprint": "b"},
+        {"message_id": "m1", "event": "clicked", "fingerprint": "a"},
+        {"message_id": "unknown", "event": "received", "fingerprint": "a"},
+    ])
+    stats = receipts.get_message_stats("m1")
+    assert (stats["received"], stats["clicked"]) == (2, 1)
+
+
+def test_receipts_without_a_device_are_not_counted():
+    receipts.register_message("m1", "webpush", "Hola", targeted=2)
+    receipts.ingest([{"message_id": "m1", "event": "clicked"}] * 5 + [{"message_id": "m1", "event": "clicked", "fingerprint": ""}])
+    assert receipts.get_message_stats("m1")["clicked"] == 0
+    with pytest.raises(ValidationError):
+        main.ReceiptBatch(receipts=[{"message_id": "m1", "event": "clicked"}])
+    with pytest.raises(ValidationError):
+        main.ReceiptBatch(fingerprint="", receipts=[])
+
+
+def test_batches_are_capped():
+    receipt = {"message_id": "m1", "event": "received"}
+    main.ReceiptBatch(fingerprint="a", receipts=[receipt] * receipts.MAX_RECEIPTS_PER_BATCH)
+    with pytest.raises(ValidationError):
+        main.ReceiptBatch(fingerprint="a", receipts=[receipt] * (receipts.MAX_RECEIPTS_PER_BATCH + 1))
+
+
+def test_receipts_are_rate_limited_per_device(monkeypatch):
+    monkeypatch.setattr(main.rate_limiter, "enabled", True)
+    monkeypatch.setattr(main.rate_limiter, "buckets", rate_limit.ExpiringBuckets())
+    receipts.register_message("m1", "webpush", "Hola", targeted=1)
+    client = TestClient(main.app)
+    _, burst = rate_limit.RATE_LIMIT_RULES["receipts"][0]
+
+    def post(fingerprint):
+        return client.post("/api/receipts", json={
+            "fingerprint": fingerprint, "receipts": [{"message_id": "m1", "event": "received"}]
+        })
+
+    assert [post("fp-1").status_code for _ in range(burst)] == [202] * burst
+    refused = post("fp-1")
+    assert refused.status_code == 429 and int(refused.headers["Retry-After"]) >= 1
+    # Another device behind the same address still gets through
+    assert post("fp-2").status_code == 202
+
+    # The accepted receipts were attributed to the batch's device and deduped
+    assert receipts.get_message_stats("m1")["received"] == 2
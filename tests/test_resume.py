@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+import pytest
+
+import main
+from back_modules import storage
+from back_modules.history_index import HistoryIndex
+from back_modules.websocket_manager import ConnectionManager, parse_resume_token
+
+
+@pytest.fixture
+def history(monkeypatch):
+    events = [{"type": "test", "message": str(i), "details": {}, "timestamp": 100.0} for i in range(10)]
+    index = HistoryIndex()
+    index.rebuild(events)
+    monkeypatch.setattr(main, "history", events)
+    monkeypatch.setattr(main, "history_index", index)
+    monkeypatch.setattr(main, "MAX_RESUME_EVENTS", 5)
+    return events
+
+
+def test_events_sharing_a_timestamp_resume_exactly_after_the_cursor(history):
+    missed = main.missed_events(7)
+    assert [e["message"] for e in missed] == ["7", "8", "9"]
+    assert main.missed_events(main.latest_resume_token()) == []
+
+
+def test_resume_outside_the_window_asks_for_a_reload(history, monkeypatch):
+    # More than MAX_RESUME_EVENTS missed
+    assert main.missed_events(2) is None
+    # Ahead of the server (e.g. history was cleared and the server restarted)
+    assert main.missed_events(11) is None
+    # Already evicted
+    main.history_index.evict(main.history.pop(0))
+    assert main.missed_events(0) is None
+    assert [e["message"] for e in main.missed_events(6)] == ["6", "7", "8", "9"]
+
+
+@pytest.mark.parametrize("token", [None, "5", 1.5, -1, True])
+def test_malformed_tokens_are_rejected(token):
+    assert parse_resume_token(token) is None
+
+
+def test_sequence_numbers_survive_a_reload():
+    index = HistoryIndex()
+    saved = [{"type": "test", "seq": 40 + i, "timestamp": float(i)} for i in range(3)]
+    index.rebuild(saved)
+    assert (index.base, index.next_seq) == (40, 43)
+    assert index.read(saved, 41, 10)[0] == saved[1:]
+
+
+def test_sequence_numbers_are_not_reused_after_clear_and_restart(history, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "HISTORY_SEQ_FILE", tmp_path / "history_seq.json")
+    monkeypatch.setattr(main, "history_store", storage.JournaledStore(
+        tmp_path / "history.json", storage.apply_capped_list_op(100), fsync=False
+    ))
+    monkeypatch.setattr(main, "print", lambda *args: None, raising=False)
+    old_token = 5
+
+    asyncio.run(main.clear_history())
+    # Restart: reload from disk into a fresh index
+    restarted = HistoryIndex()
+    restarted.rebuild(main.load_history(), main.load_history_seq())
+    monkeypatch.setattr(main, "history", main.load_history())
+    monkeypatch.setattr(main, "history_index", restarted)
+    assert restarted.next_seq == 10
+
+    for i in range(8):
+        main.history.append({"type": "test", "message": f"new {i}", "details": {}, "timestamp": 200.0})
+        restarted.add(main.history[-1])
+    assert main.history[0]["seq"] == 10
+    assert main.missed_events(old_token) is None
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, text):
+        self.frames.append(json.loads(text))
+
+
+def test_frames_carry_the_next_sequence_as_token():
+    manager = ConnectionManager()
+    client = FakeWebSocket()
+    manager.active_connections.append(client)
+    events = [{"type": "test", "seq": 7, "timestamp": 1.0}, {"type": "test", "seq": 8, "timestamp": 1.0}]
+
+    async def publish():
+        for event in events:
+            await manager.publish_event(event)
+        await manager.flush()
+
+    asyncio.run(publish())
+    assert client.frames == [{"type": "history_batch", "events": events, "resume_token": 9}]
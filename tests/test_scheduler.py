@@ -0,0 +1,78 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from back_modules import scheduler
+from back_modules.scheduler import TokenBucket
+
+
+def utc(hour):
+    return datetime(2024, 1, 15, hour, 30, tzinfo=timezone.utc).timestamp()
+
+
+def test_token_bucket_bursts_then_waits_for_refill():
+    bucket = TokenBucket(rate=2, capacity=2)
+    now = bucket.updated_at
+    assert [bucket.try_acquire(now=now) for _ in range(2)] == [0, 0]
+    assert bucket.try_acquire(now=now) == pytest.approx(0.5)
+    assert bucket.try_acquire(now=now + 0.5) == 0
+
+
+@pytest.mark.parametrize("rate", [0, -1])
+def test_token_bucket_without_a_positive_rate_is_unlimited(rate):
+    bucket = TokenBucket(rate)
+    assert all(bucket.try_acquire() == 0 for _ in range(100))
+    bucket.acquire()
+
+
+def test_jitter_is_deterministic_and_inside_the_window():
+    offsets = [scheduler.jitter_offset(f"device-{i}", 600) for i in range(1000)]
+    assert offsets == [scheduler.jitter_offset(f"device-{i}", 600) for i in range(1000)]
+    assert all(0 <= offset < 600 for offset in offsets)
+    # Spread over the whole window, not bunched up
+    assert min(offsets) < 60 and max(offsets) > 540
+    assert scheduler.jitter_offset("device-1", 0) == 0.0
+    assert scheduler.jitter_offset(None, 600) == scheduler.jitter_offset("", 600)
+
+
+@pytest.mark.parametrize("quiet, hour, expected", [
+    ((9, 17), 12, True),
+    ((9, 17), 17, False),
+    ((9, 17), 8, False),
+    # Wrapping past midnight
+    ((22, 7), 23, True),
+    ((22, 7), 3, True),
+    ((22, 7), 7, False),
+    ((22, 7), 12, False),
+    # Empty window
+    ((8, 8), 8, False),
+    ((None, 7), 3, False),
+])
+def test_quiet_hours_in_utc(quiet, hour, expected):
+    record = {"quiet_start": quiet[0], "quiet_end": quiet[1]}
+    assert scheduler.in_quiet_hours(record, now=utc(hour)) is expected
+
+
+def test_quiet_hours_use_the_device_timezone():
+    # 12:30 UTC is 07:30 in New York (EST) and 21:30 in Tokyo
+    record = {"quiet_start": 22, "quiet_end": 8, "timezone": "America/New_York"}
+    assert scheduler.in_quiet_hours(record, now=utc(12))
+    assert not scheduler.in_quiet_hours(dict(record, timezone="Asia/Tokyo"), now=utc(12))
+    assert scheduler.in_quiet_hours(dict(record, timezone="Asia/Tokyo"), now=utc(14))
+    # Unknown timezones fall back to UTC
+    assert not scheduler.in_quiet_hours(dict(record, timezone="Mars/Olympus"), now=utc(12))
+
+
+def test_delivery_plan_is_sorted_by_due_time():
+    records = [("webpush", {"device_fingerprint": f"device-{i}"}) for i in range(50)]
+    records.append(("fcm", {"device_fingerprint": "device-7"}))
+    plan = scheduler.build_delivery_plan(records, cycle_start=1000.0, window_seconds=60)
+
+    due_times = [due for due, _, _ in plan]
+    assert due_times == sorted(due_times)
+    assert all(1000.0 <= due < 1060.0 for due in due_times)
+    # The same device gets the same offset on every channel and every cycle
+    device_7 = [due for due, _, record in plan if record["device_fingerprint"] == "device-7"]
+    assert len(set(device_7)) == 1
+    again = scheduler.build_delivery_plan(records, cycle_start=4600.0, window_seconds=60)
+    assert [due - 3600.0 for due, _, _ in again] == pytest.approx(due_times)
@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import Counter
+from multiprocessing.connection import Listener
+
+import pytest
+
+from back_modules import collapse, fcm_handler, scheduler, sharding
+from back_modules.sharding import HashRing, ShardClient, ShardError, ShardWorker
+
+
+KEYS = [f"device-{i}" for i in range(3000)]
+
+
+def test_ring_spreads_keys_and_is_deterministic():
+    ring = HashRing(["shard-1", "shard-2", "shard-3"])
+    owners = Counter(ring.node_for(key) for key in KEYS)
+    assert set(owners) == {"shard-1", "shard-2", "shard-3"}
+    assert min(owners.values()) > len(KEYS) / 3 * 0.7
+    # Same placement in another ring (or process) built from the same nodes
+    other = HashRing(["shard-3", "shard-1", "shard-2"])
+    assert all(ring.node_for(key) == other.node_for(key) for key in KEYS)
+
+
+def test_adding_a_shard_only_moves_keys_to_it():
+    ring = HashRing(["shard-1", "shard-2", "shard-3"])
+    before = {key: ring.node_for(key) for key in KEYS}
+    ring.add("shard-4")
+    moved = [key for key in KEYS if ring.node_for(key) != before[key]]
+    assert {ring.node_for(key) for key in moved} == {"shard-4"}
+    assert len(moved) < len(KEYS) / 4 * 1.5
+
+
+def test_empty_ring_has_no_owner():
+    with pytest.raises(ValueError):
+        HashRing().node_for("device-1")
+
+
+@pytest.mark.parametrize("entry, expected", [
+    ("shard-1=10.0.0.5:9101", ("shard-1", ("10.0.0.5", 9101))),
+    ("10.0.0.5:9102", ("10.0.0.5:9102", ("10.0.0.5", 9102))),
+    (":9103", (":9103", ("127.0.0.1", 9103))),
+])
+def test_worker_addresses(entry, expected):
+    assert sharding.parse_worker_address(entry) == expected
+
+
+def test_worker_refuses_to_start_without_an_auth_key(monkeypatch, tmp_path):
+    monkeypatch.setattr(sharding, "SHARD_AUTHKEY", b"")
+    with pytest.raises(ShardError):
+        sharding.serve("shard-1", data_dir=tmp_path)
+
+
+def test_remote_workers_need_an_auth_key(monkeypatch):
+    monkeypatch.setattr(sharding, "SHARD_AUTHKEY", b"")
+    monkeypatch.setattr(sharding, "SHARD_WORKERS", ["shard-1=10.0.0.5:9101"])
+    with pytest.raises(ShardError):
+        sharding.start_coordinator()
+    assert sharding.coordinator is None
+
+
+def test_hung_worker_times_out_instead_of_blocking(monkeypatch):
+    monkeypatch.setattr(sharding, "SHARD_RPC_TIMEOUT", 0.2)
+    listener = Listener(("127.0.0.1", 0), authkey=b"secret")
+    received = []
+
+    def hung_worker():
+        with listener.accept() as connection:
+            received.append(connection.recv())
+            time.sleep(1)
+
+    thread = threading.Thread(target=hung_worker, daemon=True)
+    thread.start()
+    client = ShardClient("shard-1", listener.address, b"secret")
+    start = time.monotonic()
+    with pytest.raises(ShardError, match="did not answer count"):
+        client.call("count", channel="webpush")
+    assert time.monotonic() - start < 1
+    assert received == [{"op": "count", "args": {"channel": "webpush"}}]
+    # The connection is not pooled for the next call
+    assert client._idle == []
+    thread.join()
+    listener.close()
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    worker = ShardWorker("shard-1", tmp_path)
+    worker.put_many("fcm", [
+        {"token": "t-quiet", "device_fingerprint": "quiet", "quiet_start": 0, "quiet_end": 0},
+        {"token": "t-awake", "device_fingerprint": "awake"},
+    ])
+    monkeypatch.setattr(scheduler, "in_quiet_hours", lambda record, now=None: record.device_fingerprint == "quiet")
+    return worker
+
+
+def test_periodic_blast_skips_devices_in_quiet_hours(worker, monkeypatch):
+    sent_to = []
+
+    def fake_deliver(targets, data, collapse_key=None, is_superseded=None):
+        sent_to.extend(record.device_fingerprint for record in targets)
+        return len(targets), 0, 0, set()
+
+    monkeypatch.setattr(fcm_handler, "deliver_fcm", fake_deliver)
+    result = worker.send("fcm", {"data": {}, "collapse_key": "periodic", "quiet_hours": True})
+    assert sent_to == ["awake"]
+    assert result == {"sent": 1, "failed": 0, "superseded": 0, "quiet": 1, "pruned": 0}
+
+
+def test_newer_blast_with_the_same_collapse_key_supersedes_per_shard(worker, monkeypatch):
+    def fake_deliver(targets, data, collapse_key=None, is_superseded=None):
+        # A newer blast for the same key to one device starts mid-way through this one
+        with collapse.blast(collapse_key, ["awake"]):
+            superseded = sum(1 for record in targets if is_superseded(record.device_fingerprint))
+        return len(targets) - superseded, 0, superseded, {"t-quiet"}
+
+    monkeypatch.setattr(fcm_handler, "deliver_fcm", fake_deliver)
+    result = worker.send("fcm", {"data": {}, "collapse_key": "score"})
+    assert result == {"sent": 1, "failed": 0, "superseded": 1, "quiet": 0, "pruned": 1}
+    assert worker.count("fcm") == 1
@@ -0,0 +1,85 @@
+import pytest
+
+from back_modules import storage
+
+
+def make_store(tmp_path, **kwargs):
+    return storage.JournaledStore(tmp_path / "items.json", storage.apply_dict_op, empty=dict, **kwargs)
+
+
+def test_journal_replays_on_top_of_snapshot(tmp_path):
+    store = make_store(tmp_path)
+    state = {"a": 1}
+    store.snapshot(state)
+    state["b"] = 2
+    store.append({"op": "set", "key": "b", "value": 2}, state)
+    del state["a"]
+    store.append({"op": "delete", "keys": ["a"]}, state)
+
+    assert make_store(tmp_path).load() == {"b": 2}
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    store = make_store(tmp_path)
+    store.append({"op": "set", "key": "a", "value": 1}, {"a": 1})
+    store._close_journal()
+    with open(store.journal_path, "a", encoding="utf-8") as f:
+        f.write('{"op":"set","key":"b"')
+
+    reopened = make_store(tmp_path)
+    assert reopened.load() == {"a": 1}
+    reopened.append({"op": "set", "key": "c", "value": 3}, {})
+    assert make_store(tmp_path).load() == {"a": 1, "c": 3}
+
+
+def test_corrupt_snapshot_is_moved_aside_and_refuses_to_load(tmp_path):
+    store = make_store(tmp_path)
+    store.snapshot({"a": 1})
+    store.append({"op": "set", "key": "b", "value": 2}, {"a": 1, "b": 2})
+    store.path.write_bytes(b"{not json")
+
+    with pytest.raises(storage.CorruptStoreError):
+        make_store(tmp_path).load()
+    assert store.corrupt_path.read_bytes() == b"{not json"
+    assert store.journal_path.exists()
+
+    # Still refused until the operator restores or deletes the corrupt file
+    with pytest.raises(storage.CorruptStoreError):
+        make_store(tmp_path).load()
+    store.corrupt_path.unlink()
+    assert make_store(tmp_path).load() == {"b": 2}
+
+
+def test_compaction_runs_in_background_and_keeps_every_op(tmp_path):
+    store = make_store(tmp_path, compact_every=10)
+    state = {}
+    for i in range(25):
+        state[str(i)] = i
+        store.append({"op": "set", "key": str(i), "value": i}, state)
+    store.wait_for_compaction()
+
+    assert store.path.exists()
+    assert make_store(tmp_path).load() == state
+
+
+def test_rotated_journal_survives_a_crash_before_the_snapshot(tmp_path):
+    store = make_store(tmp_path)
+    state = {"a": 1}
+    store.snapshot(state)
+    store.append({"op": "set", "key": "b", "value": 2}, {"a": 1, "b": 2})
+    store._close_journal()
+    # As left by a compaction that never finished
+    store.journal_path.replace(store.rotated_path)
+    store.append({"op": "set", "key": "c", "value": 3}, {})
+
+    assert make_store(tmp_path).load() == {"a": 1, "b": 2, "c": 3}
+
+
+def test_stale_compaction_does_not_overwrite_newer_snapshot(tmp_path):
+    store = make_store(tmp_path)
+    started_at = store._epoch
+    store.snapshot({"new": True})
+
+    store._compact({"old": True}, started_at)
+    assert make_store(tmp_path).load() == {"new": True}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["items.json"]
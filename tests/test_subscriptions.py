@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+import pytest
+
+from back_modules import compact_store, storage, webpush_handler
+from back_modules.webpush_handler import PushSubscription
+
+WRITERS = 4
+DEVICES_PER_WRITER = 40
+
+
+def subscription(fingerprint, version=0):
+    return PushSubscription(
+        endpoint=f"https://push.example.com/send/{fingerprint}/{version}",
+        keys={"p256dh": "BAAA", "auth": "AAAA"},
+        device_fingerprint=fingerprint,
+    )
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(webpush_handler, "subscriptions_store", storage.JournaledStore(
+        tmp_path / "subscriptions.bin",
+        storage.apply_keyed_list_op("device_fingerprint", compact_store.WebPushRecord.from_dict),
+        encode=compact_store.encode_webpush, decode=compact_store.decode_webpush, fsync=False
+    ))
+    monkeypatch.setattr(webpush_handler, "subscriptions", [])
+    monkeypatch.setattr(webpush_handler, "print", lambda *args: None, raising=False)
+    return webpush_handler.subscriptions_store
+
+
+def test_concurrent_subscribe_unsubscribe_keeps_snapshots_stable(store):
+    done = threading.Event()
+    torn_reads = []
+
+    def writer(w):
+        async def churn():
+            for i in range(DEVICES_PER_WRITER):
+                fingerprint = f"w{w}-{i}"
+                await webpush_handler.subscribe(subscription(fingerprint))
+                # Re-subscribing replaces the device's subscription
+                await webpush_handler.subscribe(subscription(fingerprint, version=1))
+                if i % 2:
+                    await webpush_handler.unsubscribe(subscription(fingerprint))
+                if i % 5 == 0:
+                    webpush_handler.prune_subscriptions(endpoints=[f"https://push.example.com/send/{fingerprint}/1"])
+        asyncio.run(churn())
+
+    def reader():
+        # Readers iterate the current list without the lock: it must never change under them
+        while not done.is_set():
+            snapshot = webpush_handler.subscriptions
+            size = len(snapshot)
+            fingerprints = [record.device_fingerprint for record in snapshot]
+            if len(fingerprints) != size or len(set(fingerprints)) != size:
+                torn_reads.append(fingerprints)
+
+    readers = [threading.Thread(target=reader) for _ in range(2)]
+    writers = [threading.Thread(target=writer, args=(w,)) for w in range(WRITERS)]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    expected = {
+        f"w{w}-{i}" for w in range(WRITERS) for i in range(DEVICES_PER_WRITER)
+        if not i % 2 and i % 5
+    }
+    current = webpush_handler.subscriptions
+    assert torn_reads == []
+    assert sorted(record.device_fingerprint for record in current) == sorted(expected)
+    assert all(record.get("endpoint").endswith("/1") for record in current)
+    # Every write was journaled: a restart sees the same subscriptions
+    assert sorted(record.device_fingerprint for record in store.load()) == sorted(expected)
@@ -0,0 +1,55 @@
+import asyncio
+import json
+
+from fastapi.testclient import TestClient
+
+import main
+from back_modules.websocket_manager import ConnectionManager
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, text):
+        self.frames.append(json.loads(text))
+
+
+def event(seq, event_type):
+    return {"type": event_type, "seq": seq, "timestamp": 1.0}
+
+
+def test_events_are_batched_per_client_filter():
+    manager = ConnectionManager(batch_window=0.01)
+    everything, quiet, also_quiet, nothing = (FakeWebSocket() for _ in range(4))
+    manager.active_connections.extend([everything, quiet, also_quiet, nothing])
+    manager.set_filter(quiet, ["webpush_periodic"])
+    manager.set_filter(also_quiet, ["webpush_periodic"])
+    manager.set_filter(nothing, ["webpush_periodic", "notification"])
+    events = [event(1, "notification"), event(2, "webpush_periodic"), event(3, "notification")]
+
+    async def publish():
+        for item in events:
+            await manager.publish_event(item)
+        # One frame for the whole window
+        await asyncio.sleep(0.05)
+
+    asyncio.run(publish())
+    assert everything.frames == [{"type": "history_batch", "events": events, "resume_token": 4}]
+    # Filtered clients still get the cursor past the events they skipped
+    assert quiet.frames == [{"type": "history_batch", "events": [events[0], events[2]], "resume_token": 4}]
+    assert also_quiet.frames == quiet.frames
+    assert nothing.frames == []
+
+
+def test_socket_survives_messages_that_are_not_commands():
+    client = TestClient(main.app)
+    with client.websocket_connect("/ws") as websocket:
+        assert websocket.receive_json()["type"] == "session"
+        for text in ("[]", "1", "null", '"resume"', "{not json", '{"type": "subscribe_filter", "exclude": 5}'):
+            websocket.send_text(text)
+        websocket.send_text(json.dumps({"type": "subscribe_filter", "exclude": ["webpush_periodic", 3]}))
+        # A resume round trip proves every earlier message was handled without closing the socket
+        websocket.send_text(json.dumps({"type": "resume", "resume_token": main.latest_resume_token()}))
+        assert websocket.receive_json()["type"] == "history_batch"
+        assert list(main.manager.filters.values()) == [frozenset({"webpush_periodic"})]